@@ -1,21 +1,22 @@
 #!/usr/bin/env python
 # -*- coding: utf-8
 """
-Created on 16:54 19/03/2018 2018 
+Created on 16:54 19/03/2018 2018
 
 """
-import pandas as pd
+from os.path import dirname, join
+
 from bokeh.io import curdoc
-from bokeh.layouts import layout, widgetbox
+from bokeh.layouts import column, layout
 from bokeh.models import ColumnDataSource, HoverTool, Div
 from bokeh.models.widgets import Slider, Select, TextInput
 from bokeh.plotting import figure
+from bokeh.transform import log_cmap
 
-from os.path import dirname, join
+from dorina.explorer import load
 
-deseq = pd.read_csv(open(join(dirname(__file__), 'test_deseq_out.csv')))
-deseq = deseq.loc[:10000]
-deseq = deseq.rename(columns={'Unnamed: 0': 'Gene name'})
+# Indexed once per server process and shared by the sessions
+deseq = load(join(dirname(__file__), 'test_deseq_out.csv'))
 
 axis_map = {
     "Mean of normalized counts": "baseMean",
@@ -26,30 +27,24 @@ axis_map = {
 
 
 def select_genes():
-    selected = deseq.copy()
-    gene_val = gene.value.strip()
-    selected = selected[
-        (selected['padj'] < padj.value)
-    ]
-    if gene_val:
-        selected = selected[
-            selected['Gene name'].str.contains(gene_val) == True]
-    return selected
+    return deseq.select(padj.value, gene.value)
 
 
 def update():
-    df = select_genes()
+    rows = select_genes()
 
     x_name = axis_map[x_axis.value]
     y_name = axis_map[y_axis.value]
-    p.title.text = "%d genes selected" % len(df)
+    points, bins = deseq.view(rows, x_name, y_name)
+    if points is None:
+        p.title.text = "%d genes selected, shown as counts per bin" % len(rows)
+    else:
+        p.title.text = "%d genes selected" % len(rows)
     p.xaxis.axis_label = x_axis.value
     p.yaxis.axis_label = y_axis.value
-    source.data = dict(
-        x=df[x_name],
-        y=df[y_name],
-        name=df["Gene name"],
-    )
+    source.data = points or dict(x=[], y=[], name=[])
+    bin_source.data = bins or dict(x=[], y=[], width=[], height=[],
+                                   count=[])
 
 
 # Input controls
@@ -58,28 +53,37 @@ x_axis = Select(title="X Axis", options=sorted(axis_map.keys()),
 y_axis = Select(title="Y Axis", options=sorted(axis_map.keys()),
                 value="Fold change")
 gene = TextInput(title="Gene name contains")
-padj = Slider(title="Adjusted pval", value=0.05, start=deseq['padj'].min(),
-              end=deseq['padj'].max(), step=0.05)
+padj_min, padj_max = deseq.padj_range()
+padj = Slider(title="Adjusted pval", value=0.05, start=padj_min,
+              end=padj_max, step=0.05)
 
 source = ColumnDataSource(data=dict(x=[], y=[], name=[]))
+bin_source = ColumnDataSource(data=dict(x=[], y=[], width=[], height=[],
+                                        count=[]))
 
 hover = HoverTool(tooltips=[
     ("Counts", "@x"),
     ("FC", "@y"),
-    ("Name", "@name")
+    ("Name", "@name"),
+    ("Genes", "@count")
 ])
 
-p = figure(plot_height=600, plot_width=700, title="", toolbar_location=None,
+p = figure(height=600, width=700, title="", toolbar_location=None,
            tools=[hover])
-p.circle(x="x", y="y", source=source, size=7, line_color=None)
-
-controls = [gene, x_axis, y_axis, padj]
-for control in controls:
+p.rect(x="x", y="y", width="width", height="height", source=bin_source,
+       line_color=None,
+       fill_color=log_cmap('count', 'Viridis256', 1, max(len(deseq), 2)))
+p.scatter(x="x", y="y", source=source, size=7, line_color=None)
+
+# The slider updates once released, not for every step it passes
+padj.on_change('value_throttled', lambda attr, old, new: update())
+for control in [gene, x_axis, y_axis]:
     control.on_change('value', lambda attr, old, new: update())
+controls = [gene, x_axis, y_axis, padj]
 
 sizing_mode = 'fixed'  # 'scale_width' also looks nice with this example
 
-inputs = widgetbox(*controls, sizing_mode=sizing_mode)
+inputs = column(*controls, sizing_mode=sizing_mode)
 
 desc = Div(text=open(join(dirname(__file__), "description.html")).read(),
            width=800)
@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+"""
+Benchmark the Dorina.analyse() hot path on synthetic genome-scale data.
+
+A data directory with a synthetic assembly (region tracks for every
+chromosome) and a regulator file is generated once, then every analyse mode
+is timed in a fresh process so peak RSS is measured per case. Results are
+written as JSON so runs can be compared:
+
+    python benchmark/bench_analyse.py --sites 1000000 --output report.json
+"""
+from __future__ import unicode_literals
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+from io import open
+from queue import Empty
+
+import click
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+log = logging.getLogger(__name__)
+
+ASSEMBLY = 'bench1'
+SPECIES = 'b_synthetic'
+CHROM_SIZE = 50000000
+# Fraction of the sites seeded as overlapping BENCH_reg0 and BENCH_reg1
+# pairs, which the window cases need to find any hits
+PAIRED = 0.05
+
+CASES = [
+    ('any', dict(set_a=['BENCH_reg0', 'BENCH_reg1'])),
+    ('all', dict(set_a=['BENCH_reg0', 'BENCH_reg1'], match_a='all')),
+    ('cds_any', dict(set_a=['BENCH_reg0'], region_a='CDS')),
+    ('window', dict(set_a=['BENCH_reg0', 'BENCH_reg1'], match_a='all',
+                    window_a=0)),
+    ('window_slop', dict(set_a=['BENCH_reg0', 'BENCH_reg1'], match_a='all',
+                         window_a=100)),
+    ('or', dict(set_a=['BENCH_reg0'], set_b=['BENCH_reg1'], combine='or')),
+    ('and', dict(set_a=['BENCH_reg0'], set_b=['BENCH_reg1'], combine='and')),
+    ('xor', dict(set_a=['BENCH_reg0'], set_b=['BENCH_reg1'], combine='xor')),
+    ('not', dict(set_a=['BENCH_reg0'], set_b=['BENCH_reg1'], combine='not')),
+]
+
+
+def _write_gff(filename, chroms, starts, ends, feature, names, strands):
+    with open(filename, 'w', encoding='utf-8') as fh:
+        fh.write('#gff2\n')
+        for i in range(0, len(starts), 100000):
+            fh.write(''.join(
+                '%s\tbench\t%s\t%d\t%d\t.\t%s\t.\tID=%s\n' % (
+                    c, feature, s + 1, e, strand, n)
+                for c, s, e, n, strand in zip(
+                    chroms[i:i + 100000], starts[i:i + 100000],
+                    ends[i:i + 100000], names[i:i + 100000],
+                    strands[i:i + 100000])))
+
+
+def generate(datadir, n_chroms, n_genes, n_sites, n_regulators, seed=0):
+    """Write a synthetic assembly and regulator set into datadir"""
+    rng = np.random.RandomState(seed)
+    genome_dir = os.path.join(datadir, 'genomes', SPECIES, ASSEMBLY)
+    regulator_dir = os.path.join(datadir, 'regulators', SPECIES, ASSEMBLY)
+    for directory in (genome_dir, regulator_dir):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    with open(os.path.join(datadir, 'genomes', SPECIES, 'description.json'),
+              'w', encoding='utf-8') as fh:
+        fh.write(json.dumps({'id': SPECIES, 'label': 'Synthetic',
+                             'scientific': 'Synthetic', 'weight': 1}))
+    chrom_names = ['chr%d' % (i + 1) for i in range(n_chroms)]
+    with open(os.path.join(genome_dir, ASSEMBLY + '.genome'), 'w',
+              encoding='utf-8') as fh:
+        fh.write(''.join('%s\t%d\n' % (c, CHROM_SIZE) for c in chrom_names))
+
+    # Genes tile every chromosome with random gaps, sorted by position
+    per_chrom = max(1, n_genes // n_chroms)
+    slot = CHROM_SIZE // per_chrom
+    chroms = np.repeat(chrom_names, per_chrom)
+    starts = np.tile(np.arange(per_chrom) * slot, n_chroms) + \
+        rng.randint(0, slot // 4, per_chrom * n_chroms)
+    lengths = rng.randint(slot // 4, slot // 2, per_chrom * n_chroms)
+    ends = starts + lengths
+    names = np.array(['gene%07d' % i for i in range(len(starts))])
+    strands = rng.choice(['+', '-'], len(starts))
+    quarter = lengths // 4
+
+    tracks = {
+        'all': ('gene', starts, ends),
+        '5_utr': ('five_prime_UTR', starts, starts + quarter // 4),
+        'cds': ('CDS', starts + quarter, ends - quarter),
+        'intron': ('intron', starts + quarter // 4, starts + quarter),
+        '3_utr': ('three_prime_UTR', ends - quarter // 4, ends),
+    }
+    for track, (feature, track_starts, track_ends) in tracks.items():
+        _write_gff(os.path.join(genome_dir, track + '.gff'), chroms,
+                   track_starts, track_ends, feature, names, strands)
+    next_start = np.append(starts[1:], CHROM_SIZE)
+    last = np.append(chroms[1:] != chroms[:-1], True)
+    next_start[last] = CHROM_SIZE
+    _write_gff(os.path.join(genome_dir, 'intergenic.gff'), chroms, ends,
+               next_start, 'intergenic', names, np.repeat('.', len(starts)))
+
+    # Regulator sites, spread over n_regulators ids in one sorted BED file
+    site_chroms = rng.randint(0, n_chroms, n_sites)
+    site_starts = rng.randint(0, CHROM_SIZE - 100, n_sites)
+    regulators = rng.randint(0, n_regulators, n_sites)
+    n_pairs = int(n_sites * PAIRED) // 2 if n_regulators > 1 else 0
+    paired = slice(n_pairs, 2 * n_pairs)
+    regulators[:n_pairs], regulators[paired] = 0, 1
+    site_chroms[paired] = site_chroms[:n_pairs]
+    site_starts[paired] = site_starts[:n_pairs] + rng.randint(0, 20, n_pairs)
+    order = np.lexsort((site_starts, site_chroms))
+    site_chroms, site_starts = site_chroms[order], site_starts[order]
+    regulators = regulators[order]
+    site_ends = site_starts + rng.randint(20, 50, n_sites)
+    with open(os.path.join(regulator_dir, 'BENCH_synthetic.bed'), 'w',
+              encoding='utf-8') as fh:
+        for i in range(0, n_sites, 100000):
+            fh.write(''.join(
+                'chr%d\t%d\t%d\tBENCH#reg%d*reg%d_site\t5\t+\n' % (
+                    c + 1, s, e, r, r)
+                for c, s, e, r in zip(
+                    site_chroms[i:i + 100000], site_starts[i:i + 100000],
+                    site_ends[i:i + 100000], regulators[i:i + 100000])))
+    with open(os.path.join(regulator_dir, 'BENCH_synthetic.json'), 'w',
+              encoding='utf-8') as fh:
+        fh.write(json.dumps([{'id': 'BENCH_reg%d' % i,
+                              'experiment': 'BENCH',
+                              'summary': 'Synthetic regulator %d' % i}
+                             for i in range(n_regulators)]))
+
+
+def _run_case(queue, datadir, backend, case, kwargs, repeat):
+    try:
+        queue.put(_time_case(datadir, backend, case, kwargs, repeat))
+    except Exception as e:
+        log.exception(e)
+        queue.put({'case': case, 'backend': backend, 'error': repr(e)})
+
+
+def _time_case(datadir, backend, case, kwargs, repeat):
+    from dorina import run
+    from dorina.regulator import Regulator
+
+    timings = {}
+    start = time.time()
+    dorina = run.Dorina(datadir, backend=backend)
+    timings['init'] = time.time() - start
+
+    if case == 'regulator':
+        seconds = []
+        for _ in range(repeat):
+            start = time.time()
+            regulators = [Regulator.from_name(x, ASSEMBLY)
+                          for x in ('BENCH_reg0', 'BENCH_reg1')]
+            sites = [x.bed if backend == 'bedtools' else x.intervals
+                     for x in regulators]
+            timings['load'] = time.time() - start
+            merged = Regulator.merge(sites)
+            seconds.append(time.time() - start)
+        hits = len(merged)
+    else:
+        seconds = []
+        for _ in range(repeat):
+            dorina.cache.clear()
+            start = time.time()
+            result = dorina.analyse(ASSEMBLY, **kwargs)
+            hits = len(result)
+            seconds.append(time.time() - start)
+
+    return {'case': case, 'backend': backend, 'hits': hits,
+            'seconds': min(seconds), 'mean_seconds': float(np.mean(seconds)),
+            'timings': timings,
+            'peak_rss_kb': resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss}
+
+
+def run_case(datadir, backend, case, kwargs, repeat):
+    """Time one case in a fresh process and return its report entry"""
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(
+        target=_run_case, args=(queue, datadir, backend, case, kwargs, repeat))
+    process.start()
+    while True:
+        try:
+            report = queue.get(timeout=1)
+            break
+        except Empty:
+            # A crashed process puts nothing on the queue
+            if not process.is_alive():
+                report = {'case': case, 'backend': backend,
+                          'error': 'exit code %s' % process.exitcode}
+                break
+    process.join()
+    report['query'] = kwargs
+    return report
+
+
+@click.command()
+@click.option('--datadir', type=click.Path(file_okay=False),
+              help="Directory for the synthetic data, reused if it exists")
+@click.option('--chromosomes', default=24, show_default=True)
+@click.option('--genes', default=20000, show_default=True)
+@click.option('--sites', default=100000, show_default=True,
+              help="Number of regulator sites")
+@click.option('--regulators', default=10, show_default=True,
+              help="Number of regulator ids sharing the sites")
+@click.option('--backend', multiple=True, default=['native', 'bedtools'],
+              type=click.Choice(['native', 'bedtools']), show_default=True)
+@click.option('--case', 'cases', multiple=True,
+              type=click.Choice(['regulator'] + [x for x, _ in CASES]),
+              help="Cases to run, all by default")
+@click.option('--repeat', default=3, show_default=True)
+@click.option('--output', type=click.File('w'), default='-',
+              help="JSON report file")
+def main(datadir, chromosomes, genes, sites, regulators, backend, cases,
+         repeat, output):
+    """Benchmark Dorina.analyse() on synthetic data"""
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+    if datadir is None:
+        datadir = tempfile.mkdtemp(prefix='dorina_bench')
+    params = {'chromosomes': chromosomes, 'genes': genes, 'sites': sites,
+              'regulators': regulators, 'paired': PAIRED}
+    stamp = os.path.join(datadir, 'bench.json')
+    if not os.path.isfile(stamp) or json.load(open(stamp)) != params:
+        log.info('Generating synthetic data in %s' % datadir)
+        generate(datadir, chromosomes, genes, sites, regulators)
+        with open(stamp, 'w', encoding='utf-8') as fh:
+            fh.write(json.dumps(params))
+
+    queries = [('regulator', {})] + CASES
+    if cases:
+        queries = [(x, y) for x, y in queries if x in cases]
+
+    results = []
+    for _backend in backend:
+        for case, kwargs in queries:
+            report = run_case(datadir, _backend, case, kwargs, repeat)
+            if 'error' in report:
+                log.warning('%(backend)s %(case)s failed: %(error)s' % report)
+                results.append(report)
+                continue
+            log.info('%(backend)s %(case)s: %(seconds).3fs, %(hits)d hits, '
+                     '%(peak_rss_kb)d kB peak RSS' % report)
+            if not report['hits']:
+                log.warning('%(backend)s %(case)s returned no hits, its time '
+                            'does not measure a match' % report)
+            results.append(report)
+
+    output.write(json.dumps({
+        'params': params,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results}, indent=2, sort_keys=True))
+    output.write('\n')
+
+
+if __name__ == '__main__':
+    main()
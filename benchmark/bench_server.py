@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+"""
+Load test for the doRiNA query service.
+
+Sends analyse() queries from many concurrent clients to a running
+``dorina serve`` instance and writes throughput and latency percentiles as
+JSON:
+
+    dorina serve -p /path/to/datasets/ &
+    python benchmark/bench_server.py --queries queries.jsonl --concurrency 32
+"""
+from __future__ import unicode_literals
+import asyncio
+import json
+import os
+import sys
+import time
+
+import click
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dorina.server import request  # noqa: E402
+
+
+async def load(host, port, queries, concurrency=8, total=100):
+    """Drive the service with concurrent clients and measure latency
+
+    :param list queries: queries sent in turn
+    :param int concurrency: requests in flight at any time
+    :param int total: number of requests
+    :return dict: throughput, latency percentiles (seconds) and the number
+        of requests per status code
+    """
+    latencies, statuses = [], {}
+    pending = iter(range(total))
+
+    async def client():
+        for i in pending:
+            start = time.time()
+            status, _ = await request(host, port, 'POST', '/analyse',
+                                      queries[i % len(queries)])
+            latencies.append(time.time() - start)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    start = time.time()
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    elapsed = time.time() - start
+    latencies.sort()
+
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(p * len(latencies)))]
+
+    return {'requests': total,
+            'concurrency': concurrency,
+            'seconds': elapsed,
+            'throughput': total / elapsed,
+            'latency': {'p50': percentile(0.5), 'p90': percentile(0.9),
+                        'p99': percentile(0.99), 'max': latencies[-1]},
+            'statuses': statuses}
+
+
+@click.command()
+@click.option('--host', default='127.0.0.1', show_default=True)
+@click.option('--port', default=8080, show_default=True)
+@click.option('--queries', type=click.File('r'), required=True,
+              help="JSON lines file of queries, each with a 'genome' key")
+@click.option('--concurrency', default=8, show_default=True)
+@click.option('--requests', 'total', default=100, show_default=True)
+@click.option('--output', type=click.File('w'), default='-',
+              help="JSON report file")
+def main(host, port, queries, concurrency, total, output):
+    """Measure throughput and tail latency of the query service"""
+    queries = [json.loads(line) for line in queries if line.strip()]
+    loop = asyncio.new_event_loop()
+    report = loop.run_until_complete(
+        load(host, port, queries, concurrency, total))
+    loop.close()
+    output.write(json.dumps(report, indent=2, sort_keys=True))
+    output.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -7,6 +7,7 @@ Created on 16:08 11/10/2017 2017
 from __future__ import unicode_literals
 
 import functools
+import json
 import logging
 import os
 import sys
@@ -16,8 +17,10 @@ from subprocess import check_call, Popen
 import click
 
 from dorina import __version__, run as run_dorina
+from dorina.cache import ResultCache
 from dorina.config import config
 from dorina.genome import Genome
+from dorina.output import FORMATS, ResultWriter, check_format
 from dorina.regulator import Regulator
 
 # https://stackoverflow.com/a/15729700/1694714
@@ -83,19 +86,29 @@ def common_params(func):
               help="Set logging level to debug (more verbose)")
 @click.option('-q', '--quiet', is_flag=True,
               help="Set logging level to error (quieter)")
-@click.option('-a', '--seta', required=True, multiple=True,
+@click.option('-a', '--seta', multiple=True,
               help="First set of regulators to analyse")
 @click.option('-b', '--setb',
               help="Second set of regulators to analyse")
 @click.option('--genes', multiple=True, default=['all'])
-@click.option('--matcha', required=True, type=click.Choice(['any', 'all']),
+@click.option('--matcha', required=True,
+              type=click.Choice(run_dorina.MATCHES),
               show_default=True, default='any',
-              help="All or any regulators in set A must match")
+              help="All, any or at least --minmatcha regulators in set A must "
+                   "match")
+@click.option('--minmatcha', type=click.IntRange(min=1), default=1,
+              show_default=True,
+              help="Regulators in set A that must match with --matcha atleast")
 @click.option('--regiona', default='any', type=click.Choice(
     ['any', 'CDS', '3prime', '5prime', 'intron', 'intergenic']),
               help="Region to match set A in", show_default=True)
-@click.option('--matchb', type=click.Choice(['any', 'all']), default='any',
-              help="All or any regulators in set B must match", show_default=True)
+@click.option('--matchb', type=click.Choice(run_dorina.MATCHES),
+              default='any', show_default=True,
+              help="All, any or at least --minmatchb regulators in set B must "
+                   "match")
+@click.option('--minmatchb', type=click.IntRange(min=1), default=1,
+              show_default=True,
+              help="Regulators in set B that must match with --matchb atleast")
 @click.option('--regionb', default='any', type=click.Choice(
     ['any', 'CDS', '3prime', '5prime', 'intron', 'intergenic']),
               help="Region to match set B in", show_default=True)
@@ -109,24 +122,79 @@ def common_params(func):
 @click.option('--path', '-p', default=config.get('DEFAULT', 'data_path'),
               type=click.Path(exists=True, dir_okay=True, readable=True),
               help="Path to genomes and regulators")
-def run(genome, debug, quiet, seta, setb, genes, matcha, regiona,
-        matchb, regionb, combine, windowa, windowb, path):
+@click.option('--backend', default='bedtools',
+              type=click.Choice(run_dorina.BACKENDS),
+              help="Interval engine used for the analysis", show_default=True)
+@click.option('--batch', type=click.File('r'),
+              help="JSON lines file of analyse() queries to run in one pass")
+@click.option('--jobs', '-j', type=click.IntRange(min=1), default=1,
+              help="Worker processes used for the analysis", show_default=True)
+@click.option('--output', default='-', type=click.Path(dir_okay=False),
+              help="File to write the results to, '-' for stdout")
+@click.option('--format', 'fmt', default='bed', type=click.Choice(FORMATS),
+              help="Output format", show_default=True)
+@click.option('--no-cache', is_flag=True,
+              help="Compute the results even when they are cached")
+@click.option('--cache-path', default=config.get('DEFAULT', 'cache_path'),
+              type=click.Path(file_okay=False),
+              help="Directory of the result cache", show_default=True)
+def run(genome, debug, quiet, seta, setb, genes, matcha, minmatcha, regiona,
+        matchb, minmatchb, regionb, combine, windowa, windowb, path, backend,
+        batch, jobs, output, fmt, no_cache, cache_path):
     """"Run doRiNA from the command line"""
     if debug:
         log.setLevel(logging.DEBUG)
     elif quiet:
         log.setLevel(logging.ERROR)
+    if not seta and batch is None:
+        raise click.UsageError('Either --seta or --batch is required')
+    try:
+        check_format(fmt)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint="'--format'")
 
-    dorina = run_dorina.Dorina(path)
-    Genome.init(path)
+    result_cache = None
+    if not no_cache:
+        result_cache = ResultCache(cache_path,
+                                   config.getint('DEFAULT', 'cache_size'))
+    dorina = run_dorina.Dorina(path, backend=backend, jobs=jobs,
+                               result_cache=result_cache)
     mapping = {}
     for x in Genome.all().values():
         for y in x['assemblies']:
             mapping[y] = x['id']
-    click.echo('Running DORINA')
-    result = dorina.analyse(genome, seta, matcha, regiona, setb, matchb,
-                            regionb, combine, genes, windowa, windowb)
-    click.echo(result)
+    click.echo('Running DORINA', err=True)
+    try:
+        with ResultWriter(output, fmt) as writer:
+            if batch is not None:
+                queries = [json.loads(line) for line in batch
+                           if line.strip()]
+                results = dorina.analyse_batch(genome, queries)
+                for i, (query, result) in enumerate(zip(queries, results)):
+                    writer.write(result, json.dumps(query, sort_keys=True), i)
+            else:
+                result = dorina.analyse(genome, seta, matcha, regiona, setb,
+                                        matchb, regionb, combine, genes,
+                                        windowa, windowb, minmatcha,
+                                        minmatchb)
+                writer.write(result)
+    finally:
+        dorina.close()
+    sys.exit(0)
+
+
+@click.command('cache-stats')
+@click.option('--cache-path', default=config.get('DEFAULT', 'cache_path'),
+              type=click.Path(file_okay=False),
+              help="Directory of the result cache", show_default=True)
+@click.option('--clear', is_flag=True, help="Remove every cached result")
+def cache_stats(cache_path, clear):
+    """Show the size and hit rate of the result cache"""
+    result_cache = ResultCache(cache_path,
+                               config.getint('DEFAULT', 'cache_size'))
+    if clear:
+        result_cache.clear()
+    click.echo(json.dumps(result_cache.stats(), indent=2, sort_keys=True))
     sys.exit(0)
 
 
@@ -179,8 +247,85 @@ def regulators(path):
     sys.exit(0)
 
 
+@click.command()
+@click.option('--path', '-p', default=config.get('DEFAULT', 'data_path'),
+              type=click.Path(exists=True, dir_okay=True, readable=True),
+              help="Path to genomes and regulators")
+def index(path):
+    """Build the regulator and gene indexes and the genome track stores of a
+    data directory"""
+    Regulator.init(path)
+    for index_dir in Regulator.build_indexes():
+        click.echo(index_dir)
+    Genome.init(path)
+    for gff in Genome.build_gene_indexes():
+        click.echo(gff)
+    for track_dir in Genome.build_tracks():
+        click.echo(track_dir)
+    sys.exit(0)
+
+
+@click.command()
+@click.argument('bedfile', type=click.Path(exists=True, dir_okay=False))
+@click.argument('jsonfile', type=click.Path(exists=True, dir_okay=False))
+@click.option('--assembly', '-a', required=True,
+              help="Assembly the regulator sites belong to")
+@click.option('--species', '-s',
+              help="Species directory, needed for a new assembly")
+@click.option('--path', '-p', default=config.get('DEFAULT', 'data_path'),
+              type=click.Path(exists=True, dir_okay=True, readable=True),
+              help="Path to genomes and regulators")
+def ingest(bedfile, jsonfile, assembly, species, path):
+    """Add a regulator BED file and its JSON metadata to a data directory"""
+    try:
+        ids = Regulator.ingest(path, bedfile, jsonfile, assembly, species)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    for regulator_id in ids:
+        click.echo(regulator_id)
+    sys.exit(0)
+
+
+@click.command()
+@click.option('--path', '-p', default=config.get('DEFAULT', 'data_path'),
+              type=click.Path(exists=True, dir_okay=True, readable=True),
+              help="Path to genomes and regulators")
+@click.option('--host', default='127.0.0.1', show_default=True)
+@click.option('--port', default=8080, show_default=True)
+@click.option('--backend', default='bedtools',
+              type=click.Choice(run_dorina.BACKENDS),
+              help="Interval engine used for the analysis", show_default=True)
+@click.option('--workers', type=click.IntRange(min=1), default=4,
+              help="Queries computed at the same time", show_default=True)
+@click.option('--backlog', type=click.IntRange(min=0), default=None,
+              help="Queries waiting for a worker before new ones are "
+                   "refused [default: --workers]")
+@click.option('--jobs', '-j', type=click.IntRange(min=1), default=1,
+              help="Worker processes used for each analysis",
+              show_default=True)
+@click.option('--timeout', type=float, default=60, show_default=True,
+              help="Seconds a request may wait for its result")
+@click.option('--preload', multiple=True,
+              help="Genome whose region tracks are loaded at startup")
+def serve(path, host, port, backend, workers, backlog, jobs, timeout,
+          preload):
+    """Serve doRiNA queries over HTTP"""
+    from dorina.server import serve as serve_queries
+
+    dorina = run_dorina.Dorina(path, backend=backend, jobs=jobs)
+    try:
+        serve_queries(dorina, host, port, timeout, workers, preload, backlog)
+    finally:
+        dorina.close()
+    sys.exit(0)
+
+
 cli.add_command(regulators)
+cli.add_command(index)
+cli.add_command(ingest)
 cli.add_command(genomes)
 cli.add_command(run)
+cli.add_command(serve)
+cli.add_command(cache_stats)
 if __name__ == '__main__':
     cli()
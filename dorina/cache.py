@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+"""
+Bounded in-memory cache for parsed regulators and genome region tracks, and
+a content-addressed on-disk cache of analysis results.
+"""
+from __future__ import unicode_literals
+import atexit
+import gzip
+import hashlib
+import io
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from dorina.intervals import Intervals
+
+log = logging.getLogger(__name__)
+
+
+def sizeof(value):
+    """Estimate the memory held by a cached regulator or genome track"""
+    if isinstance(value, Intervals):
+        return value.nbytes()
+    filename = getattr(value, 'fn', None)
+    if isinstance(filename, str) and os.path.isfile(filename):
+        return os.path.getsize(filename)
+    return sys.getsizeof(value)
+
+
+def mtime(filename):
+    """Modification time used to invalidate entries built from filename"""
+    return os.stat(filename).st_mtime
+
+
+def fingerprint(filename):
+    """Path, size and modification time identifying the content of filename"""
+    stat = os.stat(filename)
+    return [os.path.abspath(filename), stat.st_size, stat.st_mtime]
+
+
+class LRUCache(object):
+    """Least recently used cache bounded by the estimated size of its values.
+
+    Keys should include the modification time of the files a value was built
+    from, so an updated file is loaded again instead of served stale.
+    """
+
+    def __init__(self, max_bytes=2 ** 30):
+        """
+        :param int max_bytes: upper bound for the summed value sizes, 0
+            disables caching
+        """
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, loader):
+        """Return the value cached under key, calling loader() on a miss
+
+        :param tuple key: cache key
+        :param callable loader: builds the value when it is not cached
+        """
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key][0]
+            self.misses += 1
+
+        value = loader()
+        self.put(key, value)
+        return value
+
+    def peek(self, key):
+        """Return the value cached under key, or None on a miss"""
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key][0]
+            self.misses += 1
+        return None
+
+    def put(self, key, value, size=None):
+        """Cache value under key, evicting the least recently used entries
+
+        :param int size: estimated size of value, sizeof(value) by default
+        """
+        if size is None:
+            size = sizeof(value)
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._data:
+                self.nbytes -= self._data.pop(key)[1]
+            self._data[key] = (value, size)
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                evicted, (_, evicted_size) = self._data.popitem(last=False)
+                self.nbytes -= evicted_size
+                self.evictions += 1
+                log.debug('Evicted %r from cache' % (evicted, ))
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        """Hit, miss and eviction counters with the current occupancy"""
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._data),
+                'nbytes': self.nbytes,
+                'max_bytes': self.max_bytes}
+
+
+class ResultCache(object):
+    """Analysis results stored compressed on disk, addressed by the digest of
+    the normalized query and the fingerprints of its input files.
+
+    Entries are gzip-compressed tab separated records. A hit refreshes the
+    modification time of its entry, and the least recently used entries are
+    removed once the directory grows beyond max_bytes. The directory is
+    scanned once, when the cache is opened; entry order and total size are
+    then kept up to date in memory. Hit and miss counts
+    are kept in memory and added to ``stats.json`` by flush(), which runs
+    on close() and at exit, so they add up over separate runs.
+    """
+
+    STATS = 'stats.json'
+
+    def __init__(self, directory, max_bytes=2 ** 30):
+        """
+        :param str directory: cache directory, created when missing
+        :param int max_bytes: upper bound for the compressed entry sizes
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._counts = {}
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # Entry sizes from the least to the most recently used
+        self._sizes = OrderedDict(
+            (filename, size) for _, size, filename in sorted(self._entries()))
+        self._nbytes = sum(self._sizes.values())
+        atexit.register(self.flush)
+
+    @staticmethod
+    def key(params):
+        """Digest of a JSON serializable description of a query"""
+        return hashlib.sha1(json.dumps(params, sort_keys=True).encode(
+            'utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.tsv.gz')
+
+    def _entries(self):
+        """Paths, sizes and modification times of all entries"""
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if not name.endswith('.tsv.gz'):
+                    continue
+                filename = os.path.join(root, name)
+                try:
+                    stat = os.stat(filename)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, filename))
+        return entries
+
+    def _count(self, counter, n=1):
+        with self._lock:
+            self._counts[counter] = self._counts.get(counter, 0) + n
+
+    def flush(self):
+        """Add the counters of this process to the stored ones"""
+        filename = os.path.join(self.directory, self.STATS)
+        with self._lock:
+            if not self._counts:
+                return
+            counts = self._read_counts()
+            for counter, n in self._counts.items():
+                counts[counter] = counts.get(counter, 0) + n
+            tmp = '%s.%d.tmp' % (filename, os.getpid())
+            try:
+                with io.open(tmp, 'w', encoding='utf-8') as fh:
+                    fh.write(json.dumps(counts))
+                os.rename(tmp, filename)
+            except (IOError, OSError) as e:
+                log.debug('Unable to write cache stats: {}'.format(e))
+                return
+            self._counts = {}
+
+    def close(self):
+        self.flush()
+
+    def _read_counts(self):
+        try:
+            with io.open(os.path.join(self.directory, self.STATS),
+                         encoding='utf-8') as fh:
+                return json.load(fh)
+        except (IOError, ValueError):
+            return {}
+
+    def get(self, key):
+        """Records stored under key, or None on a miss
+
+        :return list: records as lists of text fields
+        """
+        filename = self.path(key)
+        try:
+            with gzip.open(filename, 'rb') as fh:
+                data = fh.read().decode('utf-8')
+            os.utime(filename, None)
+        except (IOError, OSError, EOFError):
+            self._count('misses')
+            return None
+        with self._lock:
+            if filename in self._sizes:
+                self._sizes.move_to_end(filename)
+        self._count('hits')
+        return [line.split('\t') for line in data.splitlines()]
+
+    def put(self, key, records):
+        """Store the records of a result under key and evict old entries
+
+        :param records: iterable of lists of text fields
+        """
+        filename = self.path(key)
+        directory = os.path.dirname(filename)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp = '%s.%d.tmp' % (filename, os.getpid())
+        with gzip.open(tmp, 'wb') as fh:
+            for record in records:
+                fh.write(('\t'.join(record) + '\n').encode('utf-8'))
+        size = os.path.getsize(tmp)
+        os.rename(tmp, filename)
+        with self._lock:
+            self._nbytes += size - self._sizes.pop(filename, 0)
+            self._sizes[filename] = size
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until the size bound holds
+
+        :return int: number of removed entries
+        """
+        evicted = 0
+        with self._lock:
+            while self._sizes and self._nbytes > self.max_bytes:
+                filename, size = self._sizes.popitem(last=False)
+                self._nbytes -= size
+                try:
+                    os.remove(filename)
+                except OSError:
+                    # Removed by another process
+                    continue
+                evicted += 1
+        if evicted:
+            log.debug('Evicted %d cached results' % evicted)
+            self._count('evictions', evicted)
+        return evicted
+
+    def clear(self):
+        for _, _, filename in self._entries():
+            os.remove(filename)
+        with self._lock:
+            self._sizes.clear()
+            self._nbytes = 0
+            self._counts = {}
+            try:
+                os.remove(os.path.join(self.directory, self.STATS))
+            except OSError:
+                pass
+
+    def stats(self):
+        """Entry count and size with the hit, miss and eviction counters"""
+        entries = self._entries()
+        with self._lock:
+            counts = self._read_counts()
+            for counter, n in self._counts.items():
+                counts[counter] = counts.get(counter, 0) + n
+        mtimes = [x for x, _, _ in entries]
+        return {'directory': self.directory,
+                'hits': counts.get('hits', 0),
+                'misses': counts.get('misses', 0),
+                'evictions': counts.get('evictions', 0),
+                'entries': len(entries),
+                'nbytes': sum(size for _, size, _ in entries),
+                'max_bytes': self.max_bytes,
+                'oldest': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(
+                    min(mtimes))) if mtimes else None}
@@ -28,6 +28,9 @@ def validate_configuration(configuration):
     if '~' in default_path:
         configuration.set(
             'DEFAULT', 'data_path', value=validate_data_path(default_path))
+    if configuration.has_option('DEFAULT', 'cache_path'):
+        configuration.set('DEFAULT', 'cache_path', value=path.expanduser(
+            configuration.get('DEFAULT', 'cache_path')))
 
     return configuration
 
@@ -0,0 +1,377 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+"""
+Parallel, resumable FTP downloads verified against Ensembl CHECKSUMS files.
+
+Every worker thread keeps one logged in FTP connection for all of its
+transfers. Files are written to ``<name>.part`` and only renamed once they
+are complete and their checksum matches, so an interrupted download resumes
+from the partial file on the next attempt.
+
+Compressed files can instead be decompressed while they are received. The
+checksum is then computed on the fly and the sort order of BED and GFF
+records is checked as they are written, so the file is read only once and
+the compressed copy never reaches the disk.
+"""
+from __future__ import unicode_literals
+import logging
+import os
+import shutil
+import subprocess
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from ftplib import FTP, all_errors, error_perm
+from io import open
+
+from dorina.sorting import SortChecker, store_record
+
+log = logging.getLogger(__name__)
+
+CHECKSUMS = 'CHECKSUMS'
+# Records of these files are checked for their sort order while streaming
+TRACK_EXTENSIONS = ('.bed', '.gff', '.gff3', '.gtf')
+
+
+def _sum_update(checksum, data):
+    for byte in bytearray(data):
+        checksum = (checksum >> 1) + ((checksum & 1) << 15) + byte
+        checksum &= 0xffff
+    return checksum
+
+
+def bsd_sum(filename):
+    """BSD checksum and 1 kB block count of a file, as ``sum`` prints them
+
+    :param str filename: file to check
+    :return tuple: checksum and blocks
+    """
+    if shutil.which('sum'):
+        fields = subprocess.check_output(['sum', filename]).split()
+        return int(fields[0]), int(fields[1])
+
+    checksum, size = 0, 0
+    with open(filename, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(2 ** 20), b''):
+            size += len(chunk)
+            checksum = _sum_update(checksum, chunk)
+    return checksum, (size + 1023) // 1024
+
+
+class BSDSum(object):
+    """BSD checksum of data fed in chunks, computed by a ``sum`` process
+    reading from a pipe when available"""
+
+    def __init__(self):
+        self.size = 0
+        self.checksum = 0
+        self._process = None
+        if shutil.which('sum'):
+            self._process = subprocess.Popen(['sum'], stdin=subprocess.PIPE,
+                                             stdout=subprocess.PIPE)
+
+    def update(self, data):
+        self.size += len(data)
+        if self._process is not None:
+            self._process.stdin.write(data)
+        else:
+            self.checksum = _sum_update(self.checksum, data)
+
+    def digest(self):
+        """Checksum and 1 kB block count of the data fed so far"""
+        if self._process is not None:
+            fields = self._process.communicate()[0].split()
+            self._process = None
+            return int(fields[0]), int(fields[1])
+        return self.checksum, (self.size + 1023) // 1024
+
+    def close(self):
+        """Stop the sum process of an abandoned checksum"""
+        if self._process is not None:
+            self._process.kill()
+            self._process.communicate()
+            self._process = None
+
+
+class StreamError(IOError):
+    """Received data is not a complete gzip stream"""
+
+
+class GzipStream(object):
+    """Incremental decompression of gzip data, including files of several
+    members such as bgzip compressed VCF"""
+
+    def __init__(self):
+        self._inflate = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self._pending = False
+
+    def decompress(self, data):
+        chunks = []
+        while data:
+            self._pending = True
+            try:
+                chunks.append(self._inflate.decompress(data))
+            except zlib.error as e:
+                raise StreamError('Corrupted gzip stream: {}'.format(e))
+            if not self._inflate.eof:
+                break
+            data = self._inflate.unused_data
+            self._inflate = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            self._pending = False
+        return b''.join(chunks)
+
+    def flush(self):
+        """Check the stream ended with a complete member"""
+        if self._pending:
+            raise StreamError('Truncated gzip stream')
+
+
+class StreamWriter(object):
+    """Write decompressed data to a file, checking the checksum of the
+    compressed data and the sort order of the records on the way"""
+
+    def __init__(self, filename, check_order=False):
+        """
+        :param str filename: file to write
+        :param bool check_order: feed the lines to a SortChecker
+        """
+        self.filename = filename
+        self.offset = 0
+        self.checksum = BSDSum()
+        self.checker = SortChecker() if check_order else None
+        self._gzip = GzipStream()
+        self._rest = b''
+        self._fh = open(filename, 'wb')
+
+    def write(self, data):
+        """Take the next chunk of compressed data"""
+        self.offset += len(data)
+        self.checksum.update(data)
+        data = self._gzip.decompress(data)
+        self._fh.write(data)
+        if self.checker is not None and data:
+            lines = (self._rest + data).split(b'\n')
+            self._rest = lines.pop()
+            for line in lines:
+                self.checker.feed(line.decode('utf-8'))
+
+    def finish(self):
+        """Close the file once all data was received
+
+        :return tuple: checksum and blocks of the compressed data
+        """
+        self._gzip.flush()
+        if self.checker is not None and self._rest:
+            self.checker.feed(self._rest.decode('utf-8'))
+        self._fh.close()
+        return self.checksum.digest()
+
+    def abort(self):
+        """Close and remove the partial file"""
+        self._fh.close()
+        self.checksum.close()
+        os.remove(self.filename)
+
+
+def parse_checksums(text):
+    """Checksums by file name from the text of an Ensembl CHECKSUMS file"""
+    checksums = {}
+    for line in text.splitlines():
+        fields = line.split()
+        if len(fields) == 3:
+            checksums[fields[2]] = (int(fields[0]), int(fields[1]))
+    return checksums
+
+
+class ChecksumError(IOError):
+    """A downloaded file does not match its published checksum"""
+
+
+class FTPDownloader(object):
+    """Download files from one FTP server with a bounded pool of workers"""
+
+    def __init__(self, host, workers=4, retries=3, ftp_factory=FTP):
+        """
+        :param str host: FTP server
+        :param int workers: files transferred at the same time
+        :param int retries: attempts per file before giving up
+        :param callable ftp_factory: builds an unconnected FTP object from
+            the host name, to use a stand-in server
+        """
+        self.host = host
+        self.workers = workers
+        self.retries = retries
+        self.ftp_factory = ftp_factory
+        self._local = threading.local()
+        self._pool = None
+        self._connections = []
+        self._lock = threading.Lock()
+        self._checksums = {}
+
+    def _connection(self):
+        """FTP connection of the calling thread, logged in on first use"""
+        ftp = getattr(self._local, 'ftp', None)
+        if ftp is None:
+            ftp = self.ftp_factory(self.host)
+            ftp.login()
+            self._local.ftp = ftp
+            with self._lock:
+                self._connections.append(ftp)
+        return ftp
+
+    def _reset(self):
+        """Drop the connection of the calling thread after an error"""
+        ftp = getattr(self._local, 'ftp', None)
+        self._local.ftp = None
+        if ftp is not None:
+            with self._lock:
+                self._connections.remove(ftp)
+            try:
+                ftp.close()
+            except all_errors:
+                pass
+
+    def nlst(self, directory):
+        """List a remote directory over the connection of this thread"""
+        try:
+            return self._connection().nlst(directory)
+        except all_errors:
+            self._reset()
+            raise
+
+    def checksums(self, directory):
+        """Published checksums of a remote directory, read once
+
+        :return dict: file name to checksum and blocks; empty when the
+            directory has no CHECKSUMS file
+        """
+        with self._lock:
+            if directory in self._checksums:
+                return self._checksums[directory]
+        lines = []
+        try:
+            self._connection().retrlines(
+                'RETR {}/{}'.format(directory.rstrip('/'), CHECKSUMS),
+                lines.append)
+            checksums = parse_checksums('\n'.join(lines))
+        except error_perm:
+            log.warning('No {} in {}'.format(CHECKSUMS, directory))
+            checksums = {}
+        with self._lock:
+            self._checksums[directory] = checksums
+        return checksums
+
+    def _transfer(self, remote, filename):
+        """Download remote to filename.part, resuming a partial file"""
+        part = filename + '.part'
+        offset = os.path.getsize(part) if os.path.isfile(part) else 0
+        ftp = self._connection()
+        ftp.voidcmd('TYPE I')
+        try:
+            size = ftp.size(remote)
+        except error_perm:
+            size = None
+        if size is not None and offset > size:
+            os.remove(part)
+            offset = 0
+        elif offset and offset == size:
+            return part
+        with open(part, 'ab') as fh:
+            if offset:
+                log.info('Resuming {} at byte {}'.format(filename, offset))
+            ftp.retrbinary('RETR {}'.format(remote), fh.write,
+                           rest=offset or None)
+        return part
+
+    def _stream(self, remote, stream):
+        """Feed remote to a StreamWriter, resuming where it stopped"""
+        ftp = self._connection()
+        ftp.voidcmd('TYPE I')
+        if stream.offset:
+            log.info('Resuming {} at byte {}'.format(remote, stream.offset))
+        ftp.retrbinary('RETR {}'.format(remote), stream.write,
+                       rest=stream.offset or None)
+        return stream.finish()
+
+    def retrieve(self, remote, filename, decompress=False):
+        """Download one file, verify it and move it into place
+
+        :param str remote: path on the server
+        :param str filename: local destination
+        :param bool decompress: decompress remote, a gzip file, while it is
+            received; the sort order of BED and GFF records is recorded
+            on the way
+        :return str: filename
+        :raises ChecksumError: when every attempt gave a corrupted file
+        """
+        directory, basename = remote.rsplit('/', 1)
+        check_order = os.path.splitext(filename)[1] in TRACK_EXTENSIONS
+        stream = None
+        error = None
+        for attempt in range(self.retries):
+            try:
+                expected = self.checksums(directory).get(basename)
+                if decompress:
+                    # The decompressor state is kept in memory, so only an
+                    # attempt in this process can resume a stream
+                    if stream is None:
+                        stream = StreamWriter(filename + '.part', check_order)
+                    got = self._stream(remote, stream)
+                    part = stream.filename
+                else:
+                    part = self._transfer(remote, filename)
+                    got = bsd_sum(part) if expected is not None else None
+                if expected is not None and got != expected:
+                    os.remove(part)
+                    stream = None
+                    raise ChecksumError('Checksum mismatch for {}'.format(
+                        remote))
+                os.rename(part, filename)
+                if stream is not None and stream.checker is not None:
+                    # Out of order files are sorted once first used
+                    store_record(filename, *stream.checker.result(),
+                                 sort=False)
+                log.info('{} retrieval complete.'.format(filename))
+                return filename
+            except ChecksumError as e:
+                error = e
+            except StreamError as e:
+                # Start the stream over
+                error = e
+                stream.abort()
+                stream = None
+            except all_errors as e:
+                # Reconnect and resume from the partial file
+                error = e
+                self._reset()
+            log.warning('Attempt {} of {} for {} failed: {}'.format(
+                attempt + 1, self.retries, remote, error))
+        if stream is not None:
+            stream.abort()
+        raise error
+
+    def download(self, jobs):
+        """Download files concurrently
+
+        :param list jobs: remote path, local filename and optionally
+            whether to decompress while downloading, see retrieve()
+        :return list: local filenames, in the order of jobs
+        """
+        if self._pool is None:
+            # Kept between calls, so are the connections of its threads
+            self._pool = ThreadPoolExecutor(max_workers=self.workers)
+        futures = [self._pool.submit(self.retrieve, *job) for job in jobs]
+        return [x.result() for x in futures]
+
+    def close(self):
+        """Stop the workers and log out of every connection"""
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for ftp in connections:
+            try:
+                ftp.quit()
+            except all_errors:
+                ftp.close()
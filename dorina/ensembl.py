@@ -5,16 +5,23 @@ Created on 09:32 10/10/2017 2017
 
 """
 from __future__ import unicode_literals
+import asyncio
+import hashlib
+import json as json_module
 import os
+import threading
+import time
 from os import path
 import logging
-from ftplib import FTP, all_errors
+from ftplib import all_errors
 
 import requests
-from six.moves.urllib.request import urlretrieve, urlopen
+from six.moves.urllib.request import urlopen
 from six.moves.urllib.error import URLError
 
-from dorina.utils import check_file_extension, uncompress
+from dorina.cache import LRUCache
+from dorina.download import FTPDownloader
+from dorina.utils import check_file_extension
 from dorina.config import config
 
 log = logging.getLogger(__name__)
@@ -30,8 +37,9 @@ class EnsemblFTP(object):
     """
 
     def __init__(self, release=config.get('DEFAULT', 'version'),
-                 organism=config.get('DEFAULT', 'organism')):
+                 organism=config.get('DEFAULT', 'organism'), workers=4):
         self.base_url = 'ftp.ensemblorg.ebi.ac.uk'
+        self.downloader = FTPDownloader(self.base_url, workers=workers)
         self.url = []
         self.local_data = config.get('DEFAULT', 'data_path')
         self.release = release
@@ -65,15 +73,11 @@ class EnsemblFTP(object):
         if not url.startswith('/'):
             url = '/' + url
         available_dir = None
-        ftp = FTP(self.base_url)
         try:
-            ftp.login()
-            available_dir = ftp.nlst(url)
+            available_dir = self.downloader.nlst(url)
         except all_errors as e:
             log.error('FTP error.')
             raise e
-        finally:
-            ftp.close()
 
         if not available_dir:
             log.warning('No available files in {}'.format(self.base_url + url))
@@ -92,46 +96,46 @@ class EnsemblFTP(object):
         remote_path, filename = url.rsplit('/', 1)
         return path.join(self.local_data, self.assembly, filename)
 
-    def retrieve_file_from_url(self, url, force=False):
+    def retrieve_all(self, force=False):
         """
-        Retrieve a file from FTP server.
-        .. note:: urlretrieve has a better API for error handling than
-        ftp.retrbinary
+        Retrieve every url concurrently, resuming partial downloads and
+        verifying each file against the CHECKSUMS of its directory.
+        Compressed files are decompressed while they are received, so only
+        the uncompressed file is written.
 
         :param bool force: overwrite local files
-        :param str url: file url
-        :return bool: whether retrieved
+        :return: generator yielding the local filename of each url
         """
-        remote_path, basename = url.rsplit('/', 1)
-
-        filename = path.join(self.local_data, self.assembly, basename)
-        if not force and self.check_local(basename.replace('.gz', '')):
-            log.info('{} available, aborting retrieval.'.format(filename))
-            return False
-        else:
-            try:
-                urlretrieve('ftp://' + self.base_url + url, filename)
-                log.info('{} retrieval complete.'.format(filename))
-                return True
-            except URLError as e:
-                log.error('Error retrieving {}: \n{}'.format(
-                    'ftp://' + self.base_url + url, e))
-                raise e
-
-    def retrieve_all(self):
-        for url in reversed(self.url):
-            try:
-                retrieved = self.retrieve_file_from_url(url)
-            except (IOError, ) as e:
-                self.url = []
-                raise e
-
+        urls = list(reversed(self.url))
+        local = []
+        jobs = []
+        for url in urls:
             filename = self.filename_from_url(url)
-            if retrieved:
-                uncompress(filename)
+            decompress = filename.endswith('.gz')
+            if decompress:
+                filename = filename[:-len('.gz')]
+            local.append(filename)
+            if not force and self.check_local(path.basename(filename)):
+                log.info('{} available, aborting retrieval.'.format(filename))
+            else:
+                jobs.append((url, filename, decompress))
+        directory = path.join(self.local_data, self.assembly)
+        if jobs and not path.isdir(directory):
+            os.makedirs(directory)
+        try:
+            self.downloader.download(jobs)
+        except (IOError, ) as e:
+            self.url = []
+            raise e
+
+        for url, filename in zip(urls, local):
             self.url.remove(url)
             yield filename
 
+    def close(self):
+        """Close the FTP connections of the downloader"""
+        self.downloader.close()
+
     def check_extension(self, extension):
         """
         Check for error in the built urls
@@ -285,21 +289,138 @@ class EnsemblFTP(object):
         return list(self.retrieve_all())
 
 
+class TokenBucket(object):
+    """Rate limiter handing out one token per request.
+
+    Tokens refill at rate per second up to capacity, so short bursts are
+    allowed while the average request rate stays at rate.
+    """
+
+    def __init__(self, rate, capacity=None, clock=time.time):
+        """
+        :param float rate: tokens added per second
+        :param int capacity: most tokens held, rate by default
+        :param callable clock: returns the current time in seconds
+        """
+        self.rate = float(rate)
+        self.capacity = capacity or rate
+        self.tokens = float(self.capacity)
+        self.clock = clock
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Take a token, possibly one that is not there yet
+
+        :return float: seconds to wait before using the token
+        """
+        with self._lock:
+            now = self.clock()
+            self.tokens = min(self.capacity, self.tokens +
+                              (now - self._updated) * self.rate)
+            self._updated = now
+            self.tokens -= 1
+            return max(0.0, -self.tokens / self.rate)
+
+    def acquire(self):
+        """Block until a token is available"""
+        wait = self.reserve()
+        if wait:
+            time.sleep(wait)
+
+
+class ResponseCache(object):
+    """Decoded REST responses kept for ttl seconds, in a bounded memory
+    cache and optionally as JSON files in a directory"""
+
+    def __init__(self, ttl=24 * 3600, directory=None, clock=time.time,
+                 max_bytes=64 * 2 ** 20):
+        """
+        :param float ttl: seconds a response stays valid
+        :param str directory: where to keep the responses between runs,
+            None to keep them in memory only
+        :param callable clock: returns the current time in seconds
+        :param int max_bytes: size of the JSON text of the responses kept
+            in memory, the least recently used go first
+        """
+        self.ttl = ttl
+        self.directory = directory
+        self.clock = clock
+        self._memory = LRUCache(max_bytes)
+        if directory is not None and not path.isdir(directory):
+            os.makedirs(directory)
+
+    @staticmethod
+    def key(method, url, params=None, data=None):
+        return hashlib.sha1(json_module.dumps(
+            [method, url, params, data], sort_keys=True).encode(
+                'utf-8')).hexdigest()
+
+    def get(self, key):
+        """Cached response, or None when missing or expired"""
+        entry = self._memory.peek(key)
+        if entry is None and self.directory is not None:
+            try:
+                with open(path.join(self.directory, key + '.json'),
+                          encoding='utf-8') as fh:
+                    text = fh.read()
+                entry = json_module.loads(text)
+                self._memory.put(key, entry, len(text))
+            except (IOError, ValueError):
+                entry = None
+        if entry is None or self.clock() - entry[0] > self.ttl:
+            return None
+        return entry[1]
+
+    def put(self, key, value):
+        entry = [self.clock(), value]
+        text = json_module.dumps(entry)
+        self._memory.put(key, entry, len(text))
+        if self.directory is not None:
+            filename = path.join(self.directory, key + '.json')
+            tmp = '{}.{}.tmp'.format(filename, threading.current_thread().ident)
+            with open(tmp, 'w', encoding='utf-8') as fh:
+                fh.write(text)
+            os.rename(tmp, filename)
+
+    def clear(self):
+        self._memory.clear()
+        if self.directory is not None:
+            for name in os.listdir(self.directory):
+                if name.endswith('.json'):
+                    os.remove(path.join(self.directory, name))
+
+
 class EnsemblRest(object):
     """
     Base class for retrieving data from Ensembl Rest API.
 
+    Requests share the pooled connections of one session and are throttled
+    to reqs_per_sec. JSON responses are cached for cache_ttl seconds, in
+    cache_dir when given.
+
     Limited support to previous Ensembl release using:
     >>> rest = EnsemblRest(base_url='grch37.rest.ensembl.org')
     >>> rest.ping()
     """
 
+    # Most ids or symbols Ensembl accepts in one POST request
+    batch_size = 1000
+
     def __init__(self, **kwargs):
         self.base_url = kwargs.get('base_url', 'http://rest.ensembl.org/')
         self.headers = kwargs.get('headers',
                                   {'content-type': 'application/json'})
-        self.reqs_per_sec = 15
+        self.reqs_per_sec = kwargs.get('reqs_per_sec', 15)
+        self.retries = kwargs.get('retries', 3)
+        self.bucket = TokenBucket(self.reqs_per_sec)
+        self.cache = kwargs.get('cache', ResponseCache(
+            kwargs.get('cache_ttl', 24 * 3600), kwargs.get('cache_dir')))
         self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=4, pool_maxsize=kwargs.get('pool_size', 16))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
 
     def ping(self):
         ext = "info/ping?"
@@ -308,7 +429,7 @@ class EnsemblRest(object):
 
     def get_info_assembly(self, organism):
         ext = 'info/assembly/{}/X?'.format(organism)
-        return self.get(ext)
+        return self.get(ext, cached=True)
 
     def get_genetree_members_by_id(self, ensembl_id, params=None):
         """
@@ -333,7 +454,7 @@ class EnsemblRest(object):
             log.info('Isoform identifier detected, falling back to stable ID '
                      '{}'.format(ensembl_id))
         ext = 'genetree/member/id/{}?'.format(ensembl_id)
-        return self.get(ext, params=params)
+        return self.get(ext, params=params, cached=True)
 
     def get_genomic_alignment(self):
         pass
@@ -349,24 +470,198 @@ class EnsemblRest(object):
         :return dict:
         """
         ext = "/{}/{}:{}-{}?".format(organism, chromosome, start, end)
-        return self.get(ext)
+        return self.get(ext, cached=True)
 
-    def get(self, ext, json=True, headers=None, params=None):
+    def lookup_ids(self, ids, **params):
         """
+        Look up many Ensembl stable ids with the POST lookup/id endpoint,
+        batch_size ids per request.
 
-        :param ext:
-        :param json:
-        :param headers:
-        :param params:
-        :return:
+        :param list ids: Ensembl stable ids
+        :param params: query parameters, such as expand=1
+        :return dict: lookup result of each id
         """
-        if headers is None:
-            headers = self.headers
-        r = requests.get(self.base_url + ext, headers=headers, params=params)
+        return self._batches('lookup/id', ids, params)
+
+    def lookup_symbols(self, organism, symbols, **params):
+        """
+        Look up many gene symbols with the POST lookup/symbol endpoint.
+
+        :param str organism: Organism scientific name, such as homo_sapiens
+        :param list symbols: gene symbols
+        :return dict: lookup result of each symbol
+        """
+        return self._batches('lookup/symbol/{}'.format(organism), symbols,
+                             params, key='symbols')
+
+    def _batches(self, ext, values, params, key='ids'):
+        result = {}
+        for data in self._chunks(values, key):
+            response = self.post(ext, data, params=params, cached=True)
+            result.update(response or {})
+        return result
+
+    def _chunks(self, values, key):
+        values = list(values)
+        return [{key: values[i:i + self.batch_size]}
+                for i in range(0, len(values), self.batch_size)]
+
+    def _send(self, method, url, headers, params, data, reserved=False):
+        """Send one request through the session and the rate limiter,
+        waiting out Retry-After answers
+
+        :param bool reserved: a token was taken for the first attempt
+        """
+        for attempt in range(self.retries + 1):
+            if attempt or not reserved:
+                self.bucket.acquire()
+            r = self.session.request(method, url, headers=headers,
+                                     params=params, data=data)
+            if r.status_code != 429 or attempt == self.retries:
+                break
+            wait = float(r.headers.get('Retry-After', 1))
+            log.info('Rate limited by {}, waiting {}s'.format(url, wait))
+            time.sleep(wait)
         if not r.ok:
             r.raise_for_status()
+        return r
+
+    def request(self, method, ext, json=True, headers=None, params=None,
+                data=None, cached=False):
+        """
+        Send a request.
+
+        :param str method: 'GET' or 'POST'
+        :param str ext: endpoint, relative to base_url
+        :param bool json: decode the response as JSON
+        :param dict headers: headers, self.headers by default
+        :param dict params: query parameters
+        :param dict data: JSON body of a POST request
+        :param bool cached: answer from, and keep the response in, the
+            response cache; only for JSON requests whose answer does not
+            change, such as lookups
+        :return: decoded JSON, or the raw content
+        """
+        return self._request(method, ext, json, headers, params, data,
+                             cached)
 
-        if json:
-            return r.json()
-        else:
+    def _request(self, method, ext, json, headers, params, data,
+                 cached=False, reserved=False):
+        if headers is None:
+            headers = self.headers
+        url = self.base_url + ext
+        key = None
+        if json and cached:
+            key = ResponseCache.key(method, url, params, data)
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached
+        body = None if data is None else json_module.dumps(data)
+        r = self._send(method, url, headers, params, body, reserved)
+        if not json:
             return r.content
+        result = r.json()
+        if key is not None:
+            self.cache.put(key, result)
+        return result
+
+    def get(self, ext, json=True, headers=None, params=None, cached=False):
+        """
+        GET an endpoint.
+
+        :param str ext: endpoint, relative to base_url
+        :param bool json: decode the response as JSON
+        :param dict headers: headers, self.headers by default
+        :param dict params: query parameters
+        :param bool cached: use the response cache, see request()
+        :return: decoded JSON, or the raw content
+        """
+        return self.request('GET', ext, json, headers, params, None, cached)
+
+    def post(self, ext, data, json=True, headers=None, params=None,
+             cached=False):
+        """
+        POST a JSON body to an endpoint.
+
+        :param str ext: endpoint, relative to base_url
+        :param dict data: request body
+        :param bool cached: use the response cache, see request()
+        :return: decoded JSON, or the raw content
+        """
+        if headers is None:
+            headers = dict(self.headers, accept='application/json')
+        return self.request('POST', ext, json, headers, params, data,
+                            cached)
+
+
+class AsyncEnsemblRest(EnsemblRest):
+    """
+    EnsemblRest with coroutines, for many requests in flight at once.
+
+    Requests run on the pooled session in a thread pool, at most
+    concurrency at a time and within the same rate limit.
+
+    >>> rest = AsyncEnsemblRest()
+    >>> loop = asyncio.get_event_loop()
+    >>> loop.run_until_complete(rest.lookup_ids(['ENSG00000157764']))
+    """
+
+    def __init__(self, concurrency=8, **kwargs):
+        kwargs.setdefault('pool_size', concurrency)
+        super(AsyncEnsemblRest, self).__init__(**kwargs)
+        self.concurrency = concurrency
+        self._semaphores = {}
+
+    def _semaphore(self):
+        # A semaphore belongs to the event loop it is first used in
+        loop = asyncio.get_event_loop()
+        if loop not in self._semaphores:
+            self._semaphores[loop] = asyncio.Semaphore(self.concurrency)
+        return self._semaphores[loop]
+
+    async def request(self, method, ext, json=True, headers=None,
+                      params=None, data=None, cached=False):
+        """Coroutine version of EnsemblRest.request()"""
+        if json and cached:
+            cached = self.cache.get(ResponseCache.key(
+                method, self.base_url + ext, params, data))
+            if cached is not None:
+                return cached
+        async with self._semaphore():
+            wait = self.bucket.reserve()
+            if wait:
+                await asyncio.sleep(wait)
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(
+                None, self._request, method, ext, json, headers, params, data,
+                cached, True)
+
+    async def get(self, ext, json=True, headers=None, params=None,
+                  cached=False):
+        return await self.request('GET', ext, json, headers, params, None,
+                                  cached)
+
+    async def post(self, ext, data, json=True, headers=None, params=None,
+                   cached=False):
+        if headers is None:
+            headers = dict(self.headers, accept='application/json')
+        return await self.request('POST', ext, json, headers, params, data,
+                                  cached)
+
+    async def _batches(self, ext, values, params, key='ids'):
+        responses = await asyncio.gather(*[
+            self.post(ext, data, params=params, cached=True)
+            for data in self._chunks(values, key)])
+        result = {}
+        for response in responses:
+            result.update(response or {})
+        return result
+
+    async def lookup_ids(self, ids, **params):
+        """Coroutine version of EnsemblRest.lookup_ids()"""
+        return await self._batches('lookup/id', ids, params)
+
+    async def lookup_symbols(self, organism, symbols, **params):
+        """Coroutine version of EnsemblRest.lookup_symbols()"""
+        return await self._batches('lookup/symbol/{}'.format(organism),
+                                   symbols, params, key='symbols')
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+"""
+Selections over DESeq result tables for the Bokeh explorer in app/.
+
+A table is indexed once when loaded: the rows sorted by adjusted p-value,
+the gene names joined into one text searched without building a string
+per row, and every plotted column cut into fixed bins. An interaction then
+costs a binary search, a text search and, for selections too large to
+draw as points, a bincount over the selected rows; the table itself is
+never copied.
+"""
+from __future__ import unicode_literals
+import os
+import re
+import threading
+
+import numpy as np
+
+NAME = 'Gene name'
+COLUMNS = ('baseMean', 'log2FoldChange', 'pvalue', 'padj')
+# Points sent to the browser before switching to binned counts
+MAX_POINTS = 5000
+BINS = 200
+
+_tables = {}
+_lock = threading.Lock()
+
+
+def read_deseq(filename):
+    """DESeq results of a CSV file, as written by write.csv in R"""
+    import pandas as pd
+
+    frame = pd.read_csv(filename)
+    return frame.rename(columns={'Unnamed: 0': NAME})
+
+
+def load(filename):
+    """DeseqTable of a CSV file, shared by all sessions until it changes"""
+    key = (os.path.abspath(filename), os.path.getmtime(filename))
+    with _lock:
+        if key not in _tables:
+            _tables.clear()
+            _tables[key] = DeseqTable(read_deseq(filename))
+        return _tables[key]
+
+
+class DeseqTable(object):
+    """Indexed, read-only DESeq results"""
+
+    def __init__(self, frame, bins=BINS):
+        """
+        :param pandas.DataFrame frame: with a NAME column and the COLUMNS
+        :param int bins: bins per axis of the density view
+        """
+        self.names = frame[NAME].fillna('').astype(str).to_numpy()
+        self.columns = dict((c, frame[c].to_numpy(dtype=np.float64))
+                            for c in COLUMNS)
+        self.bins = bins
+
+        # NaN sorts last, so it never passes a threshold
+        padj = self.columns['padj']
+        self._by_padj = np.argsort(padj, kind='stable')
+        self._padj = padj[self._by_padj]
+        self._padj_rank = np.empty(len(padj), dtype=np.int64)
+        self._padj_rank[self._by_padj] = np.arange(len(padj))
+
+        # One line per row, located by the offsets of the line starts
+        self._text = '\n'.join(self.names) + '\n'
+        lengths = np.array([len(x) + 1 for x in self.names], dtype=np.int64)
+        self._starts = np.cumsum(lengths) - lengths
+
+        self._edges, self._codes = {}, {}
+        for column, values in self.columns.items():
+            self._edges[column], self._codes[column] = self._bin(values)
+
+    def __len__(self):
+        return len(self.names)
+
+    def _bin(self, values):
+        """Bin edges of a column and the bin of every value; NaN and
+        infinite values get the code bins"""
+        finite = np.isfinite(values)
+        if finite.any():
+            lo, hi = values[finite].min(), values[finite].max()
+        else:
+            lo, hi = 0.0, 1.0
+        if hi <= lo:
+            hi = lo + 1.0
+        edges = np.linspace(lo, hi, self.bins + 1)
+        codes = np.full(len(values), self.bins, dtype=np.int32)
+        codes[finite] = np.clip(
+            np.searchsorted(edges, values[finite], side='right') - 1,
+            0, self.bins - 1)
+        return edges, codes
+
+    def padj_range(self):
+        """Smallest and largest adjusted p-value"""
+        finite = self._padj[np.isfinite(self._padj)]
+        if not len(finite):
+            return 0.0, 1.0
+        return float(finite[0]), float(finite[-1])
+
+    def name_rows(self, text):
+        """Rows whose gene name contains text, in row order"""
+        if '\n' in text:
+            return np.array([], dtype=np.int64)
+        offsets = np.fromiter(
+            (m.start() for m in re.finditer(re.escape(text), self._text)),
+            dtype=np.int64)
+        rows = np.searchsorted(self._starts, offsets, side='right') - 1
+        return np.unique(rows)
+
+    def select(self, padj, text=''):
+        """Rows with an adjusted p-value below padj and, when given, a gene
+        name containing text
+
+        :return: array of row positions, a view into the padj index when
+            no name is given
+        """
+        count = np.searchsorted(self._padj, padj, side='left')
+        text = text.strip()
+        if not text:
+            return self._by_padj[:count]
+        rows = self.name_rows(text)
+        return rows[self._padj_rank[rows] < count]
+
+    def points(self, rows, x, y):
+        """Columns of the selected rows for a scatter plot"""
+        return {'x': self.columns[x][rows], 'y': self.columns[y][rows],
+                'name': self.names[rows]}
+
+    def density(self, rows, x, y):
+        """Counts of the selected rows in the non-empty bins of two columns
+
+        :return dict: bin centers, sizes and counts, for a rect glyph
+        """
+        bx, by = self._codes[x][rows], self._codes[y][rows]
+        keep = (bx < self.bins) & (by < self.bins)
+        counts = np.bincount(bx[keep] * self.bins + by[keep],
+                             minlength=self.bins * self.bins)
+        cells = np.flatnonzero(counts)
+        ix, iy = cells // self.bins, cells % self.bins
+        x_edges, y_edges = self._edges[x], self._edges[y]
+        return {'x': (x_edges[ix] + x_edges[ix + 1]) / 2,
+                'y': (y_edges[iy] + y_edges[iy + 1]) / 2,
+                'width': np.full(len(cells), x_edges[1] - x_edges[0]),
+                'height': np.full(len(cells), y_edges[1] - y_edges[0]),
+                'count': counts[cells]}
+
+    def view(self, rows, x, y, max_points=MAX_POINTS):
+        """Points of the selected rows when few enough to draw, else their
+        binned counts
+
+        :return tuple: the points, or None, and the bins, or None
+        """
+        if len(rows) <= max_points:
+            return self.points(rows, x, y), None
+        return None, self.density(rows, x, y)
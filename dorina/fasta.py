@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+"""
+Indexed, memory-mapped access to FASTA files.
+
+The index is the ``.fai`` file ``samtools faidx`` writes: for every sequence
+its name, length, byte offset and the bases and bytes per line. With it
+the bytes of any region are located by arithmetic and sliced out of the
+memory-mapped file, so sequences are read one at a time, in any order,
+without loading the genome or writing them to a temporary FASTA file.
+"""
+from __future__ import unicode_literals
+import logging
+import mmap
+import os
+from collections import Counter, OrderedDict
+from io import open
+
+log = logging.getLogger(__name__)
+
+_complement = bytes.maketrans(b'ACGTUMRWSYKVHDBNacgtumrwsykvhdbn',
+                              b'TGCAAKYWSRMBDHVNtgcaakywsrmbdhvn')
+
+
+def fai_path(filename):
+    """Location of the index of a FASTA file"""
+    return filename + '.fai'
+
+
+def reverse_complement(sequence):
+    """Reverse complement of a DNA sequence, IUPAC codes and case kept"""
+    return sequence.encode('ascii').translate(_complement)[::-1] \
+        .decode('ascii')
+
+
+def build_fai(filename):
+    """Scan a FASTA file and return its index, as samtools faidx does
+
+    :param str filename: uncompressed FASTA file
+    :return OrderedDict: sequence name to length, offset, line bases and
+        line width
+    :raises ValueError: for lines of differing length within a sequence
+    """
+    if filename.endswith('.gz'):
+        raise ValueError("Compressed FASTA files can not be indexed: %s" %
+                         filename)
+    index = OrderedDict()
+    name, entry, short = None, None, False
+    offset = 0
+    with open(filename, 'rb') as fh:
+        for line in fh:
+            width = len(line)
+            if line.startswith(b'>'):
+                name = line[1:].split()[0].decode('utf-8')
+                entry = index[name] = [0, offset + width, 0, 0]
+                short = False
+            elif entry is not None and line.strip():
+                bases = len(line.rstrip(b'\r\n'))
+                if entry[2] == 0:
+                    entry[2], entry[3] = bases, width
+                elif short or bases > entry[2] or (
+                        bases == entry[2] and width != entry[3]):
+                    raise ValueError("Different line length in sequence %s "
+                                     "of %s" % (name, filename))
+                short = bases < entry[2]
+                entry[0] += bases
+            offset += width
+    return index
+
+
+def write_fai(filename, index):
+    """Write an index next to a FASTA file"""
+    target = fai_path(filename)
+    with open(target + '.tmp', 'w', encoding='utf-8') as fh:
+        for name, entry in index.items():
+            fh.write('\t'.join([name] + [str(x) for x in entry]) + '\n')
+    os.rename(target + '.tmp', target)
+
+
+def read_fai(filename):
+    """Index of a FASTA file, read from its .fai file when up to date and
+    built otherwise; a built index is written when the directory allows it
+
+    :return OrderedDict: see build_fai()
+    """
+    target = fai_path(filename)
+    if os.path.isfile(target) and \
+            os.path.getmtime(target) >= os.path.getmtime(filename):
+        index = OrderedDict()
+        with open(target, encoding='utf-8') as fh:
+            for line in fh:
+                fields = line.rstrip('\n').split('\t')
+                index[fields[0]] = [int(x) for x in fields[1:5]]
+        return index
+
+    log.info('Indexing {}'.format(filename))
+    index = build_fai(filename)
+    try:
+        write_fai(filename, index)
+    except (IOError, OSError) as e:
+        log.debug('Unable to write FASTA index {}: {}'.format(target, e))
+    return index
+
+
+class FastaFile(object):
+    """Sequences of an indexed FASTA file, sliced out of a memory map"""
+
+    def __init__(self, filename):
+        """
+        :param str filename: uncompressed FASTA file
+        """
+        self.filename = filename
+        self.index = read_fai(filename)
+        self._fh = open(filename, 'rb')
+        self._map = mmap.mmap(self._fh.fileno(), 0, access=mmap.ACCESS_READ)
+        self._missing = set()
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def _offset(self, entry, position):
+        length, offset, bases, width = entry
+        return offset + position // bases * width + position % bases
+
+    def fetch(self, chrom, start, end, strand='+'):
+        """Sequence of a region, as ``bedtools getfasta -s`` extracts it
+
+        :param str chrom: sequence name
+        :param int start: zero-based start
+        :param int end: end, clipped to the sequence length
+        :param str strand: '-' for the reverse complement
+        :return str: the sequence; empty for unknown sequences
+        """
+        entry = self.index.get(chrom)
+        if entry is None:
+            if chrom not in self._missing:
+                self._missing.add(chrom)
+                log.warning('No sequence {} in {}'.format(chrom,
+                                                          self.filename))
+            return ''
+        start, end = max(start, 0), min(end, entry[0])
+        if end <= start:
+            return ''
+        data = self._map[self._offset(entry, start):self._offset(entry, end)]
+        sequence = data.replace(b'\n', b'').replace(b'\r', b'') \
+            .decode('ascii')
+        if strand == '-':
+            return reverse_complement(sequence)
+        return sequence
+
+    def sequences(self, chroms, starts, ends, strands=None):
+        """Yield the sequences of regions one at a time, in the given order
+
+        :param chroms: sequence names
+        :param starts: zero-based starts
+        :param ends: ends
+        :param strands: optional strands; the reverse complement is yielded
+            for '-'
+        """
+        if strands is None:
+            strands = ('+' for _ in chroms)
+        for chrom, start, end, strand in zip(chroms, starts, ends, strands):
+            yield self.fetch(chrom, int(start), int(end), strand)
+
+    def close(self):
+        self._map.close()
+        self._fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def gc_content(sequence):
+    """Fraction of G and C among the A, C, G and T of a sequence, NaN
+    when it has none"""
+    sequence = sequence.upper()
+    gc = sequence.count('G') + sequence.count('C')
+    total = gc + sequence.count('A') + sequence.count('T')
+    return gc / float(total) if total else float('nan')
+
+
+def kmer_counts(sequences, k):
+    """Occurrences of every k-mer without N over a stream of sequences
+
+    :param sequences: iterable of sequences, consumed one at a time
+    :param int k: k-mer length
+    :return Counter: upper case k-mer to count
+    """
+    counts = Counter()
+    for sequence in sequences:
+        sequence = sequence.upper()
+        counts.update(sequence[i:i + k]
+                      for i in range(len(sequence) - k + 1))
+    for kmer in [x for x in counts if 'N' in x]:
+        del counts[kmer]
+    return counts
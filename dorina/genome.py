@@ -1,16 +1,19 @@
 #!/usr/bin/env python
 # -*- coding: utf-8
 from __future__ import unicode_literals
+import bisect
 import os
-import re
-from io import open
 
+from dorina.index import GeneIndex, write_track
+from dorina.sorting import sorted_path
 from dorina.utils import DorinaUtils
 
 
 class Genome(object):
     _datadir = None
     _genomes = None
+    _species = None
+    _catalogs = {}
 
     @classmethod
     def init(klass, datadir):
@@ -31,9 +34,13 @@ class Genome(object):
             return assembly_dict
 
         klass._datadir = datadir
-        klass._genomes = DorinaUtils.walk_assembly_tree(
+        klass._genomes = DorinaUtils.load_assembly_tree(
             os.path.join(datadir, 'genomes'),
             parse_func)
+        klass._species = {}
+        for species, species_dir in klass._genomes.items():
+            for assembly in species_dir.get('assemblies', {}):
+                klass._species[assembly] = species
 
     @classmethod
     def all(klass):
@@ -43,33 +50,93 @@ class Genome(object):
     def path_by_name(klass, name):
         """Take a genome name and return the path to the genome directory"""
         filename = None
-        for species, species_dir in list(klass._genomes.items()):
-            if name in species_dir['assemblies']:
-                filename = os.path.join(klass._datadir, 'genomes', species, name)
+        if name in klass._species:
+            filename = os.path.join(klass._datadir, 'genomes',
+                                    klass._species[name], name)
 
         if not filename or not os.path.exists(filename):
             raise ValueError("Could not find genome: %s" % name)
 
         return filename
 
-    @staticmethod
-    def get_genes(name):
-        """Get a list of genes from genome <name>"""
-        genes = []
+    @classmethod
+    def _gff_files(klass):
+        """GFF tracks of every genome"""
+        for species, species_dir in sorted(klass._genomes.items()):
+            for assembly, tracks in sorted(species_dir['assemblies'].items()):
+                genome_dir = os.path.join(klass._datadir, 'genomes', species,
+                                          assembly)
+                for track in sorted(tracks):
+                    gff = os.path.join(genome_dir, '%s.gff' % track)
+                    if os.path.isfile(gff):
+                        yield gff
 
-        gene_name = re.compile(r'.*ID=(.*?)($|;\w+)')
+    @classmethod
+    def build_gene_indexes(klass):
+        """Build the gene index of every GFF track of every genome, for its
+        sorted copy when it is not sorted, as queries look it up
+
+        :return list: paths to the indexed GFF files
+        """
+        indexed = []
+        for gff in klass._gff_files():
+            filename = sorted_path(gff)
+            GeneIndex.build(filename)
+            indexed.append(filename)
+        return indexed
+
+    @classmethod
+    def build_tracks(klass):
+        """Write the memory-mapped columnar store of every GFF track of
+        every genome, from its sorted copy when it is not sorted
 
-        genome_dir = Genome.path_by_name(name)
-        if genome_dir is None:
-            return genes
+        :return list: paths to the store directories
+        """
+        return [write_track(sorted_path(gff)) for gff in klass._gff_files()]
 
-        genome = os.path.join(genome_dir, 'all.gff')
+    @classmethod
+    def gene_catalog(klass, name):
+        """Sorted gene ids of genome <name>.
+
+        Read from the gene index of all.gff, which is built and stored on
+        first use unless its directory is not writable, and kept in memory
+        until all.gff changes.
+        """
+        genome = os.path.join(klass.path_by_name(name), 'all.gff')
         if not os.path.exists(genome):
-            return genes
-        with open(genome, encoding="utf-8") as of:
-            for line in of:
-                match = gene_name.match(line)
-                if match is not None:
-                    genes.append(match.group(1))
+            return []
 
+        stamp = os.stat(genome).st_mtime
+        cached = klass._catalogs.get(genome)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+
+        indexed = sorted_path(genome)
+        gene_index = GeneIndex.open(indexed) or GeneIndex.build(indexed)
+        catalog = sorted(x for x in gene_index.genes if x)
+        klass._catalogs[genome] = (stamp, catalog)
+        return catalog
+
+    @staticmethod
+    def get_genes(name):
+        """Get a list of genes from genome <name>"""
+        return list(Genome.gene_catalog(name))
+
+    @staticmethod
+    def genes_with_prefix(name, prefix, limit=None):
+        """Genes of genome <name> starting with prefix, for autocompletion
+
+        :param str name: genome name
+        :param str prefix: start of the gene ids
+        :param int limit: maximum number of genes returned
+        :return list: sorted gene ids
+        """
+        catalog = Genome.gene_catalog(name)
+        lo = bisect.bisect_left(catalog, prefix)
+        hi = len(catalog) if limit is None else lo + limit
+        genes = []
+        for gene in catalog[lo:hi]:
+            if not gene.startswith(prefix):
+                break
+            genes.append(gene)
         return genes
@@ -0,0 +1,566 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+"""
+Persistent columnar index for interval files.
+
+An index is a directory holding one ``.npy`` file per column plus a
+``meta.json`` describing the interned chromosome and name tables and the
+row ranges of each named block. Rows of a block are sorted by chromosome
+and start, so a block can be sliced out of the memory-mapped columns
+without reading the source file.
+
+Genome region tracks are stored the same way, one directory per GFF file
+with rows sorted by chromosome and start, the row range of each
+chromosome, and text columns interned into tables of distinct strings.
+
+The genes of an Ensembl GTF file are kept as a compact gene table of
+coordinates, gene ids and biotypes, written once per GTF file and so once
+per release.
+"""
+from __future__ import unicode_literals
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+from io import open
+
+import numpy as np
+
+from dorina.intervals import Intervals, gff_name, overlap_counts
+
+log = logging.getLogger(__name__)
+
+COLUMNS = ('chrom', 'start', 'end', 'name', 'score', 'strand')
+TRACK_COLUMNS = ('chrom', 'source', 'feature', 'start', 'end', 'score',
+                 'strand', 'frame', 'attributes', 'name')
+# GFF fields stored as ids into a table of their distinct values
+TRACK_STRINGS = ('chrom', 'source', 'feature', 'score', 'attributes', 'name')
+GENE_COLUMNS = ('chrom', 'start', 'end', 'gene_id', 'biotype')
+_gtf_gene_id = r'gene_id "([^"]*)"'
+# Ensembl GTF files name it gene_biotype, GENCODE ones gene_type
+_gtf_biotype = r'gene_(?:bio)?type "([^"]*)"'
+
+
+def index_path(filename):
+    """Location of the index built for filename"""
+    return os.path.splitext(filename)[0] + '.idx'
+
+
+def track_path(filename):
+    """Location of the columnar store built for a GFF track"""
+    return os.path.splitext(filename)[0] + '.track'
+
+
+def gene_index_path(filename):
+    """Location of the gene index built for a GFF file"""
+    return os.path.splitext(filename)[0] + '.genes.json'
+
+
+def gene_table_path(filename):
+    """Location of the gene table built for a, possibly gzipped, GTF file.
+
+    Falls back to the temporary directory when the directory of filename
+    is not writable.
+    """
+    base = filename[:-3] if filename.endswith('.gz') else filename
+    target = os.path.splitext(base)[0] + '.gene_table'
+    directory = os.path.dirname(os.path.abspath(target))
+    if os.path.isdir(target) or os.access(directory, os.W_OK):
+        return target
+    digest = hashlib.sha1(os.path.abspath(filename).encode('utf-8'))
+    return os.path.join(tempfile.gettempdir(), 'dorina-genes',
+                        digest.hexdigest())
+
+
+def normalize_chrom(chrom):
+    """UCSC style chromosome name of an Ensembl one, e.g. chr1 for 1"""
+    return chrom if chrom.startswith('chr') else 'chr' + chrom
+
+
+def _source_stat(filename):
+    stat = os.stat(filename)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def write_index(filename, intervals, blocks):
+    """Write the index of a BED file.
+
+    :param str filename: source BED file, used for the location and to
+        detect when the index goes stale
+    :param Intervals intervals: parsed BED6 (or narrower) records
+    :param dict blocks: block name to the row positions it contains
+    :return str: path to the index directory
+    """
+    fields = min(intervals.field_count(), len(COLUMNS))
+    chroms, chrom_ids = np.unique(intervals.chroms.astype(str),
+                                  return_inverse=True)
+    names, name_ids = np.unique(
+        np.array(intervals.names(), dtype=str), return_inverse=True)
+    scores = [r[4] if len(r) > 4 else '' for r in intervals.rows]
+    strands = [r[5] if len(r) > 5 else '.' for r in intervals.rows]
+
+    order, ranges, offset = [], {}, 0
+    for block, rows in sorted(blocks.items()):
+        rows = np.asarray(rows, dtype=np.int64)
+        rows = rows[np.lexsort((intervals.starts[rows], chrom_ids[rows]))]
+        order.append(rows)
+        ranges[block] = [offset, offset + len(rows)]
+        offset += len(rows)
+    order = np.concatenate(order) if order else np.array([], dtype=np.int64)
+
+    columns = {
+        'chrom': chrom_ids[order].astype(np.int32),
+        'start': intervals.starts[order].astype(np.int32),
+        'end': intervals.ends[order].astype(np.int32),
+        'name': name_ids[order].astype(np.int32),
+        'score': np.array(scores, dtype=np.bytes_)[order],
+        'strand': np.array(strands, dtype='S1')[order]}
+    meta = {'fields': fields,
+            'chroms': chroms.tolist(),
+            'names': names.tolist(),
+            'blocks': ranges,
+            'source': _source_stat(filename)}
+
+    target = index_path(filename)
+    tmp = tempfile.mkdtemp(dir=os.path.dirname(target) or '.')
+    for column, values in columns.items():
+        np.save(os.path.join(tmp, column + '.npy'), values)
+    with open(os.path.join(tmp, 'meta.json'), 'w', encoding="utf-8") as fh:
+        fh.write(json.dumps(meta))
+    if os.path.isdir(target):
+        shutil.rmtree(target)
+    os.rename(tmp, target)
+    return target
+
+
+class IntervalIndex(object):
+    """Read-only, memory-mapped view of an index written by write_index"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, 'meta.json'),
+                  encoding="utf-8") as fh:
+            self.meta = json.load(fh)
+        self.columns = dict(
+            (c, np.load(os.path.join(directory, c + '.npy'), mmap_mode='r'))
+            for c in COLUMNS)
+
+    @classmethod
+    def open(cls, filename):
+        """Open the index of filename, or return None if missing or stale"""
+        directory = index_path(filename)
+        if not os.path.isfile(os.path.join(directory, 'meta.json')):
+            return None
+        index = cls(directory)
+        if index.meta['source'] != _source_stat(filename):
+            return None
+        return index
+
+    def __contains__(self, block):
+        return block in self.meta['blocks']
+
+    def intervals(self, block):
+        """Slice the rows of a block out of the index
+
+        :param str block: block name
+        :return Intervals: records of the block in BED format
+        """
+        lo, hi = self.meta['blocks'][block]
+        if lo == hi:
+            return Intervals([], 'bed')
+        c = self.columns
+        chroms = np.array(self.meta['chroms'], dtype=object)[c['chrom'][lo:hi]]
+        starts = np.array(c['start'][lo:hi], dtype=np.int64)
+        ends = np.array(c['end'][lo:hi], dtype=np.int64)
+        columns = [chroms.tolist(), starts.astype(str).tolist(),
+                   ends.astype(str).tolist(),
+                   np.array(self.meta['names'])[c['name'][lo:hi]].tolist(),
+                   np.char.decode(c['score'][lo:hi]).tolist(),
+                   np.char.decode(c['strand'][lo:hi]).tolist()]
+        rows = list(zip(*columns[:self.meta['fields']]))
+        return Intervals(rows, 'bed', chroms=chroms, starts=starts, ends=ends)
+
+
+class GeneIndex(object):
+    """Mapping of gene id to the records of a GFF file.
+
+    Each gene maps to the runs of consecutive records naming it, stored as
+    ``[first_row, last_row, first_byte, last_byte]`` so a gene can be sliced
+    out of a parsed track or read straight from the file. Rows count data
+    records only, as Intervals.from_file does.
+    """
+
+    def __init__(self, genes):
+        self.genes = genes
+
+    @classmethod
+    def build(cls, filename, persist=True):
+        """Scan a GFF file once and optionally persist its gene index; the
+        index is kept in memory only when its directory is not writable"""
+        genes = {}
+        row, offset, last = 0, 0, None
+        with open(filename, 'rb') as fh:
+            for line in fh:
+                length = len(line)
+                line = line.decode('utf-8')
+                if not line.strip() or line.startswith(
+                        ('#', 'track', 'browser')):
+                    offset += length
+                    continue
+                fields = line.rstrip('\r\n').split('\t')
+                name = gff_name(fields[8]) if len(fields) > 8 else ''
+                spans = genes.setdefault(name, [])
+                if name == last:
+                    spans[-1][1] = row + 1
+                    spans[-1][3] = offset + length
+                else:
+                    spans.append([row, row + 1, offset, offset + length])
+                row, offset, last = row + 1, offset + length, name
+
+        if not persist:
+            return cls(genes)
+        target = gene_index_path(filename)
+        try:
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(target) or '.')
+            with open(fd, 'w', encoding="utf-8") as fh:
+                fh.write(json.dumps({'source': _source_stat(filename),
+                                     'genes': genes}))
+            os.rename(tmp, target)
+        except (IOError, OSError) as e:
+            log.debug('Unable to write gene index {}: {}'.format(target, e))
+        return cls(genes)
+
+    @classmethod
+    def open(cls, filename):
+        """Load the gene index of filename, or None if missing or stale"""
+        target = gene_index_path(filename)
+        if not os.path.isfile(target):
+            return None
+        with open(target, encoding="utf-8") as fh:
+            data = json.load(fh)
+        if data['source'] != _source_stat(filename):
+            return None
+        return cls(data['genes'])
+
+    def _spans(self, genes):
+        spans = [s for g in set(genes) for s in self.genes.get(g, ())]
+        return sorted(spans)
+
+    def rows(self, genes):
+        """Sorted row positions of the records of the given genes"""
+        spans = self._spans(genes)
+        if not spans:
+            return np.array([], dtype=np.int64)
+        return np.concatenate([np.arange(lo, hi) for lo, hi, _, _ in spans])
+
+    def read(self, filename, genes):
+        """Yield the lines of the given genes, in file order"""
+        with open(filename, 'rb') as fh:
+            for _, _, lo, hi in self._spans(genes):
+                fh.seek(lo)
+                for line in fh.read(hi - lo).decode('utf-8').splitlines():
+                    if line.strip() and not line.startswith(
+                            ('#', 'track', 'browser')):
+                        yield line
+
+
+class StringTable(object):
+    """Distinct strings of a column, memory-mapped from one UTF-8 blob
+    and the offsets of its strings"""
+
+    def __init__(self, directory, column):
+        self.offsets = np.load(
+            os.path.join(directory, column + '.offsets.npy'), mmap_mode='r')
+        blob = os.path.join(directory, column + '.bytes')
+        if os.path.getsize(blob):
+            self.blob = np.memmap(blob, dtype=np.uint8, mode='r')
+        else:
+            self.blob = np.zeros(0, dtype=np.uint8)
+
+    @staticmethod
+    def write(directory, column, values):
+        """Intern values into a table written to directory
+
+        :return: array with the table id of every value
+        """
+        table, ids = np.unique(np.array(values, dtype=object),
+                               return_inverse=True)
+        encoded = [x.encode('utf-8') for x in table]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(x) for x in encoded])
+        np.save(os.path.join(directory, column + '.offsets.npy'), offsets)
+        with open(os.path.join(directory, column + '.bytes'), 'wb') as fh:
+            fh.write(b''.join(encoded))
+        return ids
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.blob[self.offsets[i]:self.offsets[i + 1]].tobytes() \
+            .decode('utf-8')
+
+    def tolist(self):
+        return [self[i] for i in range(len(self))]
+
+
+def write_track(filename):
+    """Write the columnar store of a GFF track.
+
+    :param str filename: GFF file, used for the location and to detect when
+        the store goes stale
+    :return str: path to the store directory
+    """
+    intervals = Intervals.from_file(filename)
+    if len(intervals) and intervals.file_type != 'gff':
+        raise ValueError("Not a GFF file: %s" % filename)
+    rows = intervals.rows
+
+    target = track_path(filename)
+    tmp = tempfile.mkdtemp(dir=os.path.dirname(target) or '.')
+    ids = {}
+    for column in TRACK_STRINGS:
+        if column == 'name':
+            values = intervals.names()
+        else:
+            values = [r[TRACK_COLUMNS.index(column)] for r in rows]
+        ids[column] = StringTable.write(tmp, column, values)
+
+    # Chromosome ids follow the sorted table, so this is bedtools sort order
+    order = np.lexsort((intervals.starts, ids['chrom']))
+    columns = dict((c, ids[c][order].astype(np.int32)) for c in TRACK_STRINGS)
+    columns['start'] = intervals.starts[order].astype(np.int32)
+    columns['end'] = intervals.ends[order].astype(np.int32)
+    columns['strand'] = np.array([r[6] for r in rows], dtype='S1')[order]
+    columns['frame'] = np.array([r[7] for r in rows], dtype='S1')[order]
+    for column, values in columns.items():
+        np.save(os.path.join(tmp, column + '.npy'), values)
+
+    chroms = StringTable(tmp, 'chrom').tolist()
+    bounds = np.searchsorted(columns['chrom'], np.arange(len(chroms) + 1))
+    meta = {'chroms': dict((c, [int(bounds[i]), int(bounds[i + 1])])
+                           for i, c in enumerate(chroms)),
+            'source': _source_stat(filename)}
+    with open(os.path.join(tmp, 'meta.json'), 'w', encoding="utf-8") as fh:
+        fh.write(json.dumps(meta))
+    if os.path.isdir(target):
+        shutil.rmtree(target)
+    os.rename(tmp, target)
+    return target
+
+
+class TrackIndex(object):
+    """Read-only, memory-mapped view of a track written by write_track.
+
+    Several processes opening the same track share one copy of its columns
+    through the page cache.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, 'meta.json'),
+                  encoding="utf-8") as fh:
+            self.meta = json.load(fh)
+        self.columns = dict(
+            (c, np.load(os.path.join(directory, c + '.npy'), mmap_mode='r'))
+            for c in TRACK_COLUMNS)
+        self.strings = dict((c, StringTable(directory, c))
+                            for c in TRACK_STRINGS)
+        self._tables = {}
+
+    @classmethod
+    def open(cls, filename):
+        """Open the store of filename, or return None if missing or stale"""
+        directory = track_path(filename)
+        if not os.path.isfile(os.path.join(directory, 'meta.json')):
+            return None
+        track = cls(directory)
+        if track.meta['source'] != _source_stat(filename):
+            return None
+        return track
+
+    def _table(self, column):
+        """Decoded table of a column with few distinct values"""
+        if column not in self._tables:
+            self._tables[column] = np.array(self.strings[column].tolist(),
+                                            dtype=object)
+        return self._tables[column]
+
+    def rows(self, idx):
+        """Text fields of the records at the given positions"""
+        c = self.columns
+        chrom, source, feature, score = (
+            self._table(x)[c[x][idx]]
+            for x in ('chrom', 'source', 'feature', 'score'))
+        attributes = self.strings['attributes']
+        return [(chrom[i], source[i], feature[i], str(start + 1), str(end),
+                 score[i], strand.decode('utf-8'), frame.decode('utf-8'),
+                 attributes[a])
+                for i, (start, end, strand, frame, a) in enumerate(zip(
+                    c['start'][idx], c['end'][idx], c['strand'][idx],
+                    c['frame'][idx], c['attributes'][idx]))]
+
+    def intervals(self):
+        """All records of the track, with their text rows built on demand"""
+        c = self.columns
+        intervals = Intervals(
+            None, 'gff', chroms=self._table('chrom')[c['chrom']],
+            starts=c['start'], ends=c['end'], fetch=self.rows,
+            names=self._table('name')[c['name']])
+        # Rows are stored per chromosome, so the groups are known already
+        intervals._groups = dict(
+            (chrom, np.arange(lo, hi))
+            for chrom, (lo, hi) in self.meta['chroms'].items() if hi > lo)
+        return intervals
+
+
+def read_gtf_genes(filename, chunksize=10 ** 6):
+    """Gene records of a, possibly gzipped, GTF file.
+
+    The file is read in chunks of lines and only the gene records of each
+    chunk are kept, so the exon and transcript records never pile up.
+
+    :return pandas.DataFrame: with the columns in GENE_COLUMNS, zero-based
+        starts and normalized chromosome names
+    """
+    # Only the reports need pandas
+    import pandas as pd
+
+    genes = []
+    reader = pd.read_csv(filename, sep='\t', header=None, dtype=str,
+                         usecols=[0, 2, 3, 4, 8], names=range(9),
+                         chunksize=chunksize)
+    for chunk in reader:
+        chunk = chunk[chunk[2] == 'gene']
+        attributes = chunk[8]
+        genes.append(pd.DataFrame({
+            'chrom': chunk[0], 'start': chunk[3].astype(np.int64) - 1,
+            'end': chunk[4].astype(np.int64),
+            'gene_id': attributes.str.extract(_gtf_gene_id, expand=False),
+            'biotype': attributes.str.extract(_gtf_biotype, expand=False)}))
+    genes = pd.concat(genes, ignore_index=True) if genes else pd.DataFrame(
+        columns=GENE_COLUMNS)
+    genes['biotype'] = genes['biotype'].fillna('unknown')
+    chroms = genes['chrom'].unique()
+    genes['chrom'] = genes['chrom'].map(
+        dict((x, normalize_chrom(x)) for x in chroms))
+    return genes
+
+
+def write_gene_table(filename):
+    """Write the gene table of an Ensembl GTF file.
+
+    :param str filename: GTF file, used for the location and to detect when
+        the table goes stale
+    :return str: path to the table directory
+    """
+    genes = read_gtf_genes(filename)
+    chroms, chrom_ids = np.unique(genes['chrom'].to_numpy(dtype=str),
+                                  return_inverse=True)
+    biotypes, biotype_ids = np.unique(genes['biotype'].to_numpy(dtype=str),
+                                      return_inverse=True)
+    starts = genes['start'].to_numpy(dtype=np.int64)
+    order = np.lexsort((starts, chrom_ids))
+
+    target = gene_table_path(filename)
+    parent = os.path.dirname(target)
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    tmp = tempfile.mkdtemp(dir=parent)
+    gene_ids = StringTable.write(
+        tmp, 'gene_id', genes['gene_id'].fillna('').to_numpy()[order])
+    columns = {
+        'chrom': chrom_ids[order].astype(np.int32),
+        'start': starts[order].astype(np.int32),
+        'end': genes['end'].to_numpy(dtype=np.int64)[order].astype(np.int32),
+        'gene_id': gene_ids.astype(np.int32),
+        'biotype': biotype_ids[order].astype(np.int32)}
+    for column, values in columns.items():
+        np.save(os.path.join(tmp, column + '.npy'), values)
+
+    bounds = np.searchsorted(columns['chrom'], np.arange(len(chroms) + 1))
+    meta = {'chroms': dict((c, [int(bounds[i]), int(bounds[i + 1])])
+                           for i, c in enumerate(chroms.tolist())),
+            'biotypes': biotypes.tolist(),
+            'source': _source_stat(filename)}
+    with open(os.path.join(tmp, 'meta.json'), 'w', encoding="utf-8") as fh:
+        fh.write(json.dumps(meta))
+    if os.path.isdir(target):
+        shutil.rmtree(target)
+    os.rename(tmp, target)
+    log.info('Wrote gene table of {}'.format(filename))
+    return target
+
+
+class GeneTable(object):
+    """Read-only, memory-mapped view of a table written by write_gene_table.
+
+    Rows are sorted by chromosome and start, with the row range of each
+    chromosome in the metadata.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, 'meta.json'),
+                  encoding="utf-8") as fh:
+            self.meta = json.load(fh)
+        self.columns = dict(
+            (c, np.load(os.path.join(directory, c + '.npy'), mmap_mode='r'))
+            for c in GENE_COLUMNS)
+        self.gene_ids = StringTable(directory, 'gene_id')
+        self.biotypes = self.meta['biotypes']
+
+    @classmethod
+    def open(cls, filename):
+        """Open the table of filename, or return None if missing or stale"""
+        directory = gene_table_path(filename)
+        if not os.path.isfile(os.path.join(directory, 'meta.json')):
+            return None
+        table = cls(directory)
+        if table.meta['source'] != _source_stat(filename):
+            return None
+        return table
+
+    @classmethod
+    def load(cls, filename):
+        """Open the table of filename, writing it first if needed"""
+        table = cls.open(filename)
+        if table is None:
+            table = cls(write_gene_table(filename))
+        return table
+
+    def __len__(self):
+        return len(self.columns['start'])
+
+    def overlapping(self, peaks):
+        """Which genes overlap at least one peak
+
+        :param dict peaks: chromosome to arrays of peak starts and ends
+        :return: boolean array over the rows of the table
+        """
+        c = self.columns
+        hit = np.zeros(len(self), dtype=bool)
+        for chrom, (lo, hi) in self.meta['chroms'].items():
+            if chrom not in peaks or lo == hi:
+                continue
+            starts, ends = peaks[chrom]
+            hit[lo:hi] = overlap_counts(c['start'][lo:hi], c['end'][lo:hi],
+                                        np.sort(starts), np.sort(ends)) > 0
+        return hit
+
+    def biotype_counts(self, peaks):
+        """Genes per biotype, overall and among those overlapping peaks
+
+        :param dict peaks: chromosome to arrays of peak starts and ends
+        :return tuple: dicts of biotype to the number of overlapping genes
+            and to the number of all genes
+        """
+        codes = self.columns['biotype']
+        minlength = len(self.biotypes)
+        hits = np.bincount(codes[self.overlapping(peaks)],
+                           minlength=minlength)
+        totals = np.bincount(codes, minlength=minlength)
+        return (dict(zip(self.biotypes, hits.tolist())),
+                dict(zip(self.biotypes, totals.tolist())))
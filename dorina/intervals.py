@@ -0,0 +1,414 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+"""
+In-process interval engine used as an alternative to pybedtools.
+
+Records are kept as their original text fields, while the coordinates live
+in NumPy arrays so overlap joins can be answered with binary searches over
+each chromosome instead of forking a bedtools process per step.
+"""
+from __future__ import unicode_literals
+import re
+import sys
+from io import open
+
+import numpy as np
+
+_gff_attribute = re.compile(r'\s*([^=\s]+)[=\s]"?([^";]*)"?')
+_gff_name_keys = ('ID', 'Name', 'gene_name', 'transcript_id', 'gene_id',
+                  'Parent')
+
+
+def read_chromsizes(filename):
+    """Read a bedtools genome file into a dict of chromosome lengths
+
+    :param str filename: path to a tab separated chromosome/size file; a
+        header line is skipped
+    :return dict: chromosome name to length
+    """
+    sizes = {}
+    with open(filename, encoding="utf-8") as fh:
+        for line in fh:
+            fields = line.split()
+            if len(fields) < 2 or not fields[1].isdigit():
+                continue
+            sizes[fields[0]] = int(fields[1])
+    return sizes
+
+
+def _coordinates(values):
+    values = np.asarray(values)
+    if values.dtype.kind not in 'iu':
+        values = values.astype(np.int64)
+    return values
+
+
+def is_gff(fields):
+    return len(fields) >= 9 and fields[3].isdigit() and fields[4].isdigit()
+
+
+def gff_name(attributes):
+    """Feature name from a GFF attribute column, as pybedtools reads it"""
+    attrs = dict(_gff_attribute.findall(attributes))
+    for key in _gff_name_keys:
+        if key in attrs:
+            return attrs[key]
+    return ''
+
+
+def _sweep(rows, a_starts, a_ends, order, starts, max_ends, ends):
+    """Overlapping pairs on one chromosome.
+
+    The other set is given sorted by start, along with the running maximum
+    of its ends, so the candidates of each interval form a contiguous range
+    found with two binary searches.
+    """
+    hi = np.searchsorted(starts, a_ends, side='left')
+    lo = np.searchsorted(max_ends, a_starts, side='right')
+    counts = np.maximum(hi - lo, 0)
+    total = counts.sum()
+    first = np.repeat(lo - np.cumsum(counts) + counts, counts)
+    candidates = first + np.arange(total)
+    keep = ends[candidates] > np.repeat(a_starts, counts)
+    return np.repeat(rows, counts)[keep], order[candidates[keep]]
+
+
+def overlap_counts(starts, ends, other_starts, other_ends):
+    """Number of other intervals overlapping each interval, on one chromosome.
+
+    An interval of the other set overlaps when it starts before the end and
+    does not end before the start, so with the other starts and ends sorted
+    separately both numbers come from one binary search per interval.
+
+    :param starts: zero-based starts of the intervals
+    :param ends: ends of the intervals
+    :param other_starts: sorted starts of the other intervals
+    :param other_ends: sorted ends of the other intervals
+    :return: array of counts
+    """
+    return (np.searchsorted(other_starts, ends, side='left') -
+            np.searchsorted(other_ends, starts, side='right'))
+
+
+class Intervals(object):
+    """Genomic intervals held as NumPy coordinate arrays.
+
+    Coordinates are always stored zero-based and half-open, whatever the
+    file type; rows are rendered back with the original convention.
+
+    A set may carry, in ``hits``, the list of records overlapping each of
+    its rows. They follow the rows through take(), sort() and cat(), so a
+    join found early in an analysis can be written out at the end with
+    with_hits() instead of being searched again.
+
+    Sets read from a columnar store only hold the coordinates; their text
+    rows are built on first use, and only for the rows taken out of them.
+    """
+
+    def __init__(self, rows, file_type='bed', chroms=None, starts=None,
+                 ends=None, fetch=None, names=None):
+        """
+        :param list rows: records as tuples of text fields, or None when
+            fetch is given
+        :param str file_type: 'bed' or 'gff'
+        :param chroms: optional precomputed chromosome array
+        :param starts: optional precomputed zero-based start array
+        :param ends: optional precomputed end array
+        :param callable fetch: returns the rows at an array of positions,
+            used to build them on demand
+        :param names: optional precomputed array of record names
+        """
+        self._rows = rows
+        self._fetch = fetch
+        self._names = names
+        self.file_type = file_type
+        if starts is None and file_type == 'gff':
+            starts = [int(r[3]) - 1 for r in rows]
+            ends = [int(r[4]) for r in rows]
+        elif starts is None:
+            starts = [int(r[1]) for r in rows]
+            ends = [int(r[2]) for r in rows]
+        if chroms is None:
+            chroms = [r[0] for r in rows]
+        # Integer arrays are kept as they are, so memory maps are shared
+        self.starts = _coordinates(starts)
+        self.ends = _coordinates(ends)
+        self.chroms = np.asarray(chroms, dtype=object)
+        self.hits = None
+        self._groups = None
+        self._index = None
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Create intervals from a list of field tuples, guessing the type"""
+        rows = [tuple(r) for r in rows]
+        file_type = 'gff' if rows and is_gff(rows[0]) else 'bed'
+        return cls(rows, file_type)
+
+    @classmethod
+    def from_file(cls, filename):
+        """Parse a BED or GFF file, skipping headers and comments"""
+        rows = []
+        with open(filename, encoding="utf-8") as fh:
+            for line in fh:
+                if not line.strip() or line.startswith(
+                        ('#', 'track', 'browser')):
+                    continue
+                rows.append(tuple(line.rstrip('\r\n').split('\t')))
+        return cls.from_rows(rows)
+
+    @property
+    def rows(self):
+        """Records as tuples of text fields"""
+        if self._rows is None:
+            self._rows = self._fetch(np.arange(len(self.starts)))
+        return self._rows
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __str__(self):
+        return ''.join('\t'.join(r) + '\n' for r in self.rows)
+
+    def __eq__(self, other):
+        return str(self) == str(other)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def nbytes(self):
+        """Estimated memory held by the records and coordinate arrays"""
+        rows = 0
+        if self._rows is not None:
+            rows = sys.getsizeof(self._rows) + sum(
+                sys.getsizeof(r) + sum(sys.getsizeof(f) for f in r)
+                for r in self._rows)
+        return rows + self.starts.nbytes + self.ends.nbytes + \
+            self.chroms.nbytes
+
+    def field_count(self):
+        """Number of fields of the first record, 0 if empty"""
+        if not len(self):
+            return 0
+        return len(self.take([0]).rows[0])
+
+    def names(self):
+        """Record names, following the pybedtools rules for BED and GFF"""
+        if self._names is not None:
+            return list(self._names)
+        if self.file_type == 'gff':
+            return [gff_name(r[8]) for r in self.rows]
+        return [r[3] if len(r) > 3 else '' for r in self.rows]
+
+    def take(self, idx):
+        """Return a new set holding the rows at the given positions"""
+        idx = np.asarray(idx, dtype=np.int64)
+        names = None if self._names is None else self._names[idx]
+        if self._rows is None:
+            fetch = self._fetch
+            result = Intervals(None, self.file_type, self.chroms[idx],
+                               self.starts[idx], self.ends[idx],
+                               fetch=lambda i: fetch(idx[i]), names=names)
+        else:
+            result = Intervals([self._rows[i] for i in idx], self.file_type,
+                               self.chroms[idx], self.starts[idx],
+                               self.ends[idx], names=names)
+        if self.hits is not None:
+            result.hits = [self.hits[i] for i in idx]
+        return result
+
+    def filter(self, func):
+        """Keep records whose name satisfies func"""
+        return self.take([i for i, name in enumerate(self.names())
+                          if func(name)])
+
+    def bed6(self):
+        """Split BED12 blocks into BED6 records, truncating other BED rows"""
+        rows = []
+        for r in self.rows:
+            if len(r) >= 12:
+                start = int(r[1])
+                sizes = [int(x) for x in r[10].rstrip(',').split(',')]
+                offsets = [int(x) for x in r[11].rstrip(',').split(',')]
+                for size, offset in zip(sizes, offsets):
+                    rows.append((r[0], str(start + offset),
+                                 str(start + offset + size)) + r[3:6])
+            else:
+                rows.append(r[:6])
+        return Intervals(rows, 'bed')
+
+    def _with_coords(self, row, start, end):
+        if self.file_type == 'gff':
+            return row[:3] + (str(start + 1), str(end)) + row[5:]
+        return row[:1] + (str(start), str(end)) + row[3:]
+
+    def _chrom_groups(self):
+        """Row positions per chromosome, in file order"""
+        if self._groups is None:
+            self._groups = {}
+            if len(self.starts):
+                chroms, inverse = np.unique(self.chroms, return_inverse=True)
+                order = np.argsort(inverse, kind='stable')
+                bounds = np.cumsum(np.bincount(inverse))[:-1]
+                for chrom, rows in zip(chroms, np.split(order, bounds)):
+                    self._groups[chrom] = rows
+        return self._groups
+
+    def _chrom_index(self):
+        """Per chromosome rows sorted by start with the running maximum end"""
+        if self._index is None:
+            self._index = {}
+            for chrom, rows in self._chrom_groups().items():
+                order = rows[np.argsort(self.starts[rows], kind='stable')]
+                self._index[chrom] = (order, self.starts[order],
+                                      np.maximum.accumulate(self.ends[order]))
+        return self._index
+
+    def overlaps(self, other, executor=None):
+        """Find all overlapping pairs between two interval sets.
+
+        :param Intervals other: intervals to search
+        :param executor: optional concurrent.futures executor used to sweep
+            the chromosomes in parallel
+        :return tuple: arrays of row positions in self and other, ordered by
+            self and then by other
+        """
+        index = other._chrom_index()
+        jobs = []
+        for chrom, rows in self._chrom_groups().items():
+            if chrom not in index:
+                continue
+            order, starts, max_ends = index[chrom]
+            jobs.append((rows, self.starts[rows], self.ends[rows], order,
+                         starts, max_ends, other.ends[order]))
+
+        if executor is not None and len(jobs) > 1:
+            hits = list(executor.map(_sweep, *zip(*jobs)))
+        else:
+            hits = [_sweep(*job) for job in jobs]
+
+        if not hits:
+            empty = np.array([], dtype=np.int64)
+            return empty, empty
+        a_hits = np.concatenate([a for a, _ in hits])
+        b_hits = np.concatenate([b for _, b in hits])
+        order = np.lexsort((b_hits, a_hits))
+        return a_hits[order], b_hits[order]
+
+    def sort(self):
+        """Sort by chromosome name and start, as ``bedtools sort`` does"""
+        return self.take(np.lexsort((self.starts, self.chroms.astype(str))))
+
+    def tagged_overlaps(self, others, executor=None):
+        """Find the overlapping pairs with several sets, in one sweep over all.
+
+        :param list others: Intervals, e.g. one per regulator
+        :param executor: optional concurrent.futures executor, see overlaps()
+        :return tuple: arrays of row positions in self, positions of the sets
+            in others and row positions in those sets, ordered by self, then
+            by the start of the other record, then by set
+        """
+        empty = np.array([], dtype=np.int64)
+        if not others:
+            return empty, empty, empty
+        # Only the coordinates are needed, each tagged with its set
+        tags = np.repeat(np.arange(len(others)), [len(x) for x in others])
+        local = np.concatenate([np.arange(len(x)) for x in others])
+        merged = Intervals([], chroms=np.concatenate([x.chroms for x in others]),
+                           starts=np.concatenate([x.starts for x in others]),
+                           ends=np.concatenate([x.ends for x in others]))
+        a_hits, b_hits = self.overlaps(merged, executor)
+        order = np.lexsort((b_hits, merged.starts[b_hits], a_hits))
+        a_hits, b_hits = a_hits[order], b_hits[order]
+        return a_hits, tags[b_hits], local[b_hits]
+
+    def count_overlaps(self, others, executor=None):
+        """Count the sets overlapping each record, in one sweep over all.
+
+        :param list others: Intervals, e.g. one per regulator
+        :param executor: optional concurrent.futures executor, see overlaps()
+        :return: array with the number of distinct sets in others that
+            overlap each record
+        """
+        a_hits, tags, _ = self.tagged_overlaps(others, executor)
+        pairs = np.unique(a_hits * len(others) + tags)
+        return np.bincount(pairs // max(len(others), 1), minlength=len(self))
+
+    def with_hits(self):
+        """Join every record with the records carried in hits, as
+        ``intersect(wa=True, wb=True)`` would"""
+        return Intervals([r + h for r, hits in zip(self.rows, self.hits)
+                          for h in hits], self.file_type)
+
+    def intersect(self, other, wa=False, wb=False, u=False, v=False,
+                  sorted=False, executor=None):
+        """Intersect with another set, mirroring ``bedtools intersect``.
+
+        ``sorted`` is accepted for compatibility with ``BedTool.intersect``;
+        the sweep orders each chromosome itself, in linear time when the
+        input already is sorted.
+        """
+        a_hits, b_hits = self.overlaps(other, executor)
+        if u:
+            return self.take(np.unique(a_hits))
+        if v:
+            missing = np.ones(len(self), dtype=bool)
+            missing[a_hits] = False
+            return self.take(np.flatnonzero(missing))
+
+        rows = []
+        starts = np.maximum(self.starts[a_hits], other.starts[b_hits])
+        ends = np.minimum(self.ends[a_hits], other.ends[b_hits])
+        b_rows = other.take(b_hits).rows if wb else a_hits
+        for row, b_row, start, end in zip(self.take(a_hits).rows, b_rows,
+                                          starts, ends):
+            if not wa:
+                row = self._with_coords(row, start, end)
+            rows.append(row + b_row if wb else row)
+        return Intervals(rows, self.file_type)
+
+    def slop(self, g, b):
+        """Extend every interval by b on both sides, clipped to the genome
+
+        :param str g: bedtools genome file with chromosome sizes
+        :param int b: number of bases to add
+        """
+        sizes = read_chromsizes(g)
+        rows = []
+        for row, chrom, start, end in zip(self.rows, self.chroms,
+                                          self.starts, self.ends):
+            if chrom not in sizes:
+                raise ValueError("Chromosome %s missing from %s" % (chrom, g))
+            rows.append(self._with_coords(row, max(0, start - b),
+                                          min(sizes[chrom], end + b)))
+        return Intervals(rows, self.file_type)
+
+    def cat(self, *others, **kwargs):
+        """Concatenate sets following the ``BedTool.cat`` truncation rules.
+
+        Merging is not supported, so ``postmerge`` must be False.
+        """
+        if kwargs.get('postmerge', True):
+            raise NotImplementedError("Intervals.cat does not merge")
+        sets = [x for x in (self,) + others if len(x)]
+        if not sets:
+            return self
+        types = set(x.file_type for x in sets)
+        field_counts = set(x.field_count() for x in sets)
+        if len(types) == 1 and len(field_counts) == 1:
+            result = Intervals([r for x in sets for r in x.rows],
+                               sets[0].file_type)
+        elif len(types) == 1:
+            n = min(field_counts)
+            result = Intervals([r[:n] for x in sets for r in x.rows],
+                               sets[0].file_type)
+        else:
+            result = Intervals(
+                [(c, str(s), str(e)) for x in sets
+                 for c, s, e in zip(x.chroms, x.starts, x.ends)], 'bed')
+        if all(x.hits is not None for x in sets):
+            result.hits = [h for x in sets for h in x.hits]
+        return result
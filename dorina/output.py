@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+"""
+Streaming writers for analysis results.
+
+Records are written in bounded chunks as they are read from the result, so
+memory use does not grow with the number of hits.
+"""
+from __future__ import unicode_literals
+import gzip
+import io
+import sys
+
+from dorina.intervals import is_gff
+
+FORMATS = ('bed', 'tsv', 'bed.gz', 'parquet')
+
+# Column names of an analyse() hit: the genome feature, then the regulator
+RESULT_COLUMNS = ('chrom', 'source', 'feature', 'start', 'end', 'score',
+                  'strand', 'frame', 'attributes', 'regulator_chrom',
+                  'regulator_start', 'regulator_end', 'regulator_name',
+                  'regulator_score', 'regulator_strand')
+
+
+def column_names(n_fields):
+    """Column names for records with n_fields fields"""
+    if n_fields == len(RESULT_COLUMNS):
+        return list(RESULT_COLUMNS)
+    return ['field%d' % (i + 1) for i in range(n_fields)]
+
+
+def check_format(fmt):
+    """Check an output format can be written
+
+    :raises ValueError: for unknown formats, and for Parquet without pyarrow
+    """
+    if fmt not in FORMATS:
+        raise ValueError("Invalid format: %r" % fmt)
+    if fmt == 'parquet':
+        try:
+            import pyarrow
+        except ImportError:
+            raise ValueError("Parquet output requires pyarrow, e.g. "
+                             "pip install dorina[parquet]")
+
+
+def records(result):
+    """Iterate over the fields of a BedTool or Intervals result"""
+    for record in result:
+        yield list(getattr(record, 'fields', record))
+
+
+class ResultWriter(object):
+    """Write results record by record to a file or stdout.
+
+    >>> with ResultWriter('hits.bed.gz', 'bed.gz') as writer:
+    ...     writer.write(result)
+    """
+
+    def __init__(self, output='-', fmt='bed', chunk_size=10000):
+        """
+        :param str output: file name, or '-' for stdout
+        :param str fmt: one of FORMATS
+        :param int chunk_size: records buffered before each write
+        """
+        check_format(fmt)
+        self.output = output
+        self.format = fmt
+        self.chunk_size = chunk_size
+        self._columns = None
+        self._parquet = None
+        self._query = None
+        self._with_query = None
+
+        if fmt == 'parquet':
+            self._fh = self._open_binary()
+        elif fmt == 'bed.gz':
+            self._raw = self._open_binary()
+            self._fh = io.TextIOWrapper(
+                gzip.GzipFile(fileobj=self._raw, mode='wb'), encoding='utf-8')
+        elif output == '-':
+            self._fh = sys.stdout
+        else:
+            self._fh = io.open(output, 'w', encoding='utf-8')
+
+    def _open_binary(self):
+        if self.output == '-':
+            return getattr(sys.stdout, 'buffer', sys.stdout)
+        return io.open(self.output, 'wb')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, result, comment=None, query=None):
+        """Stream all records of a result
+
+        :param result: BedTool or Intervals
+        :param str comment: written as a '#' line before text records
+        :param int query: id of the query of the result, stored in a leading
+            'query' column of Parquet records, which have no comments; give
+            it for all results written or for none
+        """
+        if comment is not None and self.format != 'parquet':
+            self._fh.write('# %s\n' % comment)
+        if self.format == 'parquet':
+            if self._with_query is None:
+                self._with_query = query is not None
+            elif self._with_query != (query is not None):
+                raise ValueError("Parquet output requires a query id for "
+                                 "either all or no results")
+            self._query = query
+
+        chunk = []
+        for fields in records(result):
+            chunk.append(fields)
+            if len(chunk) >= self.chunk_size:
+                self._write_chunk(chunk)
+                chunk = []
+        if chunk:
+            self._write_chunk(chunk)
+
+    def _write_chunk(self, chunk):
+        if self._columns is None:
+            n_fields = len(chunk[0])
+            if self.format == 'parquet' and self._with_query and \
+                    is_gff(chunk[0]) and n_fields < len(RESULT_COLUMNS):
+                # Regulators of later queries may have more fields; shorter
+                # records are padded to the schema
+                n_fields = len(RESULT_COLUMNS)
+            self._columns = column_names(n_fields)
+            if self.format == 'tsv':
+                self._fh.write('\t'.join(self._columns) + '\n')
+
+        if self.format == 'parquet':
+            self._write_parquet(chunk)
+        else:
+            self._fh.write(''.join('\t'.join(x) + '\n' for x in chunk))
+
+    def _write_parquet(self, chunk):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        width = len(self._columns)
+        if any(len(x) > width for x in chunk):
+            raise ValueError("Parquet output requires records with at most "
+                             "%d fields" % width)
+        arrays, names = [], list(self._columns)
+        if self._with_query:
+            arrays.append(pa.array([self._query] * len(chunk), pa.int64()))
+            names.insert(0, 'query')
+        # Missing trailing fields are stored as nulls
+        columns = list(zip(*(list(x) + [None] * (width - len(x))
+                             for x in chunk))) or [()] * width
+        for name, column in zip(self._columns, columns):
+            if name.endswith(('start', 'end')):
+                arrays.append(pa.array(
+                    [None if x is None else int(x) for x in column],
+                    pa.int64()))
+            else:
+                arrays.append(pa.array(column, pa.string()))
+        table = pa.Table.from_arrays(arrays, names=names)
+        if self._parquet is None:
+            self._parquet = pq.ParquetWriter(self._fh, table.schema)
+        self._parquet.write_table(table)
+
+    def close(self):
+        if self.format == 'parquet' and self._parquet is None:
+            # Leave a valid, empty file when there were no hits
+            self._columns = list(RESULT_COLUMNS)
+            self._write_parquet([])
+        if self._parquet is not None:
+            self._parquet.close()
+        if self.format == 'bed.gz':
+            self._fh.close()
+            self._fh = self._raw
+        if self.output != '-':
+            self._fh.close()
+        else:
+            self._fh.flush()
@@ -4,21 +4,79 @@
 from __future__ import unicode_literals
 import os
 import json
-from pybedtools import BedTool
-from dorina.utils import DorinaUtils
+import logging
+import shutil
+import threading
+from pybedtools import BedTool, create_interval_from_list
+from dorina.index import IntervalIndex, write_index
+from dorina.intervals import Intervals, read_chromsizes
+from dorina.sorting import sort_record, sorted_path
+from dorina.utils import MANIFEST, DorinaUtils
 from io import open
 
+log = logging.getLogger(__name__)
+
+STRANDS = ('+', '-', '.')
+
+
+def matches(regulator, record_name):
+    """Whether a BED record name belongs to the named regulator"""
+    # Drop first part before underscore.
+    if "_" in regulator:
+        name = "_".join(regulator.split("_")[1:])
+    else:
+        name = regulator
+    return (name + "*" in record_name) or (name == record_name)
+
+
+def validate_bed(filename, chrom_sizes=None):
+    """Check the records of a regulator BED file
+
+    :param str filename: BED file
+    :param dict chrom_sizes: optional chromosome lengths the records must
+        lie within
+    :return set: names of the records
+    :raises ValueError: naming the first invalid line
+    """
+    names = set()
+    with open(filename, encoding="utf-8") as fh:
+        for number, line in enumerate(fh, 1):
+            if not line.strip() or line.startswith(('#', 'track', 'browser')):
+                continue
+            fields = line.rstrip('\r\n').split('\t')
+            try:
+                if len(fields) < 6:
+                    raise ValueError("expected at least 6 fields")
+                start, end = int(fields[1]), int(fields[2])
+                if start < 0 or end < start:
+                    raise ValueError("invalid coordinates")
+                if fields[5] not in STRANDS:
+                    raise ValueError("invalid strand %r" % fields[5])
+                if chrom_sizes is not None:
+                    if fields[0] not in chrom_sizes:
+                        raise ValueError("unknown chromosome %r" % fields[0])
+                    if end > chrom_sizes[fields[0]]:
+                        raise ValueError("end beyond chromosome length")
+            except ValueError as e:
+                raise ValueError("%s, line %d: %s" % (filename, number, e))
+            names.add(fields[3])
+    return names
+
 
 class Regulator(object):
     _datadir = None
     _regulators = None
+    _by_assembly = None
+    _manifest_mtime = None
+    _lock = threading.Lock()
 
     def __init__(self, name, path, custom):
         self.name = name
         self.path = path
         self.basename = os.path.splitext(path)[0]
         self.custom = custom
-        self.bed = self._bed()
+        self._bedtool = None
+        self._intervals = None
 
     @classmethod
     def init(cls, datadir):
@@ -36,6 +94,7 @@ class Regulator(object):
             """Parse function used to initialise the regulators from the data
             directory. Gets all available regulators.  A valid regulator must
             have a JSON metadata file as well as a BED file containing the data.
+            The metadata file is recorded relative to the regulator tree.
             """
 
             regulators = {}
@@ -55,46 +114,255 @@ class Regulator(object):
 
                 experiments = parse_experiment(experiment_path)
                 for experiment_dict in experiments:
-                    experiment_dict['file'] = experiment_path
+                    experiment_dict['file'] = os.path.relpath(
+                        experiment_path, tree)
                     regulators[experiment_dict['id']] = experiment_dict
 
             return regulators
 
-        cls._datadir = datadir
-        cls._regulators = DorinaUtils.walk_assembly_tree(
-            os.path.join(datadir, 'regulators'),
-            parse_func)
+        tree = os.path.join(datadir, 'regulators')
+        regulators = DorinaUtils.load_assembly_tree(tree, parse_func)
+        mtime = cls._read_manifest_mtime(datadir)
+        by_assembly = {}
+        for species_dir in regulators.values():
+            for assembly, assembly_dir in species_dir.items():
+                for experiment in assembly_dir.values():
+                    experiment['file'] = os.path.join(
+                        os.path.abspath(tree), experiment['file'])
+                by_assembly.setdefault(assembly, {}).update(assembly_dir)
+
+        # Built aside and swapped in, as other threads look regulators up
+        # while refresh() reloads them
+        cls._regulators, cls._by_assembly = regulators, by_assembly
+        cls._datadir, cls._manifest_mtime = datadir, mtime
 
     @classmethod
     def all(cls):
         return cls._regulators
 
+    @classmethod
+    def _read_manifest_mtime(cls, datadir=None):
+        try:
+            return os.stat(os.path.join(datadir or cls._datadir, 'regulators',
+                                        MANIFEST)).st_mtime
+        except OSError:
+            return None
+
+    @classmethod
+    def refresh(cls):
+        """Reload the regulators when another process updated the manifest,
+        e.g. by ingesting a regulator
+
+        :return bool: whether the regulators were reloaded
+        """
+        if cls._datadir is None or \
+                cls._read_manifest_mtime() == cls._manifest_mtime:
+            return False
+        cls.init(cls._datadir)
+        return True
+
+    @classmethod
+    def ingest(cls, datadir, bedfile, jsonfile, assembly, species=None):
+        """Add one regulator file pair to the data directory.
+
+        The files are validated, copied next to the other regulators of the
+        assembly, sorted and indexed, then the manifest is updated in place.
+        Other assemblies are not rescanned, and processes using datadir find
+        the new regulators through refresh().
+
+        :param str datadir: path to genomes and regulators
+        :param str bedfile: BED file of the regulator sites
+        :param str jsonfile: experiment metadata, a list of objects with an
+            'id' for each regulator in bedfile
+        :param str assembly: assembly the sites belong to
+        :param str species: species directory, optional when assembly
+            already has regulators
+        :return list: ids of the ingested regulators
+        """
+        with cls._lock:
+            cls.init(datadir)
+            if species is None:
+                species = next((x for x, y in sorted(cls._regulators.items())
+                                if assembly in y), None)
+                if species is None:
+                    raise ValueError("Must provide species for new assembly: "
+                                     "%s" % assembly)
+
+            with open(jsonfile, encoding="utf-8") as fh:
+                experiments = json.load(fh)
+            if not isinstance(experiments, list) or not experiments or \
+                    not all(isinstance(x, dict) and x.get('id')
+                            for x in experiments):
+                raise ValueError("%s must hold a list of experiments with "
+                                 "ids" % jsonfile)
+            ids = [x['id'] for x in experiments]
+            known = cls._by_assembly.get(assembly, {})
+            duplicates = sorted(x for x in set(ids) if x in known or
+                                ids.count(x) > 1)
+            if duplicates:
+                raise ValueError("Regulators already exist in %s: %s" % (
+                    assembly, ", ".join(duplicates)))
+
+            chrom_sizes = None
+            genome_file = os.path.join(datadir, 'genomes', species, assembly,
+                                       '%s.genome' % assembly)
+            if os.path.isfile(genome_file):
+                chrom_sizes = read_chromsizes(genome_file)
+            record_names = validate_bed(bedfile, chrom_sizes)
+            empty = [x for x in ids if '_all' not in x and not any(
+                matches(x, name) for name in record_names)]
+            if empty:
+                raise ValueError("No sites in %s for: %s" % (
+                    bedfile, ", ".join(empty)))
+
+            directory = os.path.join(datadir, 'regulators', species, assembly)
+            basename = os.path.splitext(os.path.basename(jsonfile))[0]
+            target = os.path.join(directory, basename)
+            if os.path.exists(target + '.bed') or \
+                    os.path.exists(target + '.json'):
+                raise ValueError("Regulator file exists: %s" % target)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+
+            # The metadata is written last, a BED file without it is ignored
+            shutil.copyfile(bedfile, target + '.bed.tmp')
+            os.rename(target + '.bed.tmp', target + '.bed')
+            sort_record(target + '.bed')
+            cls.build_index(target + '.bed', ids)
+            with open(target + '.json.tmp', 'w', encoding="utf-8") as fh:
+                fh.write(json.dumps(experiments))
+            os.rename(target + '.json.tmp', target + '.json')
+
+            root = os.path.join(datadir, 'regulators')
+            entries = {}
+            for experiment in experiments:
+                entries[experiment['id']] = dict(
+                    experiment, file=os.path.relpath(target + '.json', root))
+            if DorinaUtils.update_manifest(root, species, assembly,
+                                           entries) is None:
+                log.info('Rebuilding the regulator manifest')
+            cls.init(datadir)
+            log.info('Ingested %s into %s' % (", ".join(ids), assembly))
+            return ids
+
+    @property
+    def bed(self):
+        """Regulator sites as a BedTool, built on first access"""
+        if self._bedtool is None:
+            self._bedtool = self._bed()
+        return self._bedtool
+
+    @property
+    def intervals(self):
+        """Regulator sites for the in-process engine, built on first access"""
+        if self._intervals is None:
+            self._intervals = self._load_intervals()
+        return self._intervals
+
+    def _indexed(self):
+        """Sites of the regulator from the index of its file, or None"""
+        if self.custom:
+            return None
+        index = IntervalIndex.open(self.path)
+        if index is None or self.name not in index:
+            return None
+        return index.intervals(self.name)
+
     def _bed(self):
-        def by_name(rec):
-            # Drop first part before underscore.
-            if "_" in self.name:
-                name = "_".join(self.name.split("_")[1:])
-            else:
-                name = self.name
-            return (name + "*" in rec.name) or (name == rec.name)
-
-        bt = BedTool(self.path)
+        intervals = self._indexed()
+        if intervals is not None:
+            # Index blocks are sorted BED6 already
+            return BedTool(create_interval_from_list(list(x))
+                           for x in intervals).saveas()
+
+        bt = BedTool(sorted_path(self.path))
         if not self.custom and '_all' not in self.name:
-            bt = bt.filter(by_name).saveas()
+            bt = bt.filter(lambda rec: matches(self.name, rec.name)).saveas()
 
         if len(bt) > 0 and len(bt[0].fields) > 6:
-            bt = bt.bed6().saveas()
+            # Split blocks no longer follow the order of their records
+            bt = bt.bed6().sort().saveas()
 
         return bt
 
+    def _load_intervals(self):
+        intervals = self._indexed()
+        if intervals is not None:
+            return intervals
+
+        intervals = Intervals.from_file(sorted_path(self.path))
+        if not self.custom and '_all' not in self.name:
+            intervals = intervals.filter(
+                lambda rec_name: matches(self.name, rec_name))
+
+        if intervals.field_count() > 6:
+            intervals = intervals.bed6().sort()
+
+        return intervals
+
+    @staticmethod
+    def build_index(bedfile, names):
+        """Write the persistent per-chromosome index of a regulator BED file
+
+        :param str bedfile: path to the regulator BED file
+        :param list names: ids of the regulators stored in bedfile
+        :return str: path to the index directory
+        """
+        intervals = Intervals.from_file(bedfile)
+        if intervals.field_count() > 6:
+            intervals = intervals.bed6()
+
+        record_names = intervals.names()
+        blocks = {}
+        for name in names:
+            if '_all' in name:
+                blocks[name] = range(len(intervals))
+                continue
+            hits = set(x for x in set(record_names) if matches(name, x))
+            blocks[name] = [i for i, x in enumerate(record_names) if x in hits]
+
+        return write_index(bedfile, intervals, blocks)
+
+    @classmethod
+    def build_indexes(cls):
+        """Index every regulator BED file of the data directory
+
+        :return list: paths to the index directories
+        """
+        bedfiles = {}
+        for species_dir in cls._regulators.values():
+            for assembly_dir in species_dir.values():
+                for name, experiment in assembly_dir.items():
+                    bedfile = os.path.splitext(experiment['file'])[0] + '.bed'
+                    bedfiles.setdefault(bedfile, []).append(name)
+
+        return [cls.build_index(bedfile, names)
+                for bedfile, names in sorted(bedfiles.items())]
+
     @staticmethod
     def merge(regulators):
-        """Merge a list of regulators using BedTool.cat"""
+        """Merge a list of sorted regulators using BedTool.cat or
+        Intervals.cat, sorting the result again"""
         if len(regulators) > 1:
-            return BedTool.cat(*regulators, postmerge=False)
+            return regulators[0].cat(*regulators[1:], postmerge=False).sort()
         else:
             return regulators[0]
 
+    @classmethod
+    def _experiment(cls, name, assembly):
+        """Metadata of a registered regulator, reloading the regulators once
+        when it is missing"""
+        experiment = cls._by_assembly.get(assembly, {}).get(name)
+        if experiment is None and cls.refresh():
+            experiment = cls._by_assembly.get(assembly, {}).get(name)
+        return experiment
+
+    @classmethod
+    def registered(cls, name, assembly):
+        """Whether name is the id of a regulator of assembly, not a path"""
+        return os.sep not in name and \
+            cls._experiment(name, assembly) is not None
+
     @classmethod
     def from_name(cls, name_or_path, assembly=None):
         if os.sep in name_or_path:
@@ -104,12 +372,9 @@ class Regulator(object):
             raise ValueError("Must provide assembly")
 
         filename = None
-        for species, species_dir in cls._regulators.items():
-            for _assembly, assembly_dir in species_dir.items():
-                if assembly == _assembly and name_or_path in assembly_dir:
-                    basename = \
-                    os.path.splitext(assembly_dir[name_or_path]['file'])[0]
-                    filename = basename + ".bed"
+        experiment = cls._experiment(name_or_path, assembly)
+        if experiment is not None:
+            filename = os.path.splitext(experiment['file'])[0] + ".bed"
 
         if not filename or not os.path.isfile(filename):
             raise ValueError("Could not find regulator: %s" % name_or_path)
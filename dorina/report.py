@@ -5,7 +5,12 @@ Created on 13:48 16/04/2018 2018
 This module contains a tools for ploting regulator .bed files distributed with
 Dorina.
 """
-import multiprocessing
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
 import numpy as np
@@ -15,24 +20,124 @@ from bokeh.layouts import gridplot
 from bokeh.models import ColumnDataSource, LabelSet
 from bokeh.plotting import figure, output_file, save
 
+from dorina.cache import fingerprint
+from dorina.fasta import FastaFile, gc_content
+from dorina.index import GeneTable
+from dorina.intervals import Intervals, overlap_counts
+
+log = logging.getLogger(__name__)
+
+# Feature tracks of a genome directory, in plotting order
+FEATURES = ('3_utr', '5_utr', 'cds', 'exon', 'intergenic', 'intron')
+# Total feature lengths, kept in the genome directory
+FEATURE_LENGTHS = '.feature_lengths.json'
+# Columns of the peak table, read from the first six BED fields
+COLUMNS = ('chrom', 'start', 'end', 'name', 'score', 'strand')
+PEAK_DTYPES = {'chrom': 'category', 'start': np.int64, 'end': np.int64,
+               'name': 'category', 'score': np.float64, 'strand': 'category'}
+
+
+class StageTimer(object):
+    """Wall clock time of the stages of a report"""
+
+    def __init__(self):
+        self.timings = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.time()
+        yield
+        self.timings[name] = time.time() - start
+        log.info('{}: {:.2f}s'.format(name, self.timings[name]))
+
+
+def _first_record(filename):
+    """Number of header and comment lines at the top of a BED file, and
+    the fields of its first record"""
+    count = 0
+    with open(filename) as fh:
+        for line in fh:
+            if line.strip() and \
+                    not line.startswith(('#', 'track', 'browser')):
+                return count, line.rstrip('\r\n').split('\t')
+            count += 1
+    return count, []
+
+
+def header_lines(filename):
+    """Number of header and comment lines at the top of a BED file"""
+    return _first_record(filename)[0]
+
+
+def load_peaks(target, regulator=None):
+    """Read the peaks of a BED file once into a columnar table.
+
+    Chromosome, name and strand are stored as categories and only the first
+    six fields are parsed, which keeps tens of millions of peaks in memory.
+    Files with fewer fields get an empty name, no score and no strand.
+
+    :param str target: BED file
+    :param str regulator: keep only the peaks whose name contains it
+    :return pandas.DataFrame: with the columns in COLUMNS
+    """
+    skip, fields = _first_record(target)
+    columns = list(COLUMNS[:min(max(len(fields), 3), len(COLUMNS))])
+    if fields:
+        table = pd.read_csv(target, sep='\t', header=None, names=columns,
+                            usecols=range(len(columns)), skiprows=skip,
+                            dtype=dict((x, PEAK_DTYPES[x]) for x in columns),
+                            keep_default_na=False,
+                            na_values={'score': ['.']})
+    else:
+        table = pd.DataFrame(dict((x, pd.Series(dtype=PEAK_DTYPES[x]))
+                                  for x in columns))
+    defaults = {'name': '', 'score': np.nan, 'strand': '.'}
+    for column in COLUMNS[len(columns):]:
+        table[column] = pd.Series(defaults[column], index=table.index,
+                                  dtype=PEAK_DTYPES[column])
+    if regulator:
+        names = table['name'].cat.categories
+        keep = names[names.str.contains(regulator, regex=False)]
+        table = table[table['name'].isin(keep)].reset_index(drop=True)
+        for column in ('chrom', 'name', 'strand'):
+            table[column] = table[column].cat.remove_unused_categories()
+    return table
+
 
-def filter_by_feature(feature, featuretype):
-    if feature[2] == featuretype:
-        return True
+def summarize(table):
+    """Aggregates of a peak table that need no other input
 
+    :return dict: score and length arrays, and the peak counts per
+        chromosome from the least to the most; peaks without a score are
+        left out of the scores
+    """
+    score = table['score'].to_numpy()
+    return {'score': score[~np.isnan(score)],
+            'length': (table['end'] - table['start']).to_numpy(),
+            'chrom': table['chrom'].value_counts(sort=False).sort_values()}
 
-def count_reads_in_features(bed, features_fn):
-    """Counts reads in features, loaded as pytbedtools obj"""
-    return bed.intersect(b=features_fn, stream=True).count()
 
+def get_sequences(table, fasta):
+    """Yield the sequences of the peaks in a table one at a time, in table
+    order, reverse complemented on the minus strand
 
-def get_sequences(bed, fasta):
-    """Extracts sequences from genomic regions as list"""
-    bed.sequence(fi=fasta, name=True, s=True)
-    with open(bed.seqfn) as f:
-        seq = f.readlines()
+    :param pandas.DataFrame table: peaks, see load_peaks()
+    :param str fasta: uncompressed genome FASTA file, indexed on first use
+    """
+    with FastaFile(fasta) as genome:
+        for sequence in genome.sequences(
+                table['chrom'].to_numpy(dtype=str), table['start'].to_numpy(),
+                table['end'].to_numpy(), table['strand'].to_numpy(dtype=str)):
+            yield sequence
 
-    return [x.rstrip() for x in seq if not x.startswith('>')]
+
+def peak_gc_content(table, fasta):
+    """GC content of every peak, without holding their sequences
+
+    :return: array of fractions, NaN for peaks without sequence
+    """
+    return np.fromiter((gc_content(x) for x in get_sequences(table, fasta)),
+                       dtype=np.float64, count=len(table))
 
 
 def plot_hist(values, logx=False, title=""):
@@ -78,12 +183,12 @@ def plot_vbar(values, title="counts", count=False, keys=None):
     counts['x_min'] = 0
     counts = ColumnDataSource(counts)
     p = figure(title=title, y_range=group, x_range=(0, x_max * 1.1),
-               plot_width=500, plot_height=750)
+               width=500, height=750)
     p.hbar(y="index", left='x_min', right='x_max', height=0.5,
            source=counts, fill_color="#036564", line_color="#036564")
     labels = LabelSet(x='x_max', y="index", text='x_max',
                       level='glyph', x_offset=5, y_offset=-7.5,
-                      source=counts, render_mode='canvas',
+                      source=counts,
                       text_font='helvetica', text_font_size='9pt')
     p.add_layout(labels)
     p.toolbar.active_drag = None
@@ -100,103 +205,264 @@ def plot_vbar(values, title="counts", count=False, keys=None):
     return p
 
 
-def add_chr(entry):
-    entry.chrom = 'chr' + entry.chrom
-
-    return entry
-
-
-def plot_chr_counts(assembly, dataframe):
+def plot_chr_counts(assembly, counts):
+    """
+    :param pandas.Series counts: peaks per chromosome, see summarize()
+    """
     chr_size = pybedtools.chromsizes(assembly)
     chromsizes = {k: chr_size[k][1] - chr_size[k][0] for k in chr_size}
 
-    keys = dataframe['chrom'].value_counts(
-    ).sort_values(ascending=True).index.tolist()
+    keys = counts.sort_values(ascending=True).index.tolist()
     return gridplot([[
-        plot_vbar(pd.Series(dataframe['chrom']), count=True, keys=keys,
-                  title='Counts per chromossome'),
+        plot_vbar(counts, keys=keys, title='Counts per chromossome'),
         plot_vbar(pd.Series(chromsizes), keys=keys,
                   title=assembly + ' Chromossome size')]])
 
 
-def plot_feat_counts(bt, datadir, n_proc=1):
-    def count_reads_in_features_this(feat):
-        return count_reads_in_features(bt, features_fn=feat)
+def feature_path(datadir, feature):
+    """Path to the GFF or BED track of a feature, None when missing"""
+    for ext in ('.gff', '.bed'):
+        filename = os.path.join(datadir, feature + ext)
+        if os.path.isfile(filename):
+            return filename
+    return None
+
+
+def read_coordinates(filename):
+    """Chromosomes and zero-based, half-open coordinates of a BED or GFF file
+
+    Only the first columns are parsed, which is much faster than building
+    full records for large feature tracks.
+
+    :return tuple: chromosome, start and end arrays
+    """
+    gff = os.path.splitext(filename)[1] in ('.gff', '.gff3', '.gtf')
+    columns = [0, 3, 4] if gff else [0, 1, 2]
+    # BED names may hold a '#', GFF files may have comments between records
+    df = pd.read_csv(filename, sep='\t', header=None,
+                     comment='#' if gff else None,
+                     skiprows=0 if gff else header_lines(filename),
+                     usecols=columns, dtype={columns[0]: str,
+                                             columns[1]: np.int64,
+                                             columns[2]: np.int64})
+    starts = df[columns[1]].to_numpy()
+    if gff:
+        starts = starts - 1
+    return (df[columns[0]].to_numpy(dtype=str), starts,
+            df[columns[2]].to_numpy())
+
+
+def peak_coordinates(bt):
+    """Coordinate arrays of peaks given as a table, Intervals, BedTool or
+    file name"""
+    if isinstance(bt, pd.DataFrame):
+        return (bt['chrom'].to_numpy(dtype=str), bt['start'].to_numpy(),
+                bt['end'].to_numpy())
+    if isinstance(bt, Intervals):
+        return bt.chroms.astype(str), bt.starts, bt.ends
+    return read_coordinates(getattr(bt, 'fn', bt))
+
+
+def _by_chrom(chroms, *columns):
+    """Split coordinate columns by chromosome"""
+    order = np.argsort(chroms, kind='stable')
+    chroms = chroms[order]
+    columns = [x[order] for x in columns]
+    names, first = np.unique(chroms, return_index=True)
+    last = np.append(first[1:], len(chroms))
+    return dict((name, [x[lo:hi] for x in columns])
+                for name, lo, hi in zip(names, first, last))
+
+
+def count_overlaps(peaks, chroms, starts, ends):
+    """Number of overlapping peak/feature pairs, as the line count of
+    ``bedtools intersect`` is
+
+    :param dict peaks: chromosome to start and end arrays, see _by_chrom()
+    :return int: overlapping pairs
+    """
+    total = 0
+    for chrom, (b_starts, b_ends) in _by_chrom(chroms, starts, ends).items():
+        if chrom in peaks:
+            total += int(overlap_counts(peaks[chrom][0], peaks[chrom][1],
+                                        np.sort(b_starts),
+                                        np.sort(b_ends)).sum())
+    return total
+
+
+def _feature_counts(peaks, filename):
+    """Peaks in one feature track, run by the workers"""
+    return count_overlaps(peaks, *read_coordinates(filename))
+
+
+def _tracks(datadir):
+    """Feature names and paths of the tracks present in datadir"""
+    tracks = []
+    for feature in FEATURES:
+        filename = feature_path(datadir, feature)
+        if filename is None:
+            log.warning('No {} track in {}'.format(feature, datadir))
+        else:
+            tracks.append((feature, filename))
+    return tracks
+
+
+def _read_lengths(datadir):
+    try:
+        with open(os.path.join(datadir, FEATURE_LENGTHS)) as fh:
+            return json.load(fh)
+    except (IOError, ValueError):
+        return {}
+
+
+def _store_lengths(datadir, lengths, stored):
+    """Write the feature lengths when they changed; a read-only genome
+    directory only loses the cache"""
+    if lengths == stored:
+        return
+    filename = os.path.join(datadir, FEATURE_LENGTHS)
+    try:
+        with open(filename + '.tmp', 'w') as fh:
+            fh.write(json.dumps(lengths))
+        os.rename(filename + '.tmp', filename)
+    except (IOError, OSError) as e:
+        log.debug('Unable to write feature lengths {}: {}'.format(filename, e))
+
+
+def feature_lengths(datadir, tracks=None):
+    """Total length of every feature track of a genome directory, computed
+    once and kept in datadir until a track changes
+
+    :param list tracks: feature names and paths, see _tracks()
+    :return pandas.Series: lengths indexed by feature
+    """
+    stored = _read_lengths(datadir)
+    lengths = dict(stored)
+    if tracks is None:
+        tracks = _tracks(datadir)
+    for feature, filename in tracks:
+        source = fingerprint(filename)[1:]
+        if lengths.get(feature, {}).get('source') != source:
+            _, starts, ends = read_coordinates(filename)
+            lengths[feature] = {'source': source,
+                                'length': int((ends - starts).sum())}
+    _store_lengths(datadir, lengths, stored)
+    return pd.Series([lengths[x]['length'] for x, _ in tracks],
+                     [x for x, _ in tracks], dtype=np.int64)
+
+
+def feature_stats(bt, datadir, n_proc=1):
+    """Count the peaks in every feature track of a genome directory
+
+    Each track is read by one of n_proc processes. The lengths come from
+    feature_lengths(), so they are only measured when a track changed.
+
+    :param bt: peaks as a table, Intervals, BedTool or file name
+    :param str datadir: genome directory with the feature tracks
+    :param int n_proc: worker processes
+    :return tuple: pandas Series of the counts and of the lengths, indexed
+        by feature; missing tracks are left out
+    """
+    tracks = _tracks(datadir)
+    lengths = feature_lengths(datadir, tracks)
+    peaks = _by_chrom(*peak_coordinates(bt))
+    filenames = [x for _, x in tracks]
+    if n_proc > 1 and len(tracks) > 1:
+        with ProcessPoolExecutor(max_workers=n_proc) as executor:
+            counts = list(executor.map(_feature_counts,
+                                       [peaks] * len(tracks), filenames))
+    else:
+        counts = [_feature_counts(peaks, x) for x in filenames]
 
-    def total_feature_length(bed_obj):
-        df = bed_obj.to_dataframe()
-        return sum(df['end'] - df['start'])
+    names = [x for x, _ in tracks]
+    return pd.Series(counts, names, dtype=np.int64), lengths
 
-    t_utr = pybedtools.BedTool(datadir + '/3_utr.gff')
-    f_utr = pybedtools.BedTool(datadir + '/5_utr.gff')
-    cds = pybedtools.BedTool(datadir + '/cds.gff')
-    exon = pybedtools.BedTool(datadir + '/exon.gff')
-    intergenic = pybedtools.BedTool(datadir + '/intergenic.bed')
-    intron = pybedtools.BedTool(datadir + '/intron.gff')
 
-    features = (t_utr, f_utr, cds, exon, intergenic, intron)
-    feat_names = '3_utr 5_utr cds exon intergenic intron'.split()
+def plot_feat_counts(bt, datadir, n_proc=1):
+    counts_per_feature, features_length = feature_stats(bt, datadir, n_proc)
 
-    with multiprocessing.Pool(processes=n_proc) as pool:
-        results = pool.map(count_reads_in_features_this, features)
+    return gridplot([[
+        plot_vbar(counts_per_feature, title='Peaks per feature'),
+        plot_vbar(features_length, title='Feature length')]])
 
-    with multiprocessing.Pool(processes=n_proc) as pool:
-        features_length = pool.map(total_feature_length, features)
 
-    counts_per_feature = pd.Series(results, feat_names)
+def biotype_counts(bt, ensembl_gtf):
+    """Genes per biotype, among those overlapping peaks and overall
 
-    features_length = pd.Series(features_length, feat_names)
+    The genes of the GTF file are read once into a gene table kept next to
+    it, see dorina.index.GeneTable.
 
-    return gridplot([[
-        plot_vbar(counts_per_feature, title='Peaks per feature'),
-        plot_vbar(features_length, title='Feature length')]])
+    :param bt: peaks as a table, Intervals, BedTool or file name
+    :param str ensembl_gtf: Ensembl GTF file
+    :return tuple: pandas Series of the overlapping and of all genes, by
+        biotype, for the biotypes with overlapping genes
+    """
+    genes = GeneTable.load(ensembl_gtf)
+    peaks = _by_chrom(*peak_coordinates(bt))
+    hits, totals = genes.biotype_counts(peaks)
+    hits = pd.Series(dict((x, y) for x, y in hits.items() if y),
+                     dtype=np.int64).sort_values()
+    return hits, pd.Series(totals, dtype=np.int64)[hits.index]
 
 
 def plot_biotype_counts(bt, ensembl_gtf):
-    bt_gtf = pybedtools.BedTool(
-        ensembl_gtf) \
-        .filter(filter_by_feature, 'gene') \
-        .each(add_chr) \
-        .saveas()
-    biotype_result = bt_gtf.intersect(bt, wa=True, wb=True)
-
-    reg_type = {x['gene_id']: x.attrs['gene_biotype'] for x in biotype_result}
-    gene_type = {x['gene_id']: x.attrs['gene_biotype'] for x in bt_gtf}
-    reg_type = pd.Series(list(reg_type.values()))
+    reg_type, gene_type = biotype_counts(bt, ensembl_gtf)
+    keys = reg_type.index.tolist()
 
     return gridplot([[
-        plot_vbar(reg_type.value_counts(), keys=list(reg_type.unique()),
-                  title='Counts per biotype'),
-        plot_vbar(pd.Series(list(gene_type.values())), count=True,
-                  keys=list(reg_type.unique()), title='Total')]])
+        plot_vbar(reg_type, keys=keys, title='Counts per biotype'),
+        plot_vbar(gene_type, keys=keys, title='Total')]])
 
 
 def main(target, regulator=None, fasta=None, output_dir=None,
          assembly='hg38', datadir=None, n_proc=1, ensembl_gtf=None):
+    """Write the report plots of a BED file.
+
+    The peaks are read once into a table that every plot is computed from.
+
+    :return int: 0
+    """
     if output_dir is None:
         output_dir = Path.cwd()
+    output_dir = Path(output_dir)
+    timer = StageTimer()
 
-    bt = pybedtools.BedTool(target)
-    if regulator:
-        bt = bt.filter(lambda x: regulator in x.name).saveas()
-
-    df = bt.to_dataframe()
+    with timer.stage('load'):
+        table = load_peaks(target, regulator)
+        log.info('{} peaks'.format(len(table)))
     if fasta:
-        df['seq'] = get_sequences(bt, fasta=fasta)
-
-    output_file(str(output_dir / 'score_dist.html'))
-    save(plot_hist(df['score'], logx=True, title='Score'))
+        with timer.stage('sequences'):
+            gc = peak_gc_content(table, fasta)
+            output_file(str(output_dir / 'gc_content.html'))
+            save(plot_hist(gc[~np.isnan(gc)], title='GC content'))
+
+    with timer.stage('summary'):
+        summary = summarize(table)
+
+    if len(summary['score']):
+        with timer.stage('score'):
+            output_file(str(output_dir / 'score_dist.html'))
+            save(plot_hist(summary['score'], logx=True, title='Score'))
+    else:
+        log.info('No peak scores, skipping the score distribution')
 
-    output_file(str(output_dir / 'peak_length.html'))
-    save(plot_hist(df['end'] - df['start'], title='Peak length'))
+    with timer.stage('length'):
+        output_file(str(output_dir / 'peak_length.html'))
+        save(plot_hist(summary['length'], title='Peak length'))
 
-    output_file(str(output_dir / 'count_per_chr.html'))
-    save(plot_chr_counts(assembly, df))
+    with timer.stage('chromosomes'):
+        output_file(str(output_dir / 'count_per_chr.html'))
+        save(plot_chr_counts(assembly, summary['chrom']))
 
-    output_file(str(output_dir / 'count_per_feature.html'))
-    save(plot_feat_counts(bt, datadir, n_proc=n_proc))
+    if datadir:
+        with timer.stage('features'):
+            output_file(str(output_dir / 'count_per_feature.html'))
+            save(plot_feat_counts(table, datadir, n_proc=n_proc))
 
-    output_file(str(output_dir / 'count_per_biotype.html'))
-    save(plot_biotype_counts(bt, ensembl_gtf))
+    if ensembl_gtf:
+        with timer.stage('biotypes'):
+            output_file(str(output_dir / 'count_per_biotype.html'))
+            save(plot_biotype_counts(table, ensembl_gtf))
 
+    log.info('Report done in {:.2f}s'.format(sum(timer.timings.values())))
     return 0
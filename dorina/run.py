@@ -1,74 +1,380 @@
 #!/usr/bin/env python
 # -*- coding: utf-8
 from __future__ import unicode_literals
+import itertools
 import logging
-import functools
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from os import path
 
-from pybedtools import BedTool
+import numpy as np
+from pybedtools import BedTool, create_interval_from_list
 
+from dorina import __version__
+from dorina.cache import LRUCache, ResultCache, fingerprint, mtime
 from dorina.genome import Genome
+from dorina.index import GeneIndex, TrackIndex
+from dorina.intervals import Intervals
+from dorina.output import records
 from dorina.regulator import Regulator
+from dorina.sorting import sorted_path
+
+BACKENDS = ('bedtools', 'native')
+MATCHES = ('any', 'all', 'atleast')
+REGIONS = {"any": "all",
+           "CDS": "cds",
+           "3prime": "3_utr",
+           "5prime": "5_utr",
+           "intron": "intron",
+           "intergenic": "intergenic"}
+# analyse() keyword arguments accepted in batch queries, with defaults
+QUERY_KEYS = OrderedDict([('set_a', None), ('match_a', 'any'),
+                          ('region_a', 'any'), ('set_b', None),
+                          ('match_b', 'any'), ('region_b', 'any'),
+                          ('combine', 'or'), ('genes', None),
+                          ('window_a', -1), ('window_b', -1),
+                          ('minmatch_a', 1), ('minmatch_b', 1)])
+
+
+def read_track(filename):
+    """Memory-map the columnar store of a GFF track when it is up to date,
+    parse the text file otherwise"""
+    track = TrackIndex.open(filename)
+    if track is not None:
+        return track.intervals()
+    return Intervals.from_file(filename)
 
 
 class Dorina(object):
-    def __init__(self, datadir):
+    def __init__(self, datadir, backend='bedtools', cache_size=2 ** 30,
+                 jobs=1, result_cache=None):
+        """
+        :param str datadir: path to genomes and regulators
+        :param str backend: 'bedtools' to run every step through pybedtools,
+            'native' to use the in-process NumPy interval engine
+        :param int cache_size: bytes of parsed regulators and genome tracks
+            kept between analyse calls
+        :param int jobs: worker processes; with more than one, set A and set
+            B are computed concurrently and the native backend sweeps the
+            chromosomes of each intersection in parallel
+        :param ResultCache result_cache: on-disk cache of whole results,
+            looked up before each analysis; None to always compute
+        """
+        if backend not in BACKENDS:
+            raise ValueError("Invalid backend: %r" % backend)
+        if jobs < 1:
+            raise ValueError("Invalid number of jobs: %r" % jobs)
+        self.backend = backend
+        self.cache = LRUCache(cache_size)
+        self.results = result_cache
+        self.jobs = jobs
+        self._processes = None
+        self._threads = None
+        if jobs > 1:
+            self._threads = ThreadPoolExecutor(max_workers=2)
+            if backend == 'native':
+                self._processes = ProcessPoolExecutor(max_workers=jobs)
         Genome.init(datadir)
         Regulator.init(datadir)
 
+    def close(self):
+        """Shut down the worker pools, if any were started, and write the
+        result cache counters"""
+        for pool in (self._processes, self._threads):
+            if pool is not None:
+                pool.shutdown()
+        self._processes = None
+        self._threads = None
+        if self.results is not None:
+            self.results.close()
+
+    def preload(self, genome_name):
+        """Load the region tracks of a genome into the cache"""
+        for region in REGIONS:
+            self._get_genome(genome_name, region)
+
+    def _intersect(self, a, b, **kwargs):
+        """Intersect two sorted sets with a chromosome sweep, splitting the
+        chromosomes over the worker pool"""
+        kwargs['sorted'] = True
+        if self._processes is not None:
+            kwargs['executor'] = self._processes
+        return a.intersect(b, **kwargs)
+
     def analyse(self, genome,
                 set_a, match_a='any', region_a='any',
                 set_b=None, match_b='any', region_b='any',
                 combine='or', genes=None,
                 window_a=-1,
-                window_b=-1):
-        """Run doRiNA analysis"""
+                window_b=-1,
+                minmatch_a=1,
+                minmatch_b=1):
+        """Run doRiNA analysis
+
+        A set matches a feature when 'any' or 'all' of its regulators
+        overlap it, or with match 'atleast', when at least minmatch of them
+        do.
+        """
+        args = dict(set_a=set_a, match_a=match_a, region_a=region_a,
+                    set_b=set_b, match_b=match_b, region_b=region_b,
+                    combine=combine, genes=genes, window_a=window_a,
+                    window_b=window_b, minmatch_a=minmatch_a,
+                    minmatch_b=minmatch_b)
+        return self._cached(genome, args,
+                            lambda: self._analyse(genome, shared={}, **args))
+
+    def analyse_batch(self, genome, queries):
+        """Run many doRiNA analyses against one genome.
+
+        Region tracks and regulators are loaded once, and the result of a
+        set (regulators, match, region, window and genes) is shared by every
+        query using it.
+
+        :param str genome: assembly name
+        :param queries: iterable of dicts with analyse() keyword arguments
+        :return: generator yielding one result per query, in order
+        """
+        shared = {}
+        for query in queries:
+            unknown = set(query) - set(QUERY_KEYS)
+            if unknown:
+                raise ValueError("Invalid query keys: %s" %
+                                 ", ".join(sorted(unknown)))
+            if 'set_a' not in query:
+                raise ValueError("Query without set_a: %r" % (query, ))
+            args = dict(QUERY_KEYS)
+            args.update(query)
+            yield self._cached(
+                genome, args,
+                lambda: self._analyse(genome, shared=shared, **args))
+
+    def result_key(self, genome, args):
+        """Digest identifying the result of a query in the result cache
+
+        The query is normalized, so spellings of the same query share their
+        entry, and the size and modification time of every file it reads is
+        included, so changed data is never served from the cache. Regulator
+        order is kept: the first regulator anchors windowed searches and
+        the order of the hits of each feature follows the sets.
+
+        :param str genome: assembly name
+        :param dict args: complete analyse() keyword arguments
+        :return str: hex digest
+        """
+        query = {'version': __version__, 'genome': genome,
+                 'backend': self.backend}
+        files = set()
+        for x in ('a', 'b') if args['set_b'] else ('a', ):
+            names, match = args['set_' + x], args['match_' + x]
+            window = max(args['window_' + x], -1)
+            query['set_' + x] = {
+                'regulators': list(names), 'match': match,
+                'region': args['region_' + x], 'window': window,
+                'minmatch': args['minmatch_' + x]
+                if match == 'atleast' else None}
+            files.update(Regulator.from_name(name, genome).path
+                         for name in names)
+            files.add(self._track_path(genome, args['region_' + x]))
+            if window > 0:
+                files.add(path.join(Genome.path_by_name(genome),
+                                    "{}.genome".format(genome)))
+        if args['set_b']:
+            query['combine'] = args['combine']
+        genes = args['genes']
+        query['genes'] = None if not genes or 'all' in genes else sorted(
+            set(genes))
+        query['files'] = [fingerprint(x) for x in sorted(files)]
+        return ResultCache.key(query)
+
+    def _cached(self, genome, args, compute):
+        """Serve a result from the result cache, computing and storing it
+        on a miss"""
+        if self.results is None:
+            return compute()
+        key = self.result_key(genome, args)
+        cached = self.results.get(key)
+        if cached is not None:
+            return self._from_records(cached)
+        result = compute()
+        self.results.put(key, records(result))
+        return result
+
+    def _from_records(self, cached):
+        """Result of the configured backend holding cached records"""
+        if self.backend == 'bedtools':
+            return BedTool(''.join('\t'.join(x) + '\n' for x in cached),
+                           from_string=True)
+        return Intervals.from_rows(cached)
+
+    def _analyse(self, genome, set_a, match_a, region_a, set_b, match_b,
+                 region_b, combine, genes, window_a, window_b, minmatch_a,
+                 minmatch_b, shared):
         logging.debug("analyse(%r, %r(%s) <-'%s'-> %r(%s))" % (
             genome, set_a, match_a, combine, set_b, match_b))
+        for match, minmatch in ((match_a, minmatch_a), (match_b, minmatch_b)):
+            if match not in MATCHES:
+                raise ValueError("Invalid match: %r" % match)
+            if minmatch < 1:
+                raise ValueError("Invalid minmatch: %r" % minmatch)
+
+        regulators_a = self._get_regulators(set_a, genome)
+        regulators_b = self._get_regulators(set_b, genome)
+        all_regulators = regulators_a + regulators_b
 
-        def compute_result(region, regulators, match, window):
-            genome_bed = self._get_genome_bedtool(genome, region, genes)
+        def compute_result(region, counted, match, window, minmatch):
+            genome_bed = self._get_genome(genome, region, genes)
 
             # create local copy so we can mangle it
-            _regulators = regulators[:]
+            _regulators = all_regulators[counted]
             if window > -1:
                 initial = _regulators.pop(0)
-                genome_bed = genome_bed.intersect(initial)
+                counted = slice(counted.start + 1, counted.stop)
+                # The overlapping parts are not in start order any more
+                genome_bed = self._intersect(genome_bed, initial).sort()
                 if window > 0:
                     genome_bed = self._add_slop(genome_bed, genome, window)
 
             if match == 'any':
-                result = genome_bed.intersect(Regulator.merge(_regulators), wa=True, u=True)
+                minimum = 1
             elif match == 'all':
-                result = functools.reduce(lambda acc, x: acc.intersect(x, wa=True, u=True),
-                                [genome_bed] + _regulators)
+                minimum = len(_regulators)
             else:
-                result = None
-            return result
+                # The window already holds the initial regulator
+                minimum = minmatch - 1 if window > -1 else minmatch
+
+            return self._match(genome_bed, all_regulators, counted, minimum)
+
+        def shared_result(names, counted, region, match, window, minmatch):
+            key = (tuple(names), region, match, window,
+                   minmatch if match == 'atleast' else None,
+                   tuple(genes) if genes else None)
+            if self.backend == 'native':
+                # Results carry the hits of every regulator of the query
+                key += (tuple(set_a) + tuple(set_b or ()), counted.start)
+            if key not in shared:
+                shared[key] = compute_result(region, counted, match, window,
+                                             minmatch)
+            return shared[key]
 
-        regulators_a = Regulator.from_names(set_a, assembly=genome)
-        regulators_b = Regulator.from_names(set_b, assembly=genome)
-        all_regulators = Regulator.merge(regulators_a + regulators_b)
+        counted_a = slice(0, len(regulators_a))
+        counted_b = slice(len(regulators_a), len(all_regulators))
 
-        result_a = compute_result(region_a, regulators_a, match_a, window_a)
+        # Compute set B alongside set A when a worker pool is available
+        if set_b and self._threads is not None:
+            future_b = self._threads.submit(
+                shared_result, set_b, counted_b, region_b, match_b,
+                window_b, minmatch_b)
+        result_a = shared_result(set_a, counted_a, region_a, match_a,
+                                 window_a, minmatch_a)
 
         # Combine with set B, if exists
         if set_b:
-            result_b = compute_result(region_b, regulators_b, match_b, window_b)
+            if self._threads is not None:
+                result_b = future_b.result()
+            else:
+                result_b = shared_result(set_b, counted_b, region_b,
+                                         match_b, window_b, minmatch_b)
             if combine == 'or':
                 combined = Regulator.merge([result_a, result_b])
             elif combine == 'and':
-                combined = result_a.intersect(result_b, wa=True, u=True)
+                combined = self._intersect(result_a, result_b, wa=True, u=True)
             elif combine == 'xor':
-                not_in_b = result_a.intersect(result_b, v=True, wa=True)
-                not_in_a = result_b.intersect(result_a, v=True, wa=True)
+                not_in_b = self._intersect(result_a, result_b, v=True, wa=True)
+                not_in_a = self._intersect(result_b, result_a, v=True, wa=True)
                 combined = Regulator.merge([not_in_b, not_in_a])
             elif combine == 'not':
-                combined = result_a.intersect(result_b, v=True, wa=True)
+                combined = self._intersect(result_a, result_b, v=True, wa=True)
         else:
             combined = result_a
 
-        return combined.intersect(all_regulators, wa=True, wb=True)
+        return self._annotate(combined, all_regulators)
+
+    def _match(self, features, regulators, counted, minimum):
+        """Features overlapped by at least minimum of the counted regulators.
+
+        The distinct regulators overlapping each feature are counted in a
+        single sweep over all of them, instead of one intersection per
+        regulator. The native backend sweeps every regulator of the query
+        and keeps the hits with the features, for _annotate().
+
+        :param features: genome features
+        :param list regulators: all regulators of the query
+        :param slice counted: the regulators of the set being matched
+        :param int minimum: number of counted regulators that must overlap
+        """
+        if self.backend == 'native':
+            if counted.start >= counted.stop:
+                # Nothing left to match, e.g. a window around one regulator
+                minimum = 0
+            a_hits, tags, local = features.tagged_overlaps(regulators,
+                                                           self._processes)
+            own = (tags >= counted.start) & (tags < counted.stop)
+            pairs = np.unique(a_hits[own] * len(regulators) + tags[own])
+            counts = np.bincount(pairs // len(regulators),
+                                 minlength=len(features))
+            keep = np.flatnonzero(counts >= minimum)
+            result = features.take(keep)
+            # Regulator rows are built for the hits of kept features only,
+            # fetching them from each regulator at once
+            kept = np.flatnonzero(counts[a_hits] >= minimum)
+            kept_tags, kept_local = tags[kept], local[kept]
+            rows = [None] * len(kept)
+            for tag in np.unique(kept_tags):
+                at = np.flatnonzero(kept_tags == tag)
+                fetched = regulators[tag].take(kept_local[at]).rows
+                for j, row in zip(at.tolist(), fetched):
+                    rows[j] = row
+            sizes = np.bincount(a_hits, minlength=len(features))[keep]
+            bounds = np.concatenate([[0], np.cumsum(sizes)]).tolist()
+            result.hits = [rows[lo:hi]
+                           for lo, hi in zip(bounds[:-1], bounds[1:])]
+            return result
+
+        regulators = regulators[counted]
+        if not regulators or minimum < 1:
+            return features
+        files = [x.fn for x in regulators]
+        if minimum == 1:
+            return features.intersect(b=files, wa=True, u=True, sorted=True)
+
+        # With several -b files, each hit is labelled with its file
+        n_fields = features.field_count()
+        hits = features.intersect(b=files, names=list(range(len(files))),
+                                  wa=True, wb=True, sorted=True)
+        return BedTool(
+            create_interval_from_list(list(feature))
+            for feature, group in itertools.groupby(
+                hits, key=lambda x: tuple(x.fields[:n_fields]))
+            if len(set(x.fields[n_fields] for x in group)) >= minimum
+        ).saveas()
+
+    def _annotate(self, features, regulators):
+        """Join features with every regulator of the query overlapping them
+
+        Regulator records are truncated to the fields all regulators have,
+        as BedTool.cat would.
+        """
+        n_regulator = min([x.field_count() for x in regulators
+                           if len(x)] or [0])
+        if self.backend == 'native':
+            joined = features.with_hits()
+            n_fields = features.field_count() + n_regulator
+            if any(len(x) != n_fields for x in joined.rows):
+                joined = Intervals([x[:n_fields] for x in joined.rows],
+                                   joined.file_type)
+            return joined
+
+        if len(regulators) == 1:
+            return self._intersect(features, regulators[0], wa=True, wb=True)
+        # Drop the label bedtools adds to hits when given several -b files
+        n_fields = features.field_count()
+        hits = features.intersect(b=[x.fn for x in regulators],
+                                  wa=True, wb=True, sorted=True)
+        return BedTool(
+            create_interval_from_list(
+                x.fields[:n_fields] +
+                x.fields[n_fields + 1:n_fields + 1 + n_regulator])
+            for x in hits).saveas()
 
     def _add_slop(self, feature, genome_name, slop):
         """Add specified slop before and after a regulator"""
@@ -76,23 +382,67 @@ class Dorina(object):
         chromfile = path.join(genome, "{}.genome".format(genome_name))
         return feature.slop(g=chromfile, b=slop)
 
+    def _get_regulators(self, names, genome_name):
+        """Load the regulators of a set for the configured backend"""
+        return [self._get_regulator(x, genome_name) for x in names or []]
+
+    def _get_regulator(self, name, genome_name):
+        """Load a single regulator through the cache"""
+        regulator = Regulator.from_name(name, genome_name)
+        key = (genome_name, name, self.backend, mtime(regulator.path))
+        if self.backend == 'bedtools':
+            return self.cache.get(key, lambda: regulator.bed)
+        return self.cache.get(key, lambda: regulator.intervals)
+
+    def _get_genome(self, genome_name, region, genes=None):
+        """Load a genome region track for the configured backend"""
+        if self.backend == 'bedtools':
+            return self._get_genome_bedtool(genome_name, region, genes)
+        return self._get_genome_intervals(genome_name, region, genes)
+
+    def _track_path(self, genome_name, region):
+        if region not in REGIONS:
+            raise ValueError("Invalid region: %r" % region)
+        return sorted_path(path.join(Genome.path_by_name(genome_name),
+                                     "%s.gff" % REGIONS[region]))
+
+    def _get_track(self, genome_name, region, loader):
+        """Load the unfiltered track of a region through the cache"""
+        filename = self._track_path(genome_name, region)
+        key = (genome_name, region, self.backend, mtime(filename))
+        return self.cache.get(key, lambda: loader(filename))
+
     def _get_genome_bedtool(self, genome_name, region, genes=None):
         """get the bedtool object for a genome depending on the name and the region"""
-        genome = Genome.path_by_name(genome_name)
-        mapping = {"any": "all",
-                   "CDS": "cds",
-                   "3prime": "3_utr",
-                   "5prime": "5_utr",
-                   "intron": "intron",
-                   "intergenic": "intergenic"}
-
-        if region not in mapping:
-            raise ValueError("Invalid region: %r" % region)
-        else:
-            bed = BedTool(path.join(genome, "%s.gff" % mapping[region]))
+        if genes is not None and 'all' not in genes:
+            # Read only the records of the genes when an index exists
+            filename = self._track_path(genome_name, region)
+            gene_index = GeneIndex.open(filename)
+            if gene_index is not None:
+                # Filtered by name too, which writes the attributes the way
+                # the filter below does
+                names = set(genes)
+                return BedTool(
+                    create_interval_from_list(x.split('\t'))
+                    for x in gene_index.read(filename, genes)).filter(
+                    lambda x: x.name in names).saveas()
+
+        bed = self._get_track(genome_name, region, BedTool)
 
         # Optionally, filter by gene.
         if genes is None or 'all' in genes:
             return bed
         else:
             return bed.filter(lambda x: x.name in genes).saveas()
+
+    def _get_genome_intervals(self, genome_name, region, genes=None):
+        """get the interval set for a genome depending on the name and the region"""
+        intervals = self._get_track(genome_name, region, read_track)
+        if genes is None or 'all' in genes:
+            return intervals
+
+        gene_index = GeneIndex.open(self._track_path(genome_name, region))
+        if gene_index is not None:
+            return intervals.take(gene_index.rows(genes))
+        genes = set(genes)
+        return intervals.filter(lambda x: x in genes)
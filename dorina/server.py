@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+"""
+Asynchronous HTTP query service around Dorina.analyse().
+
+The service keeps one Dorina instance, and so its cache of parsed genome
+tracks and regulators, for its whole lifetime. Queries run in a worker pool
+off the event loop; identical queries arriving while one is computed wait
+for that computation instead of starting their own. Once the workers and a
+bounded backlog are taken new queries are refused, and a queued query whose
+requests all timed out is dropped before it starts.
+
+Endpoints:
+
+    POST /analyse   JSON object with 'genome' and analyse() keyword
+                    arguments; answers with the hits as tab separated text
+    GET  /stats     JSON counters of the service and the cache
+
+Only the standard library is used, with one request per connection.
+"""
+from __future__ import unicode_literals
+import asyncio
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from dorina.output import records
+from dorina.regulator import Regulator
+from dorina.run import QUERY_KEYS
+
+log = logging.getLogger(__name__)
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+           405: 'Method Not Allowed', 500: 'Internal Server Error',
+           503: 'Service Unavailable', 504: 'Gateway Timeout'}
+
+
+class Busy(Exception):
+    """Raised when all workers and the backlog are taken"""
+
+
+class InvalidQuery(ValueError):
+    """Raised for queries rejected before they run"""
+
+
+def normalize(query):
+    """Validate a query and fill in the analyse() defaults
+
+    :param dict query: 'genome' and analyse() keyword arguments
+    :return tuple: genome, complete keyword arguments and the key shared by
+        identical queries
+    :raises InvalidQuery: for unknown keys and for sets that are not lists
+        of regulator ids of the genome; custom regulator files are refused
+    """
+    if not isinstance(query, dict):
+        raise InvalidQuery("Query must be a JSON object")
+    unknown = set(query) - set(QUERY_KEYS) - set(['genome'])
+    if unknown:
+        raise InvalidQuery("Invalid query keys: %s" %
+                           ", ".join(sorted(unknown)))
+    if not query.get('genome') or not isinstance(query['genome'], str) or \
+            not query.get('set_a'):
+        raise InvalidQuery("Query needs genome and set_a")
+    for key in ('set_a', 'set_b'):
+        names = query.get(key) or []
+        if not isinstance(names, list) or not all(
+                isinstance(x, str) and Regulator.registered(x, query['genome'])
+                for x in names):
+            raise InvalidQuery("%s must list regulators of %s" % (
+                key, query['genome']))
+    args = dict(QUERY_KEYS)
+    args.update((k, v) for k, v in query.items() if k != 'genome')
+    key = json.dumps([query['genome'], args], sort_keys=True)
+    return query['genome'], args, key
+
+
+class QueryService(object):
+    """Run analyse() queries for concurrent clients"""
+
+    def __init__(self, dorina, timeout=60, workers=4, backlog=None):
+        """
+        :param Dorina dorina: analysis object shared by all queries
+        :param float timeout: seconds a request may wait for its result
+        :param int workers: queries computed at the same time
+        :param int backlog: queries waiting for a worker, by default as many
+            as there are workers
+        """
+        self.dorina = dorina
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.max_inflight = workers + (workers if backlog is None else backlog)
+        self.requests = 0
+        self.coalesced = 0
+        self.timeouts = 0
+        self.rejected = 0
+        self.errors = 0
+        self._inflight = {}
+        self._waiters = {}
+
+    def preload(self, genome):
+        """Load the region tracks of genome into the cache"""
+        self.dorina.preload(genome)
+
+    def _analyse(self, genome, args):
+        result = self.dorina.analyse(genome, **args)
+        return ''.join('\t'.join(x) + '\n' for x in records(result))
+
+    async def query(self, query):
+        """Result of a query as text, shared with identical running queries
+
+        :raises InvalidQuery: for invalid queries
+        :raises Busy: when max_inflight queries are computed or queued
+        :raises asyncio.TimeoutError: when the result takes longer than the
+            timeout; the computation goes on for the other waiters, and is
+            cancelled when none are left and it has not started yet
+        """
+        genome, args, key = normalize(query)
+        self.requests += 1
+        future = self._inflight.get(key)
+        if future is None:
+            if len(self._inflight) >= self.max_inflight:
+                self.rejected += 1
+                raise Busy("%d queries in progress" % len(self._inflight))
+            # Running queries stay counted until their thread is done
+            future = self.executor.submit(self._analyse, genome, args)
+            self._inflight[key] = future
+            future.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            self.coalesced += 1
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        try:
+            return await asyncio.wait_for(
+                asyncio.shield(asyncio.wrap_future(future)), self.timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            if self._waiters[key] == 1:
+                future.cancel()
+            raise
+        finally:
+            self._waiters[key] -= 1
+            if not self._waiters[key]:
+                del self._waiters[key]
+
+    def stats(self):
+        return {'requests': self.requests,
+                'coalesced': self.coalesced,
+                'timeouts': self.timeouts,
+                'rejected': self.rejected,
+                'errors': self.errors,
+                'inflight': len(self._inflight),
+                'cache': self.dorina.cache.stats()}
+
+    async def handle(self, reader, writer):
+        """Answer one HTTP request"""
+        try:
+            status, content_type, body = await self._respond(reader)
+        except Exception as e:
+            log.exception(e)
+            self.errors += 1
+            status, content_type, body = 500, 'text/plain', 'Query failed\n'
+        body = body.encode('utf-8')
+        writer.write(('HTTP/1.1 %d %s\r\nContent-Type: %s; charset=utf-8\r\n'
+                      'Content-Length: %d\r\nConnection: close\r\n\r\n' % (
+                          status, REASONS[status], content_type, len(body))
+                      ).encode('latin-1') + body)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def _respond(self, reader):
+        request_line = (await reader.readline()).decode('latin-1').split()
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode('latin-1').strip()
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        if len(request_line) < 2:
+            return 400, 'text/plain', 'Malformed request\n'
+        method, target = request_line[:2]
+
+        if target == '/stats':
+            return 200, 'application/json', json.dumps(self.stats()) + '\n'
+        if target != '/analyse':
+            return 404, 'text/plain', 'Not found\n'
+        if method != 'POST':
+            return 405, 'text/plain', 'Use POST\n'
+
+        try:
+            length = int(headers.get('content-length', ''))
+            query = json.loads((await reader.readexactly(length))
+                               .decode('utf-8'))
+        except (ValueError, asyncio.IncompleteReadError):
+            return 400, 'text/plain', 'Malformed request body\n'
+        try:
+            result = await self.query(query)
+        except InvalidQuery as e:
+            return 400, 'text/plain', '%s\n' % e
+        except ValueError as e:
+            # Parser messages may quote the data files
+            log.warning('Query failed: %s' % e)
+            return 400, 'text/plain', 'Query failed\n'
+        except Busy as e:
+            return 503, 'text/plain', 'Too many queries: %s\n' % e
+        except asyncio.TimeoutError:
+            return 504, 'text/plain', 'Query timed out\n'
+        return 200, 'text/tab-separated-values', result
+
+    async def start(self, host='127.0.0.1', port=8080):
+        """Start listening; the returned asyncio server has the bound port"""
+        return await asyncio.start_server(self.handle, host, port)
+
+    def close(self):
+        self.executor.shutdown()
+
+
+async def request(host, port, method, target, body=None):
+    """Send one HTTP request to the service
+
+    :return tuple: status code and decoded body
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    data = b'' if body is None else json.dumps(body).encode('utf-8')
+    writer.write(('%s %s HTTP/1.1\r\nHost: %s\r\nContent-Type: '
+                  'application/json\r\nContent-Length: %d\r\n\r\n' % (
+                      method, target, host, len(data))).encode('latin-1') +
+                 data)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    head, _, body = response.partition(b'\r\n\r\n')
+    return int(head.split()[1]), body.decode('utf-8')
+
+
+def serve(dorina, host='127.0.0.1', port=8080, timeout=60, workers=4,
+          preload=(), backlog=None):
+    """Run the query service until interrupted
+
+    :param Dorina dorina: analysis object shared by all queries
+    :param list preload: genomes whose region tracks are loaded up front
+    :param int backlog: queries waiting for a worker before new ones are
+        refused
+    """
+    service = QueryService(dorina, timeout, workers, backlog)
+    for genome in preload:
+        service.preload(genome)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    server = loop.run_until_complete(service.start(host, port))
+    log.info('Serving on %s:%d' % (host, port))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+        service.close()
+        loop.close()
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+"""
+Sort order checks for genome tracks and regulator files.
+
+bedtools only runs its memory-bounded chrom-sweep join (``-sorted``) on
+inputs sorted by chromosome name and start, as ``bedtools sort`` writes
+them. Every file is checked once; the outcome and the order of its
+chromosomes are recorded next to it in a ``.sorted`` directory, along with
+a sorted copy when the file itself is not sorted.
+"""
+from __future__ import unicode_literals
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from io import open
+
+from dorina.index import _source_stat
+from dorina.intervals import is_gff
+
+log = logging.getLogger(__name__)
+
+SORT_DIR = '.sorted'
+
+# In-process copy of the records, keyed by file name
+_records = {}
+
+
+def _is_header(line):
+    return not line.strip() or line.startswith(('#', 'track', 'browser'))
+
+
+def _position(fields):
+    """Chromosome and start of a BED or GFF record"""
+    if is_gff(fields):
+        return fields[0], int(fields[3])
+    return fields[0], int(fields[1])
+
+
+def sort_dir(filename):
+    """Directory holding the sort record and sorted copy of filename.
+
+    Falls back to the temporary directory when the directory of filename
+    is not writable, e.g. for uploads.
+    """
+    directory = os.path.join(os.path.dirname(os.path.abspath(filename)),
+                             SORT_DIR)
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        if os.access(directory, os.W_OK):
+            return directory
+    except OSError:
+        pass
+    digest = hashlib.sha1(os.path.abspath(filename).encode('utf-8'))
+    directory = os.path.join(tempfile.gettempdir(), 'dorina-sorted',
+                             digest.hexdigest())
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    return directory
+
+
+class SortChecker(object):
+    """Check the sort order of records fed one line at a time, e.g. while
+    they are written"""
+
+    def __init__(self):
+        self.in_order = True
+        self.chroms = []
+        self._seen = set()
+        self._last_chrom = None
+        self._last_start = None
+
+    def feed(self, line):
+        """Check the next line of a BED or GFF file"""
+        if _is_header(line):
+            return
+        chrom, start = _position(line.rstrip('\r\n').split('\t'))
+        if chrom != self._last_chrom:
+            if chrom in self._seen or (self._last_chrom is not None and
+                                       chrom < self._last_chrom):
+                self.in_order = False
+            if chrom not in self._seen:
+                self._seen.add(chrom)
+                self.chroms.append(chrom)
+        elif start < self._last_start:
+            self.in_order = False
+        self._last_chrom, self._last_start = chrom, start
+
+    def result(self):
+        """Whether the lines were sorted, and their chromosomes in the order
+        they first appeared"""
+        return self.in_order, self.chroms
+
+
+def check_sorted(filename):
+    """Check in one pass that filename is sorted by chromosome and start
+
+    :param str filename: BED or GFF file
+    :return tuple: whether the file is sorted, and its chromosomes in the
+        order they first appear
+    """
+    checker = SortChecker()
+    with open(filename, encoding="utf-8") as fh:
+        for line in fh:
+            checker.feed(line)
+    return checker.result()
+
+
+def sort_file(filename, target):
+    """Write the records of filename to target, sorted by chromosome and
+    start; header lines are kept at the top"""
+    headers, records = [], []
+    with open(filename, encoding="utf-8") as fh:
+        for line in fh:
+            if _is_header(line):
+                headers.append(line)
+            else:
+                records.append(
+                    (_position(line.rstrip('\r\n').split('\t')), line))
+    records.sort(key=lambda x: x[0])
+    # A temporary file of its own, as other threads may sort the same file
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(target) or '.')
+    with open(fd, 'w', encoding="utf-8") as fh:
+        fh.writelines(headers)
+        fh.writelines(line if line.endswith('\n') else line + '\n'
+                      for _, line in records)
+    os.rename(tmp, target)
+
+
+def _complete(record):
+    """Whether a sort record needs no more sorting"""
+    return record['sorted'] or bool(record['copy'] and
+                                    os.path.isfile(record['copy']))
+
+
+def sort_record(filename):
+    """Sort order of filename, checked once and kept until it changes
+
+    :param str filename: BED or GFF file
+    :return dict: with keys 'sorted', 'chroms' (chromosome order of the
+        sorted records) and 'copy' (path to the sorted copy, or None)
+    """
+    source = _source_stat(filename)
+    cached = _records.get(filename)
+    if cached is not None and cached['source'] == source and \
+            _complete(cached):
+        return cached
+
+    directory = sort_dir(filename)
+    basename = os.path.basename(filename)
+    record_path = os.path.join(directory, basename + '.json')
+    try:
+        with open(record_path, encoding="utf-8") as fh:
+            record = json.load(fh)
+        if record['source'] != source:
+            record = None
+    except (IOError, ValueError, KeyError):
+        record = None
+
+    if record is None:
+        record = store_record(filename, *check_sorted(filename))
+    elif not _complete(record):
+        # Checked before, e.g. while downloading, but not sorted yet
+        record = store_record(filename, False, record['chroms'])
+    _records[filename] = record
+    return record
+
+
+def store_record(filename, in_order, chroms, sort=True):
+    """Record the sort order of filename, sorting a copy when it is out of
+    order
+
+    :param str filename: BED or GFF file
+    :param bool in_order: whether filename is sorted
+    :param list chroms: chromosomes of filename
+    :param bool sort: sort the copy now; otherwise sort_record() sorts it
+        on first use
+    :return dict: the sort record, see sort_record()
+    """
+    directory = sort_dir(filename)
+    basename = os.path.basename(filename)
+    record_path = os.path.join(directory, basename + '.json')
+    record = {'source': _source_stat(filename), 'sorted': in_order,
+              'chroms': sorted(chroms), 'copy': None}
+    if not in_order and sort:
+        log.info('Sorting {}'.format(filename))
+        record['copy'] = os.path.join(directory, basename)
+        sort_file(filename, record['copy'])
+    try:
+        fd, tmp = tempfile.mkstemp(dir=directory)
+        with open(fd, 'w', encoding="utf-8") as fh:
+            fh.write(json.dumps(record))
+        os.rename(tmp, record_path)
+    except (IOError, OSError) as e:
+        log.debug('Unable to write sort record {}: {}'.format(
+            record_path, e))
+    _records[filename] = record
+    return record
+
+
+def sorted_path(filename):
+    """Path to a copy of filename sorted by chromosome and start; filename
+    itself when it already is"""
+    return sort_record(filename)['copy'] or filename
+
@@ -1,16 +1,18 @@
 #!/usr/bin/env python
 # -*- coding: utf-8
 from __future__ import unicode_literals
-import gzip
 import logging
 import os
 import json
-import shutil
 from os import path
 from io import open
 
 log = logging.getLogger(__name__)
 
+MANIFEST = 'manifest.json'
+# Bumped whenever the layout of the persisted tree changes
+MANIFEST_VERSION = 2
+
 assembly_mapping = {
     'hg38': 'h_sapiens',
     'mm10': 'm_musculus'}
@@ -48,6 +50,90 @@ class DorinaUtils(object):
 
         return genomes
 
+    @staticmethod
+    def tree_mtimes(root):
+        """Modification times of the species and assembly directories"""
+        mtimes = {}
+        for species in os.listdir(root):
+            species_path = os.path.join(root, species)
+            if not os.path.isdir(species_path):
+                continue
+            mtimes[species] = os.stat(species_path).st_mtime
+            for assembly in os.listdir(species_path):
+                assembly_path = os.path.join(species_path, assembly)
+                if os.path.isdir(assembly_path):
+                    mtimes[species + '/' + assembly] = \
+                        os.stat(assembly_path).st_mtime
+        return mtimes
+
+    @staticmethod
+    def load_assembly_tree(root, parse_func, manifest=MANIFEST):
+        """Like walk_assembly_tree(), but persisted to a manifest in root.
+
+        The manifest is reused as long as no species or assembly directory
+        was added, removed or modified, so startup does not have to list
+        and parse every file again. Paths in the tree should be relative to
+        root, so the manifest holds whatever the working directory.
+        """
+        mtimes = DorinaUtils.tree_mtimes(root)
+        manifest_path = os.path.join(root, manifest)
+        try:
+            with open(manifest_path, encoding="utf-8") as fh:
+                data = json.load(fh)
+            if data.get('version') == MANIFEST_VERSION and \
+                    data['root'] == os.path.abspath(root) and \
+                    data['mtimes'] == mtimes:
+                return data['tree']
+        except (IOError, ValueError, KeyError):
+            pass
+
+        tree = DorinaUtils.walk_assembly_tree(root, parse_func)
+        data = {'version': MANIFEST_VERSION, 'root': os.path.abspath(root),
+                'mtimes': mtimes, 'tree': tree}
+        try:
+            with open(manifest_path + '.tmp', 'w', encoding="utf-8") as fh:
+                fh.write(json.dumps(data))
+            os.rename(manifest_path + '.tmp', manifest_path)
+        except (IOError, OSError) as e:
+            log.debug('Unable to write manifest {}: {}'.format(
+                manifest_path, e))
+        return tree
+
+    @staticmethod
+    def update_manifest(root, species, assembly, entries, manifest=MANIFEST):
+        """Add entries to one assembly of a persisted tree in place.
+
+        Only the recorded modification times of the species and assembly
+        directories are refreshed, so the other assemblies are not walked
+        again and the manifest stays valid for load_assembly_tree().
+
+        :param str root: directory holding the species directories
+        :param dict entries: parsed entries to add to the assembly
+        :return dict: the updated tree, or None when root has no valid
+            manifest to update
+        """
+        manifest_path = os.path.join(root, manifest)
+        try:
+            with open(manifest_path, encoding="utf-8") as fh:
+                data = json.load(fh)
+            if data.get('version') != MANIFEST_VERSION or \
+                    data['root'] != os.path.abspath(root):
+                return None
+        except (IOError, ValueError, KeyError):
+            return None
+
+        data['tree'].setdefault(species, {}).setdefault(
+            assembly, {}).update(entries)
+        species_path = os.path.join(root, species)
+        data['mtimes'][species] = os.stat(species_path).st_mtime
+        data['mtimes'][species + '/' + assembly] = os.stat(
+            os.path.join(species_path, assembly)).st_mtime
+        tmp = '{}.{}.tmp'.format(manifest_path, os.getpid())
+        with open(tmp, 'w', encoding="utf-8") as fh:
+            fh.write(json.dumps(data))
+        os.rename(tmp, manifest_path)
+        return data['tree']
+
 
 def urljoin(*args):
     """
@@ -89,26 +175,6 @@ def validate_data_path(path_):
     return path_
 
 
-def uncompress(filename):
-    """
-
-    :param str filename:
-    :return:
-    """
-    extension = filename.rsplit('.', 1)[-1]
-    uncompressed_filename = filename.replace('.' + extension, '')
-    if extension not in ('gz',):
-        raise NotImplementedError(
-            "Extension {} is unsupported.".format(extension))
-
-    with gzip.open(filename) as _input, \
-            open(uncompressed_filename, 'wb') as output:
-        shutil.copyfileobj(_input, output)
-        shutil.os.remove(filename)
-
-    return uncompressed_filename
-
-
 def data_for_assembly(assembly, datadir, validate=False, *args):
     from pathlib import Path
     path = Path(datadir, assembly_mapping[assembly], assembly, *args)
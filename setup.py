@@ -26,6 +26,7 @@ setup(
     package_data={'dorina.config': ['*.cfg']},
     include_package_data=True,
     install_requires=read('requirements.txt').splitlines(),
+    extras_require={'parquet': ['pyarrow']},
     tests_require=['nose'],
     license=read('LICENSE'),
     long_description=read('README.md'),
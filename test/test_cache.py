@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+
+from __future__ import unicode_literals
+
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from dorina.cache import LRUCache, ResultCache, sizeof
+from dorina.intervals import Intervals
+
+
+class TestLRUCache(unittest.TestCase):
+    def setUp(self):
+        self.intervals = Intervals.from_rows([('chr1', '10', '20', 'a1')])
+        self.size = sizeof(self.intervals)
+
+    def test_hits_and_misses(self):
+        """Test LRUCache.get() only calls the loader on a miss"""
+        cache = LRUCache()
+        calls = []
+
+        def loader():
+            calls.append(1)
+            return self.intervals
+
+        self.assertIs(self.intervals, cache.get(('hg19', 'a'), loader))
+        self.assertIs(self.intervals, cache.get(('hg19', 'a'), loader))
+        self.assertEqual(1, len(calls))
+        stats = cache.stats()
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(1, stats['misses'])
+        self.assertEqual(self.size, stats['nbytes'])
+
+    def test_eviction(self):
+        """Test LRUCache evicts the least recently used entry"""
+        cache = LRUCache(max_bytes=2 * self.size)
+        cache.get('a', lambda: self.intervals)
+        cache.get('b', lambda: self.intervals)
+        cache.get('a', lambda: self.intervals)
+        cache.get('c', lambda: self.intervals)
+
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache)
+        self.assertEqual(1, cache.stats()['evictions'])
+        self.assertEqual(2 * self.size, cache.nbytes)
+
+    def test_disabled(self):
+        """Test a zero sized LRUCache never stores values"""
+        cache = LRUCache(max_bytes=0)
+        cache.get('a', lambda: self.intervals)
+        self.assertEqual(0, len(cache))
+
+
+class TestResultCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.records = [['chr1', '10', '20', 'a1'], ['chr2', '5', '8', 'bé']]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_key(self):
+        """Test ResultCache.key() ignores the order of mapping keys"""
+        self.assertEqual(ResultCache.key({'a': 1, 'b': [2, 3]}),
+                         ResultCache.key({'b': [2, 3], 'a': 1}))
+        self.assertNotEqual(ResultCache.key({'a': 1, 'b': [2, 3]}),
+                            ResultCache.key({'a': 1, 'b': [3, 2]}))
+
+    def test_get_put(self):
+        """Test ResultCache.put() stores records for later runs"""
+        cache = ResultCache(self.directory)
+        key = ResultCache.key({'set_a': ['a']})
+        self.assertIsNone(cache.get(key))
+        cache.put(key, iter(self.records))
+        later = ResultCache(self.directory)
+        self.assertEqual(self.records, later.get(key))
+        later.close()
+        stats = cache.stats()
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(1, stats['misses'])
+        self.assertEqual(1, stats['entries'])
+        self.assertEqual(os.path.getsize(cache.path(key)), stats['nbytes'])
+
+    def test_stats_flush(self):
+        """Test ResultCache counts lookups in memory until closed"""
+        cache = ResultCache(self.directory)
+        cache.put('aa', self.records)
+        cache.get('aa')
+        cache.get('bb')
+        stats = os.path.join(self.directory, ResultCache.STATS)
+        self.assertFalse(os.path.exists(stats))
+        self.assertEqual(1, cache.stats()['hits'])
+        cache.close()
+        cache.get('aa')
+        cache.close()
+        stats = ResultCache(self.directory).stats()
+        self.assertEqual(2, stats['hits'])
+        self.assertEqual(1, stats['misses'])
+
+    def test_empty_result(self):
+        """Test an empty result is a hit, not a miss"""
+        cache = ResultCache(self.directory)
+        cache.put('ab12', [])
+        self.assertEqual([], cache.get('ab12'))
+
+    def test_eviction(self):
+        """Test ResultCache evicts the least recently used entries"""
+        cache = ResultCache(self.directory)
+        for i, key in enumerate(('aa', 'bb', 'cc')):
+            cache.put(key, self.records)
+            os.utime(cache.path(key), (i, i))
+        cache.get('aa')
+        size = os.path.getsize(cache.path('aa'))
+        cache.max_bytes = 2 * size
+        self.assertEqual(1, cache.evict())
+        self.assertIsNone(cache.get('bb'))
+        self.assertIsNotNone(cache.get('cc'))
+        self.assertEqual(1, cache.stats()['evictions'])
+
+    def test_put_without_scan(self):
+        """Test ResultCache scans its directory only when opened"""
+        cache = ResultCache(self.directory)
+        cache.put('aa', self.records)
+        size = os.path.getsize(cache.path('aa'))
+        with mock.patch.object(ResultCache, '_entries',
+                               side_effect=AssertionError('scanned')):
+            cache.max_bytes = 2 * size
+            cache.put('bb', self.records)
+            cache.get('aa')
+            cache.put('cc', self.records)
+        self.assertTrue(os.path.exists(cache.path('aa')))
+        self.assertFalse(os.path.exists(cache.path('bb')))
+
+        reopened = ResultCache(self.directory, max_bytes=size)
+        self.assertEqual(2 * size, reopened._nbytes)
+        self.assertEqual(1, reopened.evict())
+
+    def test_clear(self):
+        """Test ResultCache.clear() removes entries and counters"""
+        cache = ResultCache(self.directory)
+        cache.put('aa', self.records)
+        cache.get('aa')
+        cache.clear()
+        stats = cache.stats()
+        self.assertEqual(0, stats['entries'])
+        self.assertEqual(0, stats['hits'])
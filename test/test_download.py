@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+
+from __future__ import unicode_literals
+
+import gzip
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from ftplib import error_perm, error_temp
+from io import open
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from dorina import download, sorting
+from dorina.download import (BSDSum, ChecksumError, FTPDownloader,
+                             GzipStream, StreamError, bsd_sum,
+                             parse_checksums)
+
+
+class FakeFTP(object):
+    """Stand-in for ftplib.FTP serving files from a dict"""
+
+    def __init__(self, files, fail_after=None):
+        self.files = files
+        self.fail_after = fail_after
+        self.connections = []
+        self.lock = threading.Lock()
+
+    def __call__(self, host):
+        connection = FakeConnection(self)
+        with self.lock:
+            self.connections.append(connection)
+        return connection
+
+
+class FakeConnection(object):
+    def __init__(self, server):
+        self.server = server
+        self.logged_in = False
+        self.closed = False
+        self.transfers = []
+
+    def login(self):
+        self.logged_in = True
+
+    def voidcmd(self, command):
+        return '200 OK'
+
+    def nlst(self, directory):
+        return sorted(x for x in self.server.files if x.startswith(directory))
+
+    def size(self, remote):
+        if remote not in self.server.files:
+            raise error_perm('550 No such file')
+        return len(self.server.files[remote])
+
+    def _data(self, command):
+        remote = command.split(' ', 1)[1]
+        if remote not in self.server.files:
+            raise error_perm('550 No such file')
+        return self.server.files[remote]
+
+    def retrlines(self, command, callback):
+        for line in self._data(command).decode('utf-8').splitlines():
+            callback(line)
+
+    def retrbinary(self, command, callback, blocksize=8192, rest=None):
+        data = self._data(command)[rest or 0:]
+        self.transfers.append((command, rest))
+        with self.server.lock:
+            fail_after, self.server.fail_after = self.server.fail_after, None
+        if fail_after is not None:
+            callback(data[:fail_after])
+            raise error_temp('426 Connection closed; transfer aborted')
+        for i in range(0, len(data), blocksize):
+            callback(data[i:i + blocksize])
+
+    def quit(self):
+        self.closed = True
+
+    def close(self):
+        self.closed = True
+
+
+def checksum_line(data, name):
+    fh, filename = tempfile.mkstemp()
+    os.write(fh, data)
+    os.close(fh)
+    try:
+        return '%d %d %s\n' % (bsd_sum(filename) + (name, ))
+    finally:
+        os.remove(filename)
+
+
+class TestDownload(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.files = {}
+        checksums = ''
+        for i in range(6):
+            data = ('peaks %d\n' % i).encode('utf-8') * (5000 + i)
+            name = 'peaks%d.bed.gz' % i
+            self.files['/pub/peaks/' + name] = data
+            checksums += checksum_line(data, name)
+        self.files['/pub/peaks/CHECKSUMS'] = checksums.encode('utf-8')
+        self.jobs = [('/pub/peaks/peaks%d.bed.gz' % i,
+                      os.path.join(self.directory, 'peaks%d.bed.gz' % i))
+                     for i in range(6)]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def read(self, filename):
+        with open(filename, 'rb') as fh:
+            return fh.read()
+
+    def test_bsd_sum(self):
+        """Test the Python fallback of bsd_sum() matches sum"""
+        filename = os.path.join(self.directory, 'data')
+        with open(filename, 'wb') as fh:
+            fh.write(self.files['/pub/peaks/peaks3.bed.gz'])
+        expected = bsd_sum(filename)
+        with mock.patch.object(download.shutil, 'which', return_value=None):
+            self.assertEqual(expected, bsd_sum(filename))
+        with open(filename, 'wb') as fh:
+            fh.write(b'hello\n')
+        with mock.patch.object(download.shutil, 'which', return_value=None):
+            self.assertEqual((36979, 1), bsd_sum(filename))
+
+    def test_parse_checksums(self):
+        """Test parse_checksums() reads sum output lines"""
+        self.assertEqual({'a.gz': (123, 4), 'b.gz': (5, 6)},
+                         parse_checksums('123 4 a.gz\n\n5   6 b.gz\n'))
+
+    def test_download(self):
+        """Test download() fetches every file over one connection per
+        worker"""
+        server = FakeFTP(self.files)
+        downloader = FTPDownloader('ftp.test', workers=3, ftp_factory=server)
+        got = downloader.download(self.jobs)
+        downloader.download(self.jobs[:2])
+        downloader.close()
+
+        self.assertEqual([x for _, x in self.jobs], got)
+        for remote, filename in self.jobs:
+            self.assertEqual(self.files[remote], self.read(filename))
+        self.assertLessEqual(len(server.connections), 3)
+        self.assertTrue(all(x.logged_in and x.closed
+                            for x in server.connections))
+
+    def test_resume(self):
+        """Test an aborted transfer resumes from the partial file"""
+        server = FakeFTP(self.files, fail_after=1000)
+        downloader = FTPDownloader('ftp.test', workers=1, ftp_factory=server)
+        remote, filename = self.jobs[0]
+        downloader.download([self.jobs[0]])
+
+        self.assertEqual(self.files[remote], self.read(filename))
+        self.assertFalse(os.path.exists(filename + '.part'))
+        transfers = [x for c in server.connections for x in c.transfers]
+        self.assertEqual([('RETR ' + remote, None), ('RETR ' + remote, 1000)],
+                         transfers)
+
+    def test_partial_file(self):
+        """Test a partial file left by an earlier run is completed"""
+        remote, filename = self.jobs[1]
+        with open(filename + '.part', 'wb') as fh:
+            fh.write(self.files[remote][:4000])
+        server = FakeFTP(self.files)
+        FTPDownloader('ftp.test', ftp_factory=server).download([self.jobs[1]])
+        self.assertEqual(self.files[remote], self.read(filename))
+        self.assertEqual([('RETR ' + remote, 4000)],
+                         server.connections[0].transfers)
+
+    def test_checksum_mismatch(self):
+        """Test a corrupted file is downloaded again, then rejected"""
+        remote, filename = self.jobs[2]
+        with open(filename + '.part', 'wb') as fh:
+            fh.write(b'x' * len(self.files[remote]))
+        server = FakeFTP(self.files)
+        FTPDownloader('ftp.test', ftp_factory=server).download([self.jobs[2]])
+        self.assertEqual(self.files[remote], self.read(filename))
+
+        self.files[remote] = b'corrupted'
+        os.remove(filename)
+        downloader = FTPDownloader('ftp.test', retries=2, ftp_factory=server)
+        self.assertRaises(ChecksumError, downloader.download, [self.jobs[2]])
+        self.assertFalse(os.path.exists(filename))
+        self.assertFalse(os.path.exists(filename + '.part'))
+
+    def test_without_checksums(self):
+        """Test files of directories without CHECKSUMS are not verified"""
+        del self.files['/pub/peaks/CHECKSUMS']
+        server = FakeFTP(self.files)
+        downloader = FTPDownloader('ftp.test', ftp_factory=server)
+        self.assertEqual([self.jobs[0][1]], downloader.download(self.jobs[:1]))
+        self.assertEqual({}, downloader.checksums('/pub/peaks'))
+
+
+class TestStreamingDownload(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.gff = ''.join(
+            'chr%d\tensembl\tgene\t%d\t%d\t.\t+\t.\tID=g%d\n' % (
+                c, i * 100 + 1, i * 100 + 50, i)
+            for c in (1, 2) for i in range(2000)).encode('utf-8')
+        self.files = {}
+        self.add('/pub/gff3/genes.gff3.gz', gzip.compress(self.gff))
+        self.filename = os.path.join(self.directory, 'genes.gff3')
+        self.job = ('/pub/gff3/genes.gff3.gz', self.filename, True)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def add(self, remote, data):
+        self.files[remote] = data
+        directory, name = remote.rsplit('/', 1)
+        self.files[directory + '/CHECKSUMS'] = checksum_line(
+            data, name).encode('utf-8')
+
+    def read(self):
+        with open(self.filename, 'rb') as fh:
+            return fh.read()
+
+    def test_bsd_sum_stream(self):
+        """Test BSDSum matches bsd_sum() with and without sum"""
+        filename = os.path.join(self.directory, 'data')
+        with open(filename, 'wb') as fh:
+            fh.write(self.gff)
+        expected = bsd_sum(filename)
+        for which in (shutil.which, lambda x: None):
+            with mock.patch.object(download.shutil, 'which', which):
+                checksum = BSDSum()
+                for i in range(0, len(self.gff), 1000):
+                    checksum.update(self.gff[i:i + 1000])
+                self.assertEqual(expected, checksum.digest())
+
+    def test_gzip_stream(self):
+        """Test GzipStream handles several members and truncation"""
+        data = gzip.compress(b'first\n') + gzip.compress(b'second\n')
+        stream = GzipStream()
+        got = b''.join(stream.decompress(data[i:i + 7])
+                       for i in range(0, len(data), 7))
+        stream.flush()
+        self.assertEqual(b'first\nsecond\n', got)
+
+        stream = GzipStream()
+        stream.decompress(data[:-3])
+        self.assertRaises(StreamError, stream.flush)
+        self.assertRaises(StreamError, GzipStream().decompress, b'not gzip')
+
+    def test_stream(self):
+        """Test a gzip file is decompressed while it is downloaded"""
+        server = FakeFTP(self.files)
+        FTPDownloader('ftp.test', ftp_factory=server).download([self.job])
+        self.assertEqual(self.gff, self.read())
+        # Neither the compressed file nor a partial one is left
+        self.assertEqual(['.sorted', 'genes.gff3'],
+                         sorted(os.listdir(self.directory)))
+
+        # The sort order was recorded on the way
+        with mock.patch.object(sorting, 'check_sorted') as check:
+            sorting._records.clear()
+            record = sorting.sort_record(self.filename)
+        self.assertFalse(check.called)
+        self.assertEqual((True, ['chr1', 'chr2']),
+                         (record['sorted'], record['chroms']))
+
+    def test_stream_resume(self):
+        """Test an aborted stream resumes in the same decompressor"""
+        server = FakeFTP(self.files, fail_after=3000)
+        FTPDownloader('ftp.test', ftp_factory=server).download([self.job])
+        self.assertEqual(self.gff, self.read())
+        transfers = [x for c in server.connections for x in c.transfers]
+        self.assertEqual([3000], [x for _, x in transfers if x])
+
+    def test_stream_unsorted(self):
+        """Test an unsorted stream gets a sorted copy once first used"""
+        lines = self.gff.splitlines(True)
+        self.add('/pub/gff3/genes.gff3.gz',
+                 gzip.compress(b''.join(lines[2000:] + lines[:2000])))
+        server = FakeFTP(self.files)
+        with mock.patch.object(sorting, 'sort_file') as sort_file:
+            FTPDownloader('ftp.test', ftp_factory=server).download([self.job])
+            self.assertFalse(sort_file.called)
+
+        sorting._records.clear()
+        with mock.patch.object(sorting, 'check_sorted') as check:
+            record = sorting.sort_record(self.filename)
+            self.assertFalse(check.called)
+        self.assertFalse(record['sorted'])
+        with open(record['copy'], 'rb') as fh:
+            self.assertEqual(self.gff, fh.read())
+
+    def test_stream_corrupted(self):
+        """Test corrupted streams are retried, then rejected"""
+        data = self.files['/pub/gff3/genes.gff3.gz']
+        self.files['/pub/gff3/genes.gff3.gz'] = data[:100] + b'x' + data[101:]
+        downloader = FTPDownloader('ftp.test', retries=2,
+                                   ftp_factory=FakeFTP(self.files))
+        self.assertRaises((ChecksumError, StreamError), downloader.download,
+                          [self.job])
+        self.assertEqual([], os.listdir(self.directory))
+
+        self.add('/pub/gff3/genes.gff3.gz', data[:-10])
+        self.assertRaises(StreamError, downloader.download, [self.job])
+        self.assertEqual([], os.listdir(self.directory))
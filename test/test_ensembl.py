@@ -6,7 +6,17 @@ Created on 07:41 16/10/2017 2017
 """
 from __future__ import unicode_literals
 
+import asyncio
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import threading
 import unittest
+from io import open
+
+from six.moves import BaseHTTPServer, socketserver
 
 try:
     from unittest import mock
@@ -16,7 +26,9 @@ except ImportError:
 from nose.tools import assert_true, raises
 from requests.exceptions import HTTPError
 
-from dorina.ensembl import EnsemblRest
+from dorina.ensembl import (AsyncEnsemblRest, EnsemblFTP, EnsemblRest,
+                            ResponseCache, TokenBucket)
+from test.test_download import FakeFTP, checksum_line
 
 
 class TestEnsemblRest(unittest.TestCase):
@@ -28,19 +40,14 @@ class TestEnsemblRest(unittest.TestCase):
         self.ensembl_rest = None
         self.ensembl_rest_bad = None
 
-    @mock.patch('dorina.ensembl.urlretrieve')
-    def test_ensembl_ftp(self, mock_urlretrieve):
-        urlretrieve = mock_urlretrieve()
-        urlretrieve.return_value = []
-
-    @mock.patch('dorina.ensembl.requests.get')
+    @mock.patch('dorina.ensembl.requests.Session.request')
     def test_ensembl_rest_ping(self, mock_get):
         """Test the communication with the Rest server"""
         mock_get.return_value = mock.Mock(ok=True)
 
         assert_true(self.ensembl_rest.ping())
 
-    @mock.patch('dorina.ensembl.requests.get')
+    @mock.patch('dorina.ensembl.requests.Session.request')
     @raises(HTTPError)
     def test_ensembl_bad_ping(self, mock_get):
         """Test the communication bad server"""
@@ -48,7 +55,7 @@ class TestEnsemblRest(unittest.TestCase):
         mock_get.side_effect = HTTPError(mock.Mock(status=404), 'not found')
         self.ensembl_rest_bad.ping()
 
-    @mock.patch('dorina.ensembl.requests.get')
+    @mock.patch('dorina.ensembl.requests.Session.request')
     def test_get_info_assembly_w_defaults(self, mock_get):
         normal_response = {'is_chromosome': 1,
                            'length': 156040895,
@@ -66,8 +73,237 @@ class TestEnsemblRest(unittest.TestCase):
         pass
 
 
+class MockEnsemblHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answers ping and lookup requests like the Ensembl REST server"""
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def respond(self, status, body, headers=()):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for header in headers:
+            self.send_header(*header)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def record(self, body=None):
+        server = self.server
+        with server.lock:
+            server.requests.append((self.command, self.path, body))
+            server.clients.add(self.client_address)
+            throttle = server.throttle
+            server.throttle = max(0, throttle - 1)
+        return throttle
+
+    def do_GET(self):
+        if self.record():
+            return self.respond(429, {'error': 'Too many requests'},
+                                [('Retry-After', '0.01')])
+        if self.path.startswith('/info/ping'):
+            return self.respond(200, {'ping': 1})
+        self.respond(404, {'error': 'not found'})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = json.loads(self.rfile.read(length).decode('utf-8'))
+        if self.record(body):
+            return self.respond(429, {'error': 'Too many requests'},
+                                [('Retry-After', '0.01')])
+        if self.path.startswith('/lookup/id'):
+            return self.respond(200, dict(
+                (x, {'id': x, 'object_type': 'Gene'}) for x in body['ids']))
+        if self.path.startswith('/lookup/symbol/'):
+            return self.respond(200, dict(
+                (x, {'display_name': x}) for x in body['symbols']))
+        self.respond(404, {'error': 'not found'})
+
+
+class MockEnsemblServer(socketserver.ThreadingMixIn,
+                        BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class TestEnsemblRestServer(unittest.TestCase):
+    def setUp(self):
+        self.server = MockEnsemblServer(('127.0.0.1', 0), MockEnsemblHandler)
+        self.server.lock = threading.Lock()
+        self.server.requests = []
+        self.server.clients = set()
+        self.server.throttle = 0
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.base_url = 'http://127.0.0.1:%d/' % self.server.server_port
+        self.ids = ['ENSG%011d' % i for i in range(25)]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_pooled_connection(self):
+        """Test requests reuse one pooled connection"""
+        rest = EnsemblRest(base_url=self.base_url, reqs_per_sec=1000)
+        for _ in range(5):
+            self.assertEqual({'ping': 1}, rest.ping())
+        self.assertEqual(5, len(self.server.requests))
+        self.assertEqual(1, len(self.server.clients))
+
+    def test_lookup_ids_batches(self):
+        """Test bulk lookups are sent as POST batches"""
+        rest = EnsemblRest(base_url=self.base_url, reqs_per_sec=1000)
+        rest.batch_size = 10
+        got = rest.lookup_ids(self.ids, expand=1)
+        self.assertEqual(self.ids, sorted(got))
+        self.assertEqual([('POST', 10), ('POST', 10), ('POST', 5)],
+                         [(x, len(y['ids'])) for x, _, y in
+                          self.server.requests])
+        self.assertTrue(self.server.requests[0][1].endswith('expand=1'))
+        self.assertEqual({'BRCA2': {'display_name': 'BRCA2'}},
+                         rest.lookup_symbols('homo_sapiens', ['BRCA2']))
+
+    def test_response_cache(self):
+        """Test lookups are served from the cache until they expire"""
+        now = [0]
+        cache_dir = tempfile.mkdtemp()
+        try:
+            cache = ResponseCache(60, cache_dir, clock=lambda: now[0])
+            rest = EnsemblRest(base_url=self.base_url, cache=cache)
+            rest.lookup_ids(self.ids[:2])
+            rest.lookup_ids(self.ids[:2])
+            self.assertEqual(1, len(self.server.requests))
+
+            # Status requests are never cached
+            rest.ping()
+            rest.ping()
+            self.assertEqual(3, len(self.server.requests))
+
+            # Kept between runs
+            rest = EnsemblRest(base_url=self.base_url, cache=ResponseCache(
+                60, cache_dir, clock=lambda: now[0]))
+            rest.lookup_ids(self.ids[:2])
+            self.assertEqual(3, len(self.server.requests))
+            now[0] = 61
+            rest.lookup_ids(self.ids[:2])
+            self.assertEqual(4, len(self.server.requests))
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_response_cache_bounded(self):
+        """Test the memory of the response cache is bounded"""
+        cache = ResponseCache(max_bytes=200)
+        for i in range(20):
+            cache.put('key%d' % i, {'id': 'ENSG%011d' % i})
+        self.assertIsNone(cache.get('key0'))
+        self.assertEqual({'id': 'ENSG%011d' % 19}, cache.get('key19'))
+        self.assertLessEqual(cache._memory.nbytes, 200)
+
+    def test_retry_after(self):
+        """Test 429 answers are retried after the Retry-After delay"""
+        self.server.throttle = 2
+        rest = EnsemblRest(base_url=self.base_url, reqs_per_sec=1000)
+        self.assertEqual({'ping': 1}, rest.ping())
+        self.assertEqual(3, len(self.server.requests))
+
+        self.server.throttle = 5
+        rest = EnsemblRest(base_url=self.base_url, retries=1)
+        self.assertRaises(HTTPError, rest.ping)
+
+    def test_async(self):
+        """Test AsyncEnsemblRest sends the batches concurrently"""
+        rest = AsyncEnsemblRest(concurrency=3, base_url=self.base_url,
+                                reqs_per_sec=1000)
+        rest.batch_size = 5
+
+        async def query():
+            return await asyncio.gather(rest.lookup_ids(self.ids),
+                                        rest.ping())
+
+        loop = asyncio.new_event_loop()
+        try:
+            got, ping = loop.run_until_complete(query())
+        finally:
+            loop.close()
+        self.assertEqual(self.ids, sorted(got))
+        self.assertEqual({'ping': 1}, ping)
+        self.assertEqual(6, len(self.server.requests))
+        self.assertLessEqual(len(self.server.clients), 3)
+
+
+class TestTokenBucket(unittest.TestCase):
+    def test_rate(self):
+        """Test TokenBucket allows a burst, then one token per interval"""
+        now = [0.0]
+        bucket = TokenBucket(10, clock=lambda: now[0])
+        self.assertEqual([0.0] * 10, [bucket.reserve() for _ in range(10)])
+        self.assertAlmostEqual(0.1, bucket.reserve())
+        self.assertAlmostEqual(0.2, bucket.reserve())
+        now[0] = 1.0
+        self.assertAlmostEqual(0.0, bucket.reserve())
+
+    def test_acquire(self):
+        """Test TokenBucket.acquire() sleeps for missing tokens"""
+        bucket = TokenBucket(2, capacity=1, clock=lambda: 0.0)
+        with mock.patch('dorina.ensembl.time.sleep') as sleep:
+            bucket.acquire()
+            bucket.acquire()
+        sleep.assert_called_once_with(0.5)
+
+
 class TestEnsemblFTP(unittest.TestCase):
-    pass
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        url = '/pub/release-90/regulation/homo_sapiens/Peaks/Aorta/'
+        self.files = {}
+        checksums = {}
+        for experiment in ('CTCF', 'H3K4me3'):
+            data = gzip.compress(
+                ('chr1\t10\t20\t%s\n' % experiment).encode('utf-8') * 100)
+            name = '%s.bed.gz' % experiment
+            self.files[url + experiment + '/' + name] = data
+            checksums[experiment] = checksum_line(data, name)
+        for experiment, line in checksums.items():
+            self.files[url + experiment + '/CHECKSUMS'] = line.encode('utf-8')
+        self.server = FakeFTP(self.files)
+
+        with mock.patch.object(EnsemblFTP, 'get_assembly',
+                               return_value='GRCh38'), \
+                mock.patch('dorina.ensembl.os.makedirs'):
+            self.ftp = EnsemblFTP('release-90', 'homo_sapiens', workers=2)
+        self.ftp.local_data = self.directory
+        self.ftp.downloader.ftp_factory = self.server
+
+    def tearDown(self):
+        self.ftp.close()
+        shutil.rmtree(self.directory)
+
+    def test_retrieve_from_regulation(self):
+        """Test peak files are downloaded in parallel and uncompressed"""
+        got = self.ftp.retrieve_from_regulation_by_experiment(
+            tissue='Aorta', experiment='*')
+        expected = [os.path.join(self.directory, 'GRCh38', '%s.bed' % x)
+                    for x in ('H3K4me3', 'CTCF')]
+        self.assertEqual(expected, got)
+        for filename in expected:
+            with open(filename, encoding='utf-8') as fh:
+                self.assertEqual(100, len(fh.readlines()))
+            self.assertFalse(os.path.exists(filename + '.gz'))
+        self.assertEqual([], self.ftp.url)
+        # Listing and downloads reuse the worker connections
+        self.assertLessEqual(len(self.server.connections), 3)
+
+    def test_local_files_skipped(self):
+        """Test files already available locally are not downloaded"""
+        os.makedirs(os.path.join(self.directory, 'GRCh38'))
+        open(os.path.join(self.directory, 'GRCh38', 'CTCF.bed'), 'w').close()
+        self.ftp.retrieve_from_regulation_by_experiment(tissue='Aorta')
+        transfers = [x for c in self.server.connections
+                     for x, _ in c.transfers]
+        self.assertEqual(1, len(transfers))
+        self.assertIn('H3K4me3', transfers[0])
 
 
 if __name__ == '__main__':
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+
+from __future__ import unicode_literals
+
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from dorina.explorer import NAME, DeseqTable
+
+
+class TestDeseqTable(unittest.TestCase):
+    def setUp(self):
+        self.frame = pd.DataFrame({
+            NAME: ['ACTB', 'GAPDH', 'ACTG1', 'TP53', 'MYC', None],
+            'baseMean': [100.0, 2000.0, 50.0, 10.0, 300.0, 1.0],
+            'log2FoldChange': [1.0, -2.0, 0.5, 3.0, -1.0, 0.0],
+            'pvalue': [0.001, 0.0001, 0.2, 0.01, 0.5, np.nan],
+            'padj': [0.01, 0.001, 0.4, 0.04, np.nan, np.nan]})
+        self.table = DeseqTable(self.frame, bins=10)
+
+    def expected(self, padj, text=''):
+        """Rows selected as the unindexed app did"""
+        frame = self.frame[self.frame['padj'] < padj]
+        if text:
+            frame = frame[frame[NAME].fillna('').str.contains(text,
+                                                              regex=False)]
+        return sorted(frame.index)
+
+    def test_select(self):
+        """Test DeseqTable.select() against a pandas filter"""
+        for padj in (0, 0.001, 0.02, 0.05, 1):
+            for text in ('', 'ACT', 'A', 'T', 'CTB', 'x', 'ACTB\nG'):
+                self.assertEqual(self.expected(padj, text.strip()),
+                                 sorted(self.table.select(padj, text)))
+
+    def test_select_order(self):
+        """Test DeseqTable.select() without a name gives the padj order"""
+        self.assertEqual([1, 0, 3], self.table.select(0.05).tolist())
+
+    def test_padj_range(self):
+        """Test DeseqTable.padj_range() skips missing values"""
+        self.assertEqual((0.001, 0.4), self.table.padj_range())
+
+    def test_view(self):
+        """Test DeseqTable.view() switching to binned counts"""
+        rows = self.table.select(1)
+        points, bins = self.table.view(rows, 'baseMean', 'log2FoldChange')
+        self.assertIsNone(bins)
+        self.assertEqual(['GAPDH', 'ACTB', 'TP53', 'ACTG1'],
+                         points['name'].tolist())
+        self.assertEqual([2000, 100, 10, 50], points['x'].tolist())
+
+        points, bins = self.table.view(rows, 'baseMean', 'log2FoldChange',
+                                       max_points=2)
+        self.assertIsNone(points)
+        self.assertEqual(4, bins['count'].sum())
+        self.assertEqual(4, len(bins['count']))
+        for x, y in zip([2000, 100, 10, 50], [-2, 1, 3, 0.5]):
+            hit = (abs(bins['x'] - x) <= bins['width'] / 2) & \
+                (abs(bins['y'] - y) <= bins['height'] / 2)
+            self.assertTrue(hit.any())
+
+    def test_density_missing(self):
+        """Test DeseqTable.density() leaves out missing values"""
+        rows = np.arange(len(self.frame))
+        bins = self.table.density(rows, 'pvalue', 'padj')
+        self.assertEqual(4, bins['count'].sum())
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+
+from __future__ import unicode_literals
+
+import os
+import shutil
+import tempfile
+import unittest
+from io import open
+from os import path
+
+from dorina import fasta
+
+CHR1 = 'ACGTACGTAAccggttNNACGTTTGGCCAAGT'
+CHR2 = 'GGGCCCAAAT'
+
+
+class TestFasta(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = path.join(self.tmpdir, 'genome.fa')
+        with open(self.filename, 'w', encoding='utf-8') as fh:
+            fh.write('>chr1 first\n')
+            for i in range(0, len(CHR1), 10):
+                fh.write(CHR1[i:i + 10] + '\n')
+            fh.write('>chr2\n%s\n%s\n' % (CHR2[:8], CHR2[8:]))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_build_fai(self):
+        """Test fasta.build_fai() and the written .fai file"""
+        index = fasta.build_fai(self.filename)
+        self.assertEqual({'chr1': [32, 12, 10, 11], 'chr2': [10, 54, 8, 9]},
+                         dict(index))
+        with fasta.FastaFile(self.filename):
+            pass
+        with open(fasta.fai_path(self.filename), encoding='utf-8') as fh:
+            self.assertEqual('chr1\t32\t12\t10\t11\nchr2\t10\t54\t8\t9\n',
+                             fh.read())
+        self.assertEqual(index, fasta.read_fai(self.filename))
+
+    def test_build_fai_invalid(self):
+        """Test fasta.build_fai() with uneven lines"""
+        with open(self.filename, 'w', encoding='utf-8') as fh:
+            fh.write('>chr1\nACGT\nAC\nACGT\n')
+        self.assertRaises(ValueError, fasta.build_fai, self.filename)
+
+    def test_fetch(self):
+        """Test FastaFile.fetch() against slices of the sequence"""
+        with fasta.FastaFile(self.filename) as genome:
+            for start in range(len(CHR1)):
+                for end in range(start, len(CHR1) + 1):
+                    self.assertEqual(CHR1[start:end],
+                                     genome.fetch('chr1', start, end))
+            self.assertEqual(CHR2, genome.fetch('chr2', 0, 100))
+            self.assertEqual('ATTTGG', genome.fetch('chr2', 4, 10, '-'))
+            self.assertEqual('aaccgg', genome.fetch('chr1', 10, 16, '-'))
+            self.assertEqual('', genome.fetch('chrX', 0, 10))
+
+    def test_sequences(self):
+        """Test FastaFile.sequences() keeps the order of the regions"""
+        with fasta.FastaFile(self.filename) as genome:
+            self.assertEqual(
+                ['GGCC', 'ACGT', 'GGGC'],
+                list(genome.sequences(['chr1', 'chr1', 'chr2'], [24, 0, 0],
+                                      [28, 4, 4], ['+', '-', '.'])))
+
+    def test_stale_index(self):
+        """Test a .fai file older than the FASTA file is rebuilt"""
+        with open(fasta.fai_path(self.filename), 'w',
+                  encoding='utf-8') as fh:
+            fh.write('chr1\t1\t1\t1\t1\n')
+        os.utime(fasta.fai_path(self.filename), (0, 0))
+        self.assertEqual(['chr1', 'chr2'],
+                         list(fasta.read_fai(self.filename)))
+
+    def test_aggregates(self):
+        """Test fasta.gc_content() and fasta.kmer_counts()"""
+        self.assertEqual(0.5, fasta.gc_content('ACgtNN'))
+        self.assertTrue(fasta.gc_content('NNN') != fasta.gc_content('NNN'))
+        counts = fasta.kmer_counts(iter(['ACGA', 'cgn']), 2)
+        self.assertEqual({'AC': 1, 'CG': 2, 'GA': 1}, dict(counts))
+        self.assertEqual('NACGTta', fasta.reverse_complement('taACGTN'))
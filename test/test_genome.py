@@ -2,10 +2,21 @@
 # -*- coding: utf-8
 
 from __future__ import unicode_literals
+import os
+import shutil
+import tempfile
 import unittest
 from os import path
 
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
 from dorina.genome import Genome
+from dorina.index import GeneIndex, TrackIndex, gene_index_path
+from dorina.intervals import Intervals
+from dorina.sorting import sorted_path
 
 
 class TestListDataWithoutOptions(unittest.TestCase):
@@ -57,3 +68,107 @@ class TestListDataWithoutOptions(unittest.TestCase):
         expected = ['gene01.01', 'gene01.02']
         got = Genome.get_genes('hg19')
         self.assertEqual(expected, got)
+
+    def test_genes_with_prefix(self):
+        """Test Genome.genes_with_prefix()"""
+        self.assertEqual(['gene01.01', 'gene01.02'],
+                         Genome.genes_with_prefix('hg19', 'gene'))
+        self.assertEqual(['gene01.02'],
+                         Genome.genes_with_prefix('hg19', 'gene01.02'))
+        self.assertEqual(['gene01.01'],
+                         Genome.genes_with_prefix('hg19', 'gene', limit=1))
+        self.assertEqual([], Genome.genes_with_prefix('hg19', 'x'))
+
+
+class TestGeneIndex(unittest.TestCase):
+    def setUp(self):
+        datadir = path.join(path.dirname(path.abspath(__file__)), 'data')
+        self.datadir = tempfile.mkdtemp()
+        shutil.copytree(path.join(datadir, 'genomes'),
+                        path.join(self.datadir, 'genomes'))
+        Genome.init(self.datadir)
+        self.cds = path.join(Genome.path_by_name('hg19'), 'cds.gff')
+
+    def tearDown(self):
+        shutil.rmtree(self.datadir)
+
+    def test_build_gene_indexes(self):
+        """Test Genome.build_gene_indexes()"""
+        self.assertIsNone(GeneIndex.open(self.cds))
+        got = Genome.build_gene_indexes()
+        self.assertEqual(6, len(got))
+
+        gene_index = GeneIndex.open(self.cds)
+        self.assertEqual([3, 4, 5], gene_index.rows(['gene01.02']).tolist())
+        self.assertEqual([], gene_index.rows(['invalid']).tolist())
+
+        intervals = Intervals.from_file(self.cds)
+        expected = intervals.filter(lambda x: x == 'gene01.02')
+        got = list(gene_index.read(self.cds, ['gene01.02', 'invalid']))
+        self.assertEqual(str(expected), ''.join(x + '\n' for x in got))
+
+    def test_build_gene_indexes_unsorted(self):
+        """Test Genome.build_gene_indexes() indexes the sorted copy of an
+        unsorted track"""
+        with open(self.cds) as fh:
+            lines = fh.readlines()
+        with open(self.cds, 'w') as fh:
+            fh.writelines(lines[::-1])
+        self.assertIn(sorted_path(self.cds), Genome.build_gene_indexes())
+        self.assertNotEqual(self.cds, sorted_path(self.cds))
+
+        gene_index = GeneIndex.open(sorted_path(self.cds))
+        self.assertIsNotNone(gene_index)
+        self.assertEqual([3, 4, 5], gene_index.rows(['gene01.02']).tolist())
+
+    def test_build_tracks(self):
+        """Test Genome.build_tracks()"""
+        self.assertIsNone(TrackIndex.open(self.cds))
+        self.assertEqual(6, len(Genome.build_tracks()))
+
+        expected = Intervals.from_file(self.cds)
+        got = TrackIndex.open(self.cds).intervals()
+        self.assertEqual(expected.names(), got.names())
+        self.assertEqual(['chr1'], list(got._chrom_groups()))
+        self.assertEqual(str(expected.take([4, 1])), str(got.take([4, 1])))
+        self.assertEqual(str(expected), str(got))
+
+        with open(self.cds, 'a') as fh:
+            fh.write('chr1\tdoRiNA2\tCDS\t5001\t5100\t.\t+\t0\tID=x\n')
+        self.assertIsNone(TrackIndex.open(self.cds))
+
+    def test_stale_gene_index(self):
+        """Test a gene index is ignored once its GFF file changes"""
+        GeneIndex.build(self.cds)
+        with open(self.cds, 'a') as fh:
+            fh.write('chr1\tdoRiNA2\tCDS\t5001\t5100\t.\t+\t0\tID=x\n')
+        self.assertIsNone(GeneIndex.open(self.cds))
+
+    def test_gene_catalog_persisted(self):
+        """Test Genome.get_genes() stores the gene index of all.gff, and
+        keeps it in memory when it can not"""
+        all_gff = path.join(Genome.path_by_name('hg19'), 'all.gff')
+        stored = gene_index_path(sorted_path(all_gff))
+        if path.exists(stored):
+            os.remove(stored)
+        with mock.patch('dorina.index.tempfile.mkstemp',
+                        side_effect=OSError('read-only')):
+            self.assertEqual(['gene01.01', 'gene01.02'],
+                             Genome.get_genes('hg19'))
+        self.assertIsNone(GeneIndex.open(sorted_path(all_gff)))
+
+        Genome._catalogs.clear()
+        self.assertEqual(['gene01.01', 'gene01.02'], Genome.get_genes('hg19'))
+        gene_index = GeneIndex.open(sorted_path(all_gff))
+        self.assertEqual(['gene01.01', 'gene01.02'],
+                         sorted(x for x in gene_index.genes if x))
+
+    def test_gene_catalog_invalidation(self):
+        """Test Genome.get_genes() picks up a changed all.gff"""
+        all_gff = path.join(Genome.path_by_name('hg19'), 'all.gff')
+        self.assertEqual(['gene01.01', 'gene01.02'], Genome.get_genes('hg19'))
+        with open(all_gff, 'a') as fh:
+            fh.write('chr1\tdoRiNA2\tgene\t5001\t6000\t.\t+\t.\tID=a01\n')
+        os.utime(all_gff, (0, 0))
+        self.assertEqual(['a01', 'gene01.01', 'gene01.02'],
+                         Genome.get_genes('hg19'))
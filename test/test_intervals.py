@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+
+from __future__ import unicode_literals
+
+import unittest
+from concurrent.futures import ProcessPoolExecutor
+from os import path
+
+from dorina.intervals import Intervals, read_chromsizes
+
+
+class TestIntervals(unittest.TestCase):
+    def setUp(self):
+        self.datadir = path.join(path.dirname(path.abspath(__file__)), 'data')
+        self.genome = path.join(self.datadir, 'genomes', 'h_sapiens', 'hg19')
+        self.a = Intervals.from_rows([
+            ('chr1', '10', '20', 'a1'),
+            ('chr1', '30', '40', 'a2'),
+            ('chr2', '10', '20', 'a3')])
+        self.b = Intervals.from_rows([
+            ('chr1', '0', '100', 'b1'),
+            ('chr1', '15', '16', 'b2'),
+            ('chr3', '10', '20', 'b3')])
+
+    def test_from_file(self):
+        """Test Intervals.from_file() on GFF and BED"""
+        gff = Intervals.from_file(path.join(self.genome, 'all.gff'))
+        self.assertEqual('gff', gff.file_type)
+        self.assertEqual([0, 2000], gff.starts.tolist())
+        self.assertEqual(['gene01.01', 'gene01.02'], gff.names())
+
+        bed = Intervals.from_file(path.join(self.datadir, 'manual.bed'))
+        self.assertEqual('bed', bed.file_type)
+        self.assertEqual(8, bed.field_count())
+        self.assertEqual(6, bed.bed6().field_count())
+
+    def test_overlaps(self):
+        """Test Intervals.overlaps()"""
+        a_hits, b_hits = self.a.overlaps(self.b)
+        self.assertEqual([0, 0, 1], a_hits.tolist())
+        self.assertEqual([0, 1, 0], b_hits.tolist())
+
+    def test_overlaps_nested(self):
+        """Test Intervals.overlaps() does not skip short nested intervals"""
+        b = Intervals.from_rows([
+            ('chr1', '0', '5', 'b1'),
+            ('chr1', '1', '50', 'b2'),
+            ('chr1', '2', '3', 'b3'),
+            ('chr1', '4', '35', 'b4')])
+        a_hits, b_hits = self.a.overlaps(b)
+        self.assertEqual([0, 0, 1, 1], a_hits.tolist())
+        self.assertEqual([1, 3, 1, 3], b_hits.tolist())
+
+    def test_overlaps_executor(self):
+        """Test Intervals.overlaps() sweeping chromosomes in worker processes"""
+        b = self.b.cat(Intervals.from_rows([('chr2', '5', '12', 'b4')]),
+                       postmerge=False)
+        expected = self.a.overlaps(b)
+        with ProcessPoolExecutor(max_workers=2) as executor:
+            got = self.a.overlaps(b, executor)
+        self.assertEqual([x.tolist() for x in expected],
+                         [x.tolist() for x in got])
+        self.assertEqual([0, 0, 1, 2], got[0].tolist())
+
+    def test_intersect(self):
+        """Test Intervals.intersect() flags"""
+        self.assertEqual('chr1\t10\t20\ta1\nchr1\t30\t40\ta2\n',
+                         str(self.a.intersect(self.b, wa=True, u=True)))
+        self.assertEqual('chr2\t10\t20\ta3\n',
+                         str(self.a.intersect(self.b, wa=True, v=True)))
+        self.assertEqual('chr1\t10\t20\ta1\nchr1\t15\t16\ta1\n'
+                         'chr1\t30\t40\ta2\n',
+                         str(self.a.intersect(self.b)))
+        got = self.a.intersect(self.b, wa=True, wb=True)
+        self.assertEqual(3, len(got))
+        self.assertEqual(('chr1', '10', '20', 'a1', 'chr1', '15', '16', 'b2'),
+                         got.rows[1])
+
+    def test_count_overlaps(self):
+        """Test Intervals.count_overlaps()"""
+        c = Intervals.from_rows([('chr1', '35', '36', 'c1'),
+                                 ('chr1', '36', '37', 'c2')])
+        # Two sites of b in a1 and two of c in a2 count once
+        self.assertEqual([1, 2, 0],
+                         self.a.count_overlaps([self.b, c]).tolist())
+        self.assertEqual([2, 3, 1],
+                         self.a.count_overlaps([self.b, c, self.a]).tolist())
+        self.assertEqual([0, 0, 0], self.a.count_overlaps([]).tolist())
+
+    def test_hits(self):
+        """Test that hits follow the rows through take(), cat() and sort()"""
+        a_hits, tags, local = self.a.tagged_overlaps([self.b, self.a])
+        self.assertEqual([0, 0, 0, 1, 1, 2], a_hits.tolist())
+        self.assertEqual([0, 1, 0, 0, 1, 1], tags.tolist())
+        self.assertEqual([0, 0, 1, 0, 1, 2], local.tolist())
+
+        a = self.a.take([2, 0])
+        a.hits = [[], [('chr1', '15', '16', 'b2')]]
+        merged = a.cat(self.a.take([1]), postmerge=False)
+        self.assertEqual(None, merged.hits)
+        b = self.a.take([1])
+        b.hits = [[('chr1', '0', '100', 'b1')]]
+        merged = a.cat(b, postmerge=False).sort()
+        self.assertEqual(['a1', 'a2', 'a3'], merged.names())
+        self.assertEqual('chr1\t10\t20\ta1\tchr1\t15\t16\tb2\n'
+                         'chr1\t30\t40\ta2\tchr1\t0\t100\tb1\n',
+                         str(merged.with_hits()))
+
+    def test_sort(self):
+        """Test Intervals.sort()"""
+        unsorted = self.b.cat(self.a, postmerge=False)
+        self.assertEqual(['b1', 'a1', 'b2', 'a2', 'a3', 'b3'],
+                         unsorted.sort().names())
+
+    def test_slop(self):
+        """Test Intervals.slop() clips to chromosome sizes"""
+        genome_file = path.join(self.genome, 'hg19.genome')
+        self.assertEqual(249250621, read_chromsizes(genome_file)['chr1'])
+        got = self.a.take([0]).slop(g=genome_file, b=15)
+        self.assertEqual('chr1\t0\t35\ta1\n', str(got))
+        unknown = Intervals.from_rows([('chrZ', '10', '20', 'z1')])
+        self.assertRaises(ValueError, unknown.slop, g=genome_file, b=1)
+
+    def test_cat(self):
+        """Test Intervals.cat() truncation rules"""
+        got = self.a.cat(self.b, postmerge=False)
+        self.assertEqual(6, len(got))
+        self.assertEqual(4, got.field_count())
+
+        gff = Intervals.from_file(path.join(self.genome, 'all.gff'))
+        got = self.a.cat(gff, postmerge=False)
+        self.assertEqual(('chr1', '0', '1000'), got.rows[3])
+        self.assertRaises(NotImplementedError, self.a.cat, self.b)
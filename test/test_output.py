@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+
+from __future__ import unicode_literals
+
+import gzip
+import shutil
+import sys
+import tempfile
+import unittest
+from io import open
+from os import path
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from dorina.intervals import Intervals
+from dorina.output import RESULT_COLUMNS, ResultWriter, check_format
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
+
+
+class TestResultWriter(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.result = Intervals.from_rows([
+            ('chr1', '10', '20', 'a1'),
+            ('chr1', '30', '40', 'a2'),
+            ('chr2', '10', '20', 'a3')])
+        self.text = str(self.result)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_bed(self):
+        """Test ResultWriter writes BED in chunks"""
+        filename = path.join(self.tmpdir, 'out.bed')
+        with ResultWriter(filename, 'bed', chunk_size=2) as writer:
+            writer.write(self.result, comment='query')
+        with open(filename, encoding='utf-8') as fh:
+            self.assertEqual('# query\n' + self.text, fh.read())
+
+    def test_tsv(self):
+        """Test ResultWriter writes a TSV header"""
+        filename = path.join(self.tmpdir, 'out.tsv')
+        with ResultWriter(filename, 'tsv') as writer:
+            writer.write(self.result)
+        with open(filename, encoding='utf-8') as fh:
+            self.assertEqual('field1\tfield2\tfield3\tfield4\n' + self.text,
+                             fh.read())
+
+    def test_bed_gz(self):
+        """Test ResultWriter compresses BED"""
+        filename = path.join(self.tmpdir, 'out.bed.gz')
+        with ResultWriter(filename, 'bed.gz') as writer:
+            writer.write(self.result)
+        with gzip.open(filename) as fh:
+            self.assertEqual(self.text, fh.read().decode('utf-8'))
+
+    @unittest.skipIf(pq is None, 'pyarrow is not installed')
+    def test_parquet(self):
+        """Test ResultWriter writes Parquet"""
+        filename = path.join(self.tmpdir, 'out.parquet')
+        with ResultWriter(filename, 'parquet', chunk_size=2) as writer:
+            writer.write(self.result)
+        table = pq.read_table(filename)
+        self.assertEqual(3, table.num_rows)
+        self.assertEqual(['a1', 'a2', 'a3'], table.column('field4').to_pylist())
+
+    @unittest.skipIf(pq is None, 'pyarrow is not installed')
+    def test_parquet_query(self):
+        """Test ResultWriter keeps the query id of batch results in Parquet"""
+        filename = path.join(self.tmpdir, 'out.parquet')
+        with ResultWriter(filename, 'parquet', chunk_size=2) as writer:
+            writer.write(self.result, 'first', 0)
+            writer.write(Intervals.from_rows([]), 'second', 1)
+            writer.write(self.result, 'third', 2)
+            self.assertRaises(ValueError, writer.write, self.result)
+        table = pq.read_table(filename)
+        self.assertEqual('query', table.column_names[0])
+        self.assertEqual([0, 0, 0, 2, 2, 2],
+                         table.column('query').to_pylist())
+
+    @unittest.skipIf(pq is None, 'pyarrow is not installed')
+    def test_parquet_query_fields(self):
+        """Test batch Parquet output pads results with fewer fields"""
+        feature = ['chr1', 'doRiNA2', 'gene', '1', '100', '.', '+', '.',
+                   'ID=g1']
+        filename = path.join(self.tmpdir, 'out.parquet')
+        with ResultWriter(filename, 'parquet') as writer:
+            writer.write([feature + ['chr1', '10', '20', 'r1']], 'first', 0)
+            writer.write([feature + ['chr1', '30', '40', 'r2', '5', '-']],
+                         'second', 1)
+        table = pq.read_table(filename)
+        self.assertEqual(['query'] + list(RESULT_COLUMNS), table.column_names)
+        self.assertEqual([None, '-'],
+                         table.column('regulator_strand').to_pylist())
+        self.assertEqual([10, 30], table.column('regulator_start').to_pylist())
+
+    def test_parquet_without_pyarrow(self):
+        """Test Parquet output fails up front without pyarrow"""
+        with mock.patch.dict(sys.modules, {'pyarrow': None}):
+            self.assertRaises(ValueError, check_format, 'parquet')
+            self.assertRaises(ValueError, ResultWriter,
+                              path.join(self.tmpdir, 'out.parquet'),
+                              'parquet')
+        check_format('bed')
+
+    def test_invalid_format(self):
+        """Test ResultWriter rejects unknown formats"""
+        self.assertRaises(ValueError, ResultWriter, '-', 'xml')
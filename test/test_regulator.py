@@ -2,10 +2,18 @@
 # -*- coding: utf-8
 
 from __future__ import unicode_literals
+import os
+import shutil
+import tempfile
 import unittest
 import json
 from os import path
 from dorina import utils
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+from dorina.index import IntervalIndex
 from dorina.regulator import Regulator
 from pybedtools import BedTool
 
@@ -92,3 +100,224 @@ class TestListDataWithoutOptions(unittest.TestCase):
         expected = BedTool(manual).bed6()
         got = Regulator.from_name(manual).bed
         self.assertEqual(expected, got)
+
+
+class TestRegulatorIndex(unittest.TestCase):
+    def setUp(self):
+        datadir = path.join(path.dirname(path.abspath(__file__)), 'data')
+        self.datadir = tempfile.mkdtemp()
+        shutil.copytree(path.join(datadir, 'regulators'),
+                        path.join(self.datadir, 'regulators'))
+        Regulator.init(self.datadir)
+
+    def tearDown(self):
+        shutil.rmtree(self.datadir)
+
+    def test_build_indexes(self):
+        """Test Regulator.build_indexes() matches the parsed BED files"""
+        names = ['PARCLIP_scifi', 'PICTAR_fake01', 'PICTAR_fake02',
+                 'PICTAR_fake023', 'fake024|Pictar']
+        expected = [str(Regulator.from_name(x, 'hg19').intervals)
+                    for x in names]
+
+        got = Regulator.build_indexes()
+        self.assertEqual(3, len(got))
+        bedfile = path.join(self.datadir, 'regulators', 'h_sapiens', 'hg19',
+                            'PICTAR_fake.bed')
+        index = IntervalIndex.open(bedfile)
+        self.assertTrue('PICTAR_fake02' in index)
+        self.assertEqual(2, len(index.intervals('PICTAR_fake02')))
+
+        got = [str(Regulator.from_name(x, 'hg19').intervals) for x in names]
+        self.assertEqual(expected, got)
+
+    def test_bed_from_index(self):
+        """Test Regulator.bed slices the index instead of filtering the
+        whole file"""
+        Regulator.build_indexes()
+        with mock.patch.object(BedTool, 'filter',
+                               side_effect=AssertionError('filtered')):
+            for name in ('PARCLIP_scifi', 'PICTAR_fake02', 'fake024|Pictar'):
+                regulator = Regulator.from_name(name, 'hg19')
+                with open(regulator.bed.fn) as fh:
+                    self.assertEqual(str(regulator.intervals), fh.read())
+
+    def test_stale_index(self):
+        """Test an index is ignored once its BED file changes"""
+        Regulator.build_indexes()
+        bedfile = path.join(self.datadir, 'regulators', 'h_sapiens', 'hg19',
+                            'PARCLIP_scifi.bed')
+        with open(bedfile, 'a') as fh:
+            fh.write('chr1\t5000\t5010\tPARCLIP#scifi*scifi_new\t5\t+\n')
+        self.assertIsNone(IntervalIndex.open(bedfile))
+        got = Regulator.from_name('PARCLIP_scifi', 'hg19').intervals
+        self.assertEqual(4, len(got))
+
+    def test_manifest(self):
+        """Test Regulator.init() reuses the manifest until a directory changes"""
+        manifest = path.join(self.datadir, 'regulators', utils.MANIFEST)
+        self.assertTrue(path.isfile(manifest))
+        expected = Regulator.all()
+
+        with mock.patch('dorina.utils.DorinaUtils.walk_assembly_tree') as walk:
+            Regulator.init(self.datadir)
+            self.assertFalse(walk.called)
+        self.assertEqual(expected, Regulator.all())
+
+        hg38 = path.join(self.datadir, 'regulators', 'h_sapiens', 'hg38')
+        shutil.copytree(path.join(path.dirname(hg38), 'hg18'), hg38)
+        Regulator.init(self.datadir)
+        self.assertTrue('hg38' in Regulator.all()['h_sapiens'])
+        self.assertEqual(
+            path.join(hg38, 'PICTAR_fake'),
+            Regulator.from_name('PICTAR_fake01', 'hg38').basename)
+
+    def test_manifest_working_directory(self):
+        """Test a manifest written with a relative data directory is reused
+        from another working directory"""
+        os.remove(path.join(self.datadir, 'regulators', utils.MANIFEST))
+        cwd = os.getcwd()
+        try:
+            os.chdir(path.dirname(self.datadir))
+            Regulator.init(path.basename(self.datadir))
+            os.chdir(self.datadir)
+            with mock.patch('dorina.utils.DorinaUtils.walk_assembly_tree') \
+                    as walk:
+                Regulator.init('.')
+                self.assertFalse(walk.called)
+            self.assertEqual(
+                path.realpath(path.join(self.datadir, 'regulators',
+                                        'h_sapiens', 'hg19',
+                                        'PARCLIP_scifi.bed')),
+                path.realpath(Regulator.from_name('PARCLIP_scifi',
+                                                  'hg19').path))
+        finally:
+            os.chdir(cwd)
+
+
+class TestRegulatorIngest(unittest.TestCase):
+    def setUp(self):
+        datadir = path.join(path.dirname(path.abspath(__file__)), 'data')
+        self.datadir = tempfile.mkdtemp()
+        for x in ('regulators', 'genomes'):
+            shutil.copytree(path.join(datadir, x), path.join(self.datadir, x),
+                            ignore=shutil.ignore_patterns('manifest.json'))
+        Regulator.init(self.datadir)
+        self.upload = tempfile.mkdtemp()
+        self.bedfile = path.join(self.upload, 'CLIP_new.bed')
+        self.jsonfile = path.join(self.upload, 'CLIP_new.json')
+        self.write("chr2\t500\t510\tCLIP#new*new_b\t3\t-\n"
+                   "chr1\t100\t120\tCLIP#new*new_a\t4\t+\n",
+                   [{'id': 'CLIP_new', 'experiment': 'CLIP'}])
+
+    def tearDown(self):
+        shutil.rmtree(self.datadir)
+        shutil.rmtree(self.upload)
+
+    def write(self, bed, experiments):
+        with open(self.bedfile, 'w') as fh:
+            fh.write(bed)
+        with open(self.jsonfile, 'w') as fh:
+            json.dump(experiments, fh)
+
+    def test_ingest(self):
+        """Test Regulator.ingest() adds a sorted and indexed regulator"""
+        ids = Regulator.ingest(self.datadir, self.bedfile, self.jsonfile,
+                               'hg19')
+        self.assertEqual(['CLIP_new'], ids)
+        bedfile = path.join(self.datadir, 'regulators', 'h_sapiens', 'hg19',
+                            'CLIP_new.bed')
+        index = IntervalIndex.open(bedfile)
+        self.assertTrue('CLIP_new' in index)
+        self.assertEqual(['chr1', 'chr2'],
+                         list(index.intervals('CLIP_new').chroms))
+        regulator = Regulator.from_name('CLIP_new', 'hg19')
+        self.assertEqual(bedfile, regulator.path)
+        self.assertEqual(2, len(regulator.intervals))
+
+        # The updated manifest is used without walking the tree again
+        with mock.patch.object(utils.DorinaUtils, 'walk_assembly_tree') as walk:
+            Regulator.init(self.datadir)
+        self.assertFalse(walk.called)
+        self.assertIn('CLIP_new', Regulator.all()['h_sapiens']['hg19'])
+        self.assertIn('PARCLIP_scifi', Regulator.all()['h_sapiens']['hg19'])
+
+        # The copied metadata is the uploaded one
+        with open(path.splitext(bedfile)[0] + '.json') as fh:
+            self.assertEqual([{'id': 'CLIP_new', 'experiment': 'CLIP'}],
+                             json.load(fh))
+
+    def test_ingest_relative(self):
+        """Test Regulator.ingest() into a relative data directory"""
+        cwd = os.getcwd()
+        try:
+            os.chdir(path.dirname(self.datadir))
+            Regulator.ingest(path.basename(self.datadir), self.bedfile,
+                             self.jsonfile, 'hg19')
+            os.chdir(self.datadir)
+            Regulator.init('.')
+            self.assertEqual(2, len(Regulator.from_name('CLIP_new',
+                                                        'hg19').intervals))
+        finally:
+            os.chdir(cwd)
+
+    def test_refresh(self):
+        """Test a process started before ingest() finds the new regulator"""
+        state = (Regulator._regulators, Regulator._by_assembly,
+                 Regulator._manifest_mtime)
+        Regulator.ingest(self.datadir, self.bedfile, self.jsonfile, 'hg19')
+        (Regulator._regulators, Regulator._by_assembly,
+         Regulator._manifest_mtime) = state
+        self.assertEqual(2, len(Regulator.from_name('CLIP_new',
+                                                    'hg19').intervals))
+        self.assertFalse(Regulator.refresh())
+
+    def test_init_concurrent_lookups(self):
+        """Test lookups during a reload never see partial regulators"""
+        Regulator.init(self.datadir)
+        seen = []
+        abspath = os.path.abspath
+
+        def lookup(filename):
+            # Runs while init() resolves the metadata paths
+            seen.append('PICTAR_fake01' in
+                        Regulator._by_assembly.get('hg19', {}))
+            return abspath(filename)
+
+        with mock.patch('os.path.abspath', side_effect=lookup):
+            Regulator.init(self.datadir)
+        self.assertTrue(seen)
+        self.assertTrue(all(seen))
+        self.assertIsNotNone(Regulator.from_name('PICTAR_fake01', 'hg19'))
+
+    def test_new_assembly(self):
+        """Test Regulator.ingest() into an assembly without regulators"""
+        self.assertRaises(ValueError, Regulator.ingest, self.datadir,
+                          self.bedfile, self.jsonfile, 'mm10')
+        Regulator.ingest(self.datadir, self.bedfile, self.jsonfile, 'mm10',
+                         'm_musculus')
+        self.assertIn('CLIP_new', Regulator.all()['m_musculus']['mm10'])
+
+    def test_invalid(self):
+        """Test Regulator.ingest() rejects invalid regulators untouched"""
+        invalid = [
+            ("chr1\t100\t120\tCLIP#new*new_a\t4\t+\n",
+             [{'id': 'PARCLIP_scifi'}]),
+            ("chr1\t100\t120\tCLIP#new*new_a\t4\t+\n", [{'summary': 'x'}]),
+            ("chr1\t120\t100\tCLIP#new*new_a\t4\t+\n", [{'id': 'CLIP_new'}]),
+            ("chr1\t100\t120\tCLIP#new*new_a\n", [{'id': 'CLIP_new'}]),
+            ("chrZ\t100\t120\tCLIP#new*new_a\t4\t+\n", [{'id': 'CLIP_new'}]),
+            ("chr1\t100\t120\tCLIP#new*new_a\t4\t+\n", [{'id': 'CLIP_old'}]),
+        ]
+        directory = path.join(self.datadir, 'regulators', 'h_sapiens', 'hg19')
+        for bed, experiments in invalid:
+            self.write(bed, experiments)
+            self.assertRaises(ValueError, Regulator.ingest, self.datadir,
+                              self.bedfile, self.jsonfile, 'hg19')
+            self.assertFalse(path.exists(path.join(directory, 'CLIP_new.bed')))
+
+        self.write("chr1\t100\t120\tCLIP#new*new_a\t4\t+\n",
+                   [{'id': 'CLIP_new'}])
+        Regulator.ingest(self.datadir, self.bedfile, self.jsonfile, 'hg19')
+        self.assertRaises(ValueError, Regulator.ingest, self.datadir,
+                          self.bedfile, self.jsonfile, 'hg19')
@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+
+from __future__ import unicode_literals
+
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from os import path
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from dorina import report
+from dorina.index import GeneTable, gene_table_path
+from dorina.intervals import Intervals
+
+
+class TestFeatureStats(unittest.TestCase):
+    def setUp(self):
+        datadir = path.join(path.dirname(path.abspath(__file__)), 'data')
+        self.genome = tempfile.mkdtemp()
+        source = path.join(datadir, 'genomes', 'h_sapiens', 'hg19')
+        for name in ('3_utr.gff', '5_utr.gff', 'cds.gff', 'intergenic.gff',
+                     'intron.gff'):
+            shutil.copy(path.join(source, name), self.genome)
+        self.peaks = path.join(datadir, 'regulators', 'h_sapiens', 'hg19',
+                               'PICTAR_fake.bed')
+
+    def tearDown(self):
+        shutil.rmtree(self.genome)
+
+    def expected_counts(self):
+        """Overlapping pairs counted one by one"""
+        peaks = Intervals.from_file(self.peaks)
+        counts = {}
+        for feature in report.FEATURES:
+            filename = report.feature_path(self.genome, feature)
+            if filename is None:
+                continue
+            features = Intervals.from_file(filename)
+            counts[feature] = sum(
+                1 for i in range(len(peaks)) for j in range(len(features))
+                if peaks.chroms[i] == features.chroms[j] and
+                peaks.starts[i] < features.ends[j] and
+                features.starts[j] < peaks.ends[i])
+        return counts
+
+    def test_feature_stats(self):
+        """Test report.feature_stats()"""
+        counts, lengths = report.feature_stats(self.peaks, self.genome)
+        self.assertEqual(['3_utr', '5_utr', 'cds', 'intergenic', 'intron'],
+                         list(counts.index))
+        self.assertEqual(self.expected_counts(), counts.to_dict())
+        self.assertEqual({'3_utr': 200, '5_utr': 400, 'cds': 1000,
+                          'intergenic': 1000, 'intron': 402},
+                         lengths.to_dict())
+
+    def test_feature_stats_processes(self):
+        """Test report.feature_stats() with worker processes"""
+        peaks = Intervals.from_file(self.peaks)
+        counts, lengths = report.feature_stats(self.peaks, self.genome)
+        parallel = report.feature_stats(peaks, self.genome, n_proc=3)
+        self.assertEqual(counts.to_dict(), parallel[0].to_dict())
+        self.assertEqual(lengths.to_dict(), parallel[1].to_dict())
+
+    def test_feature_stats_cached_lengths(self):
+        """Test report.feature_stats() takes the cached lengths"""
+        report.feature_stats(self.peaks, self.genome)
+        with mock.patch.object(report, 'read_coordinates',
+                               wraps=report.read_coordinates) as read:
+            _, lengths = report.feature_stats(self.peaks, self.genome)
+        # The peaks, then once per track for the counts only
+        self.assertEqual(6, read.call_count)
+        self.assertEqual(1000, lengths['cds'])
+
+    def test_feature_lengths_cached(self):
+        """Test report.feature_lengths() reading its cache"""
+        lengths = report.feature_lengths(self.genome)
+        cache = path.join(self.genome, report.FEATURE_LENGTHS)
+        self.assertTrue(path.isfile(cache))
+
+        with open(cache) as fh:
+            stored = json.load(fh)
+        stored['cds']['length'] = 1
+        with open(cache, 'w') as fh:
+            json.dump(stored, fh)
+        self.assertEqual(1, report.feature_lengths(self.genome)['cds'])
+
+        # A changed track is measured again
+        cds = path.join(self.genome, 'cds.gff')
+        os.utime(cds, (0, 0))
+        self.assertEqual(lengths.to_dict(),
+                         report.feature_lengths(self.genome).to_dict())
+
+    def test_feature_stats_table(self):
+        """Test report.feature_stats() on a peak table"""
+        counts, _ = report.feature_stats(self.peaks, self.genome)
+        table = report.load_peaks(self.peaks)
+        self.assertEqual(counts.to_dict(),
+                         report.feature_stats(table, self.genome)[0].to_dict())
+
+
+class TestPeakTable(unittest.TestCase):
+    def setUp(self):
+        datadir = path.join(path.dirname(path.abspath(__file__)), 'data')
+        self.peaks = path.join(datadir, 'regulators', 'h_sapiens', 'hg19',
+                               'PICTAR_fake.bed')
+
+    def test_load_peaks(self):
+        """Test report.load_peaks()"""
+        table = report.load_peaks(self.peaks)
+        self.assertEqual(list(report.COLUMNS), list(table.columns))
+        self.assertEqual(6, len(table))
+        self.assertEqual('PICTAR#fake01*fake01_cds', table['name'][0])
+        self.assertEqual(['+', '.', '.', '+', '+', '+'],
+                         list(table['strand']))
+
+    def test_load_peaks_regulator(self):
+        """Test report.load_peaks() keeping one regulator"""
+        table = report.load_peaks(self.peaks, 'fake02')
+        self.assertEqual(['PICTAR#fake02*fake02_intergenic',
+                          'PICTAR#fake02*fake02_intron',
+                          'PICTAR#fake023*fake023_rubbish',
+                          'fake024|Pictar'], list(table['name']))
+        self.assertEqual(4, len(table['name'].cat.categories))
+
+    def test_load_peaks_header(self):
+        """Test report.load_peaks() skipping header lines"""
+        with tempfile.NamedTemporaryFile('w', suffix='.bed') as fh:
+            fh.write('track name=peaks\n#comment\n'
+                     'chr2\t10\t30\tpeak#1\t.\t-\n')
+            fh.flush()
+            table = report.load_peaks(fh.name)
+        self.assertEqual(['peak#1'], list(table['name']))
+        self.assertTrue(table['score'].isnull().all())
+
+    def test_load_peaks_short(self):
+        """Test report.load_peaks() on BED files with fewer than six fields"""
+        with tempfile.NamedTemporaryFile('w', suffix='.bed') as fh:
+            fh.write('chr1\t10\t20\nchr2\t30\t40\n')
+            fh.flush()
+            table = report.load_peaks(fh.name)
+        self.assertEqual(list(report.COLUMNS), list(table.columns))
+        self.assertEqual([10, 30], list(table['start']))
+        self.assertEqual(['.', '.'], list(table['strand']))
+        self.assertTrue(table['score'].isnull().all())
+
+        with tempfile.NamedTemporaryFile('w', suffix='.bed') as fh:
+            fh.write('#comment\nchr1\t10\t20\tpeak#1\n')
+            fh.flush()
+            table = report.load_peaks(fh.name, 'peak')
+        self.assertEqual(['peak#1'], list(table['name']))
+        self.assertEqual('category', table['strand'].dtype.name)
+
+    def test_peak_gc_content(self):
+        """Test report.get_sequences() and report.peak_gc_content()"""
+        with tempfile.NamedTemporaryFile('w', suffix='.fa') as fh:
+            fh.write('>chr1\n' + 'ACGT' * 1000 + '\n')
+            fh.flush()
+            table = report.load_peaks(self.peaks)
+            sequences = list(report.get_sequences(table, fh.name))
+            gc = report.peak_gc_content(table, fh.name)
+            os.remove(fh.name + '.fai')
+        self.assertEqual('TACGTACGTA', sequences[0])
+        self.assertEqual('GTACGTACGT', sequences[1])
+        self.assertEqual([0.4, 0.5], gc[:2].tolist())
+        self.assertEqual(6, len(gc))
+
+    def test_summarize(self):
+        """Test report.summarize()"""
+        summary = report.summarize(report.load_peaks(self.peaks))
+        self.assertEqual([5, 5, 5, 5, 500, 500], list(summary['score']))
+        self.assertEqual([10] * 6, list(summary['length']))
+        self.assertEqual({'chr1': 6}, summary['chrom'].to_dict())
+
+    def test_main_bed3(self):
+        """Test report.main() on a BED3 file, which has no scores"""
+        tmpdir = tempfile.mkdtemp()
+        try:
+            target = path.join(tmpdir, 'peaks.bed')
+            with open(target, 'w') as fh:
+                fh.write('chr1\t10\t20\nchr1\t30\t45\nchr2\t5\t25\n')
+            self.assertEqual([], list(report.summarize(
+                report.load_peaks(target))['score']))
+            self.assertEqual(0, report.main(target, output_dir=tmpdir))
+            self.assertFalse(path.exists(path.join(tmpdir,
+                                                   'score_dist.html')))
+            self.assertTrue(path.exists(path.join(tmpdir,
+                                                  'peak_length.html')))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_stage_timer(self):
+        """Test report.StageTimer"""
+        timer = report.StageTimer()
+        with timer.stage('load'):
+            pass
+        self.assertEqual(['load'], list(timer.timings))
+        self.assertGreaterEqual(timer.timings['load'], 0)
+
+
+GTF = """#!genome-build GRCh37.p13
+1\tensembl\tgene\t1\t1000\t.\t+\t.\tgene_id "G1"; gene_biotype "protein_coding";
+1\tensembl\ttranscript\t1\t1000\t.\t+\t.\tgene_id "G1"; transcript_id "T1";
+1\tensembl\tgene\t1201\t1300\t.\t-\t.\tgene_id "G2"; gene_biotype "lincRNA";
+1\tensembl\tgene\t5001\t6000\t.\t+\t.\tgene_id "G3"; gene_biotype "protein_coding";
+chr2\tensembl\tgene\t1\t100\t.\t+\t.\tgene_id "G4"; gene_type "miRNA";
+"""
+
+
+class TestBiotypeCounts(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.gtf = path.join(self.tmpdir, 'Homo_sapiens.GRCh37.75.gtf.gz')
+        with gzip.open(self.gtf, 'wt') as fh:
+            fh.write(GTF)
+        datadir = path.join(path.dirname(path.abspath(__file__)), 'data')
+        self.peaks = path.join(datadir, 'regulators', 'h_sapiens', 'hg19',
+                               'PICTAR_fake.bed')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_gene_table(self):
+        """Test GeneTable.load() writing and reopening the table"""
+        self.assertIsNone(GeneTable.open(self.gtf))
+        genes = GeneTable.load(self.gtf)
+        self.assertEqual(path.join(self.tmpdir, 'Homo_sapiens.GRCh37.75'
+                                   '.gene_table'), genes.directory)
+        self.assertEqual(4, len(genes))
+        self.assertEqual({'chr1': [0, 3], 'chr2': [3, 4]},
+                         genes.meta['chroms'])
+        self.assertEqual([0, 1200, 5000, 0], list(genes.columns['start']))
+        self.assertEqual(['G1', 'G2', 'G3', 'G4'], genes.gene_ids.tolist())
+        self.assertEqual(['lincRNA', 'miRNA', 'protein_coding'],
+                         genes.biotypes)
+
+        self.assertIsNotNone(GeneTable.open(self.gtf))
+        os.utime(self.gtf, (0, 0))
+        self.assertIsNone(GeneTable.open(self.gtf))
+        self.assertEqual(gene_table_path(self.gtf),
+                         GeneTable.load(self.gtf).directory)
+
+    def test_biotype_counts(self):
+        """Test report.biotype_counts()"""
+        hits, totals = report.biotype_counts(self.peaks, self.gtf)
+        self.assertEqual({'lincRNA': 1, 'protein_coding': 1}, hits.to_dict())
+        self.assertEqual({'lincRNA': 1, 'protein_coding': 2},
+                         totals.to_dict())
+        table = report.load_peaks(self.peaks)
+        self.assertEqual(hits.to_dict(),
+                         report.biotype_counts(table, self.gtf)[0].to_dict())
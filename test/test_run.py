@@ -3,13 +3,23 @@
 
 from __future__ import unicode_literals
 
+import shutil
+import tempfile
 import unittest
 from os import path
 
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
 from pybedtools import BedTool
 
 from dorina import run
+from dorina.cache import ResultCache
 from dorina.genome import Genome
+from dorina.index import GeneIndex
+from dorina.intervals import Intervals
 from dorina.regulator import Regulator
 
 
@@ -91,6 +101,26 @@ class TestAnalyseWithoutOptions(unittest.TestCase):
                                match_a='all')
         self.assertEqual(expected, got)
 
+    def test_analyse_all_regions_seta_atleast(self):
+        """Test run.analyse() on all regions with at least two of three regulators
+        matching """
+        bed_str = """chr1   doRiNA2 gene    1   1000    .   +   .   ID=gene01.01    chr1    250 260 PARCLIP#scifi*scifi_cds 5   +
+        chr1    doRiNA2 gene    1   1000    .   +   .   ID=gene01.01    chr1    255 265 PICTAR#fake01*fake01_cds    5   +
+        chr1    doRiNA2 gene    2001    3000    .   +   .   ID=gene01.02    chr1    2350    2360    PARCLIP#scifi*scifi_intron  5   +
+        chr1    doRiNA2 gene    2001    3000    .   +   .   ID=gene01.02    chr1    2450    2460    PICTAR#fake02*fake02_intron 5   +"""
+        expected = BedTool(bed_str, from_string=True)
+        set_a = ['PARCLIP_scifi', 'PICTAR_fake01', 'PICTAR_fake02']
+        got = self.run.analyse('hg19', set_a=set_a, match_a='atleast',
+                               minmatch_a=2)
+        self.assertMultiLineEqual(str(expected), str(got))
+
+        got = self.run.analyse('hg19', set_a=set_a, match_a='atleast',
+                               minmatch_a=3)
+        self.assertEqual(0, len(got))
+
+        with self.assertRaises(ValueError):
+            self.run.analyse('hg19', set_a=set_a, match_a='most')
+
     def test_analyse_all_regions_seta_and_setb(self):
         """Test run.analyse() on all regions with any regulator from set A and any regulator
         from set B matching """
@@ -109,9 +139,9 @@ class TestAnalyseWithoutOptions(unittest.TestCase):
         set B matching """
         bed_str = """chr1   doRiNA2 gene    1   1000    .   +   .   ID=gene01.01    chr1    250 260 PARCLIP#scifi*scifi_cds 5   +
         chr1    doRiNA2 gene    1   1000    .   +   .   ID=gene01.01    chr1    255 265 PICTAR#fake01*fake01_cds    5   +
-        chr1    doRiNA2 gene    2001    3000    .   +   .   ID=gene01.02    chr1    2350    2360    PARCLIP#scifi*scifi_intron  5   +
         chr1    doRiNA2 gene    1   1000    .   +   .   ID=gene01.01    chr1    250 260 PARCLIP#scifi*scifi_cds 5   +
-        chr1    doRiNA2 gene    1   1000    .   +   .   ID=gene01.01    chr1    255 265 PICTAR#fake01*fake01_cds    5   +"""
+        chr1    doRiNA2 gene    1   1000    .   +   .   ID=gene01.01    chr1    255 265 PICTAR#fake01*fake01_cds    5   +
+        chr1    doRiNA2 gene    2001    3000    .   +   .   ID=gene01.02    chr1    2350    2360    PARCLIP#scifi*scifi_intron  5   +"""
         expected = BedTool(bed_str, from_string=True)
         got = self.run.analyse('hg19', set_a=['PARCLIP_scifi'], match_a='any',
                                region_a='any',
@@ -159,10 +189,10 @@ chr1	doRiNA2	gene	251	260	.	+	.	ID=gene01.01	chr1	255	265 PICTAR#fake01*fake01_c
         """Test run.analyse() on all regions with all regulators from set A matching in an
         overlapping window with slop """
         bed_str = """chr1	doRiNA2	gene    1	1260	.	+	.	ID=gene01.01	chr1	250	260	PARCLIP#scifi*scifi_cds	5	+
-chr1	doRiNA2	gene	1	1260	.	+	.	ID=gene01.01	chr1	1250	1260	PARCLIP#scifi*scifi_intergenic	5	.
 chr1	doRiNA2	gene	1	1260	.	+	.	ID=gene01.01	chr1	255	265	PICTAR#fake01*fake01_cds	5	+
-chr1	doRiNA2	gene	1351	3360	.	+	.	ID=gene01.02	chr1	2350	2360    PARCLIP#scifi*scifi_intron	5	+
-chr1	doRiNA2	gene	1351	3360	.	+	.	ID=gene01.02	chr1	1350	1360	PICTAR#fake01*fake01_intergenic	5	."""
+chr1	doRiNA2	gene	1	1260	.	+	.	ID=gene01.01	chr1	1250	1260	PARCLIP#scifi*scifi_intergenic	5	.
+chr1	doRiNA2	gene	1351	3360	.	+	.	ID=gene01.02	chr1	1350	1360	PICTAR#fake01*fake01_intergenic	5	.
+chr1	doRiNA2	gene	1351	3360	.	+	.	ID=gene01.02	chr1	2350	2360    PARCLIP#scifi*scifi_intron	5	+"""
         expected = BedTool(bed_str, from_string=True)
         got = self.run.analyse('hg19', set_a=['PARCLIP_scifi', 'PICTAR_fake01'],
                                match_a='all',
@@ -219,4 +249,194 @@ chr1	doRiNA2	gene	1351	3360	.	+	.	ID=gene01.02	chr1	1350	1360	PICTAR#fake01*fake
         self.assertEqual(expected, got)
 
 
+class TestAnalyseNative(TestAnalyseWithoutOptions):
+    """Run the analyse() expectations against the in-process engine"""
+    def setUp(self):
+        super(TestAnalyseNative, self).setUp()
+        self.run = run.Dorina(self.datadir, backend='native')
+
+    def assertEqual(self, first, second, msg=None):
+        # BedTool.__eq__ refuses other types, compare the text as it does
+        super(TestAnalyseNative, self).assertEqual(str(first), str(second),
+                                                   msg)
+
+    def test_cache(self):
+        """Test repeated analyse() calls are served from the cache"""
+        self.run.analyse('hg19', set_a=['PARCLIP_scifi'])
+        misses = self.run.cache.stats()['misses']
+        self.run.analyse('hg19', set_a=['PARCLIP_scifi'])
+        stats = self.run.cache.stats()
+        self.assertEqual(misses, stats['misses'])
+        self.assertEqual(misses, stats['hits'])
+
+    def test_window_single_regulator(self):
+        """Test a window around one regulator matches with any, all and
+        atleast alike"""
+        for window in (0, 1000):
+            expected = self.run.analyse('hg19', set_a=['PARCLIP_scifi'],
+                                        match_a='all', window_a=window)
+            self.assertTrue(len(expected) > 0)
+            for match in ('any', 'atleast'):
+                got = self.run.analyse('hg19', set_a=['PARCLIP_scifi'],
+                                       match_a=match, window_a=window)
+                self.assertEqual(expected, got)
+
+    def test_match_rows_of_kept_features(self):
+        """Test _match() builds regulator rows for kept features only"""
+        features = Intervals.from_rows([
+            ('chr1', '0', '100', 'f1', '0', '+'),
+            ('chr1', '200', '300', 'f2', '0', '+')])
+        fetched = []
+
+        def regulator(rows):
+            def fetch(idx):
+                fetched.extend((rows[0][3], int(i)) for i in idx)
+                return [rows[i] for i in idx]
+            parsed = Intervals.from_rows(rows)
+            return Intervals(None, 'bed', parsed.chroms, parsed.starts,
+                             parsed.ends, fetch=fetch)
+
+        regulators = [
+            regulator([('chr1', '10', '20', 'a', '0', '+'),
+                       ('chr1', '210', '220', 'a', '0', '+')]),
+            regulator([('chr1', '30', '40', 'b', '0', '+')])]
+        got = self.run._match(features, regulators, slice(0, 2), 2)
+        self.assertEqual(['f1'], got.names())
+        self.assertEqual([[('chr1', '10', '20', 'a', '0', '+'),
+                           ('chr1', '30', '40', 'b', '0', '+')]], got.hits)
+        self.assertEqual([('a', 0), ('b', 0)], sorted(fetched))
+
+    def test_analyse_batch(self):
+        """Test run.analyse_batch() matches single analyse() calls"""
+        queries = [
+            {'set_a': ['PARCLIP_scifi']},
+            {'set_a': ['PARCLIP_scifi'], 'region_a': 'CDS'},
+            {'set_a': ['PARCLIP_scifi'], 'set_b': ['PICTAR_fake01'],
+             'combine': 'xor'}]
+        expected = [self.run.analyse('hg19', **x) for x in queries]
+        got = list(self.run.analyse_batch('hg19', queries))
+        self.assertEqual([str(x) for x in expected], [str(x) for x in got])
+
+        with self.assertRaises(ValueError):
+            list(self.run.analyse_batch('hg19', [{'set_c': ['x']}]))
+
+    def test_analyse_jobs(self):
+        """Test run.analyse() with a worker pool gives the serial result"""
+        parallel = run.Dorina(self.datadir, backend='native', jobs=2)
+        try:
+            for combine in ('or', 'and', 'xor', 'not'):
+                expected = self.run.analyse(
+                    'hg19', set_a=['PARCLIP_scifi'], set_b=['PICTAR_fake01'],
+                    combine=combine)
+                got = parallel.analyse(
+                    'hg19', set_a=['PARCLIP_scifi'], set_b=['PICTAR_fake01'],
+                    combine=combine)
+                self.assertEqual(expected, got)
+        finally:
+            parallel.close()
+        self.assertRaises(ValueError, run.Dorina, self.datadir, jobs=0)
+
+    def test_analyse_track_store(self):
+        """Test run.analyse() on memory-mapped genome tracks"""
+        datadir = tempfile.mkdtemp()
+        try:
+            shutil.copytree(self.datadir, path.join(datadir, 'data'),
+                            ignore=shutil.ignore_patterns('.sorted'))
+            datadir = path.join(datadir, 'data')
+            mapped = run.Dorina(datadir, backend='native')
+            queries = ({'set_a': ['PARCLIP_scifi']},
+                       {'set_a': ['PARCLIP_scifi'], 'region_a': 'CDS',
+                        'genes': ['gene01.02']},
+                       {'set_a': ['PARCLIP_scifi', 'PICTAR_fake01'],
+                        'match_a': 'all', 'window_a': 1000})
+            expected = [str(mapped.analyse('hg19', **x)) for x in queries]
+
+            self.assertEqual(6, len(Genome.build_tracks()))
+            mapped.cache.clear()
+            track = mapped._get_genome_intervals('hg19', 'CDS')
+            self.assertIsNone(track._rows)
+            self.assertEqual(expected, [str(mapped.analyse('hg19', **x))
+                                        for x in queries])
+            self.assertIsNone(track._rows)
+        finally:
+            shutil.rmtree(path.dirname(datadir))
+
+    def test_result_cache(self):
+        """Test run.analyse() serves repeated queries from the result cache"""
+        directory = tempfile.mkdtemp()
+        try:
+            cached = run.Dorina(self.datadir, backend='native',
+                                result_cache=ResultCache(directory))
+            queries = ({'set_a': ['PARCLIP_scifi']},
+                       {'set_a': ['PARCLIP_scifi'], 'genes': ['all']},
+                       {'set_a': ['PARCLIP_scifi', 'PICTAR_fake01'],
+                        'match_a': 'all', 'window_a': 1000},
+                       {'set_a': ['PARCLIP_scifi'],
+                        'set_b': ['PICTAR_fake01'], 'combine': 'xor'})
+            expected = [str(self.run.analyse('hg19', **x)) for x in queries]
+            self.assertEqual(expected, [str(cached.analyse('hg19', **x))
+                                        for x in queries])
+            # The second query is the first one spelled differently
+            self.assertEqual(1, cached.results.stats()['hits'])
+
+            with mock.patch.object(cached, '_analyse') as analyse:
+                self.assertEqual(expected, [str(cached.analyse('hg19', **x))
+                                            for x in queries])
+                self.assertEqual(expected, [str(x) for x in
+                                            cached.analyse_batch('hg19',
+                                                                 queries)])
+            self.assertFalse(analyse.called)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_result_key(self):
+        """Test the result key follows the query and its input files"""
+        args = dict(run.QUERY_KEYS, set_a=['PARCLIP_scifi'])
+        key = self.run.result_key('hg19', args)
+        self.assertEqual(key, self.run.result_key(
+            'hg19', dict(args, match_b='all', window_a=-5, minmatch_a=3)))
+        self.assertNotEqual(key, self.run.result_key(
+            'hg19', dict(args, region_a='CDS')))
+        self.assertNotEqual(key, self.run.result_key(
+            'hg19', dict(args, match_a='atleast')))
+        with mock.patch('dorina.run.fingerprint',
+                        side_effect=lambda x: [x, 0, 0]):
+            self.assertNotEqual(key, self.run.result_key('hg19', args))
+
+    def test_invalid_backend(self):
+        """Test run.Dorina() with an unknown backend"""
+        self.assertRaises(ValueError, run.Dorina, self.datadir, 'invalid')
+
+    def test_add_slop(self):
+        """Test run._add_slop() on intervals"""
+        slop_string = """chr1   0   560 PARCLIP#scifi*scifi_cds 5   +
+        chr1    950 1560    PARCLIP#scifi*scifi_intergenic  5   .
+        chr1    2050    2660    PARCLIP#scifi*scifi_intron  5   +
+"""
+        expected = BedTool(slop_string, from_string=True)
+        regulator = Regulator.from_name('PARCLIP_scifi', "hg19")
+        got = self.run._add_slop(regulator.intervals, 'hg19', 300)
+        self.assertEqual(str(expected), str(got))
+
+    def test_get_genome_bedtool(self):
+        """Test self.run._get_genome_intervals()"""
+        self.assertRaises(ValueError, self.run._get_genome_intervals, 'hg19',
+                          'invalid')
 
+        got = self.run._get_genome_intervals('hg19', 'CDS')
+        self.assertEqual(6, len(got))
+        self.assertEqual('gff', got.file_type)
+
+        got = self.run._get_genome_intervals('hg19', 'any',
+                                             genes=['gene01.02'])
+        self.assertEqual(['gene01.02'], got.names())
+
+    def test_get_genome_intervals_gene_index(self):
+        """Test self.run._get_genome_intervals() through a gene index"""
+        cds = path.join(Genome.path_by_name('hg19'), 'cds.gff')
+        with mock.patch('dorina.run.GeneIndex.open',
+                        return_value=GeneIndex({'gene01.02': [[3, 6, 0, 0]]})):
+            got = self.run._get_genome_intervals('hg19', 'CDS',
+                                                 genes=['gene01.02'])
+        expected = Intervals.from_file(cds).filter(lambda x: x == 'gene01.02')
+        self.assertEqual(expected, got)
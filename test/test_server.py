@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+
+from __future__ import unicode_literals
+
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import unittest
+from os import path
+
+from dorina import run
+from dorina.server import QueryService, normalize, request
+
+
+class TestQueryService(unittest.TestCase):
+    def setUp(self):
+        self.datadir = path.join(path.dirname(path.abspath(__file__)), 'data')
+        self.dorina = run.Dorina(self.datadir, backend='native')
+        self.service = QueryService(self.dorina, timeout=10, workers=2)
+        self.loop = asyncio.new_event_loop()
+        self.server = self.loop.run_until_complete(self.service.start(port=0))
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    def tearDown(self):
+        self.server.close()
+        self.loop.run_until_complete(self.server.wait_closed())
+        self.service.close()
+        self.loop.close()
+        self.dorina.close()
+
+    def send(self, *requests):
+        async def send_all():
+            return await asyncio.gather(*[
+                request('127.0.0.1', self.port, *x) for x in requests])
+        return self.loop.run_until_complete(send_all())
+
+    def test_normalize(self):
+        """Test normalize() fills in defaults and rejects unknown keys"""
+        genome, args, key = normalize({'genome': 'hg19',
+                                       'set_a': ['PARCLIP_scifi']})
+        self.assertEqual('hg19', genome)
+        self.assertEqual(dict(run.QUERY_KEYS, set_a=['PARCLIP_scifi']), args)
+        self.assertEqual(key, normalize({'set_a': ['PARCLIP_scifi'],
+                                         'match_a': 'any',
+                                         'genome': 'hg19'})[2])
+        self.assertRaises(ValueError, normalize, {'genome': 'hg19'})
+        self.assertRaises(ValueError, normalize,
+                          {'genome': 'hg19', 'set_a': ['x'], 'bogus': 1})
+
+    def test_analyse(self):
+        """Test POST /analyse answers with the analyse() hits"""
+        expected = self.dorina.analyse('hg19', set_a=['PARCLIP_scifi'])
+        status, body = self.send(
+            ('POST', '/analyse', {'genome': 'hg19',
+                                  'set_a': ['PARCLIP_scifi']}))[0]
+        self.assertEqual(200, status)
+        self.assertEqual(len(expected), len(body.splitlines()))
+
+    def test_coalesce(self):
+        """Test identical concurrent queries share one computation"""
+        started = threading.Event()
+        release = threading.Event()
+        analyse = self.service._analyse
+
+        def slow_analyse(genome, args):
+            started.set()
+            release.wait(5)
+            return analyse(genome, args)
+
+        self.service._analyse = slow_analyse
+        query = ('POST', '/analyse', {'genome': 'hg19',
+                                      'set_a': ['PARCLIP_scifi']})
+
+        async def send_all():
+            pending = [asyncio.ensure_future(
+                request('127.0.0.1', self.port, *query)) for _ in range(4)]
+            while self.service.requests < 4:
+                await asyncio.sleep(0.01)
+            release.set()
+            return await asyncio.gather(*pending)
+
+        responses = self.loop.run_until_complete(send_all())
+        self.assertTrue(started.is_set())
+        self.assertEqual(set([200]), set(x for x, _ in responses))
+        self.assertEqual(1, len(set(x for _, x in responses)))
+        self.assertEqual(3, self.service.coalesced)
+
+    def test_errors(self):
+        """Test invalid queries and unknown targets are rejected"""
+        responses = self.send(
+            ('POST', '/analyse', {'set_a': ['PARCLIP_scifi']}),
+            ('POST', '/analyse', {'genome': 'hg19', 'set_a': ['nope']}),
+            ('GET', '/analyse'),
+            ('GET', '/nowhere'))
+        self.assertEqual([400, 400, 405, 404], [x for x, _ in responses])
+
+    def test_custom_regulator(self):
+        """Test regulator files of the server are not read for clients"""
+        with tempfile.NamedTemporaryFile('w', suffix='.bed') as fh:
+            fh.write('chr1\tsecret-value\t20\n')
+            fh.flush()
+            status, body = self.send(
+                ('POST', '/analyse', {'genome': 'hg19',
+                                      'set_a': [fh.name]}))[0]
+        self.assertEqual(400, status)
+        self.assertNotIn('secret', body)
+        self.assertRaises(ValueError, normalize,
+                          {'genome': 'hg19', 'set_a': ['PARCLIP_scifi'],
+                           'set_b': [os.sep + 'PARCLIP_scifi']})
+
+    def test_content_length(self):
+        """Test a missing or invalid Content-Length answers 400"""
+        async def send_raw(head):
+            reader, writer = await asyncio.open_connection('127.0.0.1',
+                                                           self.port)
+            writer.write(head.encode('latin-1'))
+            await writer.drain()
+            response = await reader.read()
+            writer.close()
+            return int(response.split()[1])
+
+        for head in ('POST /analyse HTTP/1.1\r\n\r\n{}',
+                     'POST /analyse HTTP/1.1\r\nContent-Length: x\r\n\r\n'):
+            self.assertEqual(400, self.loop.run_until_complete(
+                send_raw(head)))
+        self.assertEqual(0, self.service.errors)
+
+    def test_timeout(self):
+        """Test a query taking longer than the timeout answers 504"""
+        release = threading.Event()
+        self.service.timeout = 0.05
+        self.service._analyse = lambda genome, args: release.wait(5)
+        try:
+            status, _ = self.send(
+                ('POST', '/analyse', {'genome': 'hg19',
+                                      'set_a': ['PARCLIP_scifi']}))[0]
+        finally:
+            release.set()
+        self.assertEqual(504, status)
+        self.assertEqual(1, self.service.timeouts)
+
+    def test_busy(self):
+        """Test queued queries nobody waits for are dropped and queries
+        beyond the backlog answer 503"""
+        release = threading.Event()
+        self.service.timeout = 0.05
+        self.service.max_inflight = 3
+        self.service._analyse = lambda genome, args: release.wait(5)
+        queries = [('POST', '/analyse', {'genome': 'hg19', 'set_a': [x]})
+                   for x in ('PARCLIP_scifi', 'PICTAR_fake01', 'PICTAR_fake02')]
+        try:
+            responses = self.send(*queries)
+            # The two running queries keep their workers, the queued one
+            # was cancelled
+            self.assertEqual([504, 504, 504], [x for x, _ in responses])
+            self.assertEqual(2, len(self.service._inflight))
+            self.assertEqual({}, self.service._waiters)
+
+            self.service.max_inflight = 2
+            status, _ = self.send(queries[2])[0]
+            self.assertEqual(503, status)
+            self.assertEqual(1, self.service.rejected)
+        finally:
+            release.set()
+
+    def test_preload(self):
+        """Test QueryService.preload() fills the track cache"""
+        self.service.preload('hg19')
+        self.assertEqual(len(run.REGIONS), len(self.dorina.cache))
+
+    def test_stats(self):
+        """Test GET /stats reports the service counters"""
+        self.send(('POST', '/analyse', {'genome': 'hg19',
+                                        'set_a': ['PARCLIP_scifi']}))
+        status, body = self.send(('GET', '/stats'))[0]
+        self.assertEqual(200, status)
+        stats = json.loads(body)
+        self.assertEqual(1, stats['requests'])
+        self.assertEqual(0, stats['inflight'])
+        self.assertIn('cache', stats)
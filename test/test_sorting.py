@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+
+from __future__ import unicode_literals
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from io import open
+from os import path
+
+from dorina import sorting
+
+
+class TestSorting(unittest.TestCase):
+    def setUp(self):
+        datadir = path.join(path.dirname(path.abspath(__file__)), 'data')
+        self.datadir = tempfile.mkdtemp()
+        regulators = path.join(datadir, 'regulators', 'h_sapiens', 'hg19')
+        genome = path.join(datadir, 'genomes', 'h_sapiens', 'hg19')
+        self.unsorted = path.join(self.datadir, 'PICTAR_fake.bed')
+        self.gff = path.join(self.datadir, 'cds.gff')
+        shutil.copy(path.join(regulators, 'PICTAR_fake.bed'), self.unsorted)
+        shutil.copy(path.join(genome, 'cds.gff'), self.gff)
+
+    def tearDown(self):
+        shutil.rmtree(self.datadir)
+
+    def test_check_sorted(self):
+        """Test sorting.check_sorted()"""
+        self.assertEqual((True, ['chr1']), sorting.check_sorted(self.gff))
+        self.assertEqual((False, ['chr1']),
+                         sorting.check_sorted(self.unsorted))
+
+        chroms = path.join(self.datadir, 'chroms.bed')
+        with open(chroms, 'w', encoding='utf-8') as fh:
+            fh.write('chr2\t10\t20\nchr1\t10\t20\n')
+        self.assertEqual((False, ['chr2', 'chr1']),
+                         sorting.check_sorted(chroms))
+
+    def test_sorted_path(self):
+        """Test sorting.sorted_path() keeps sorted files and sorts others once"""
+        self.assertEqual(self.gff, sorting.sorted_path(self.gff))
+
+        copy = sorting.sorted_path(self.unsorted)
+        self.assertEqual(path.join(self.datadir, sorting.SORT_DIR,
+                                   'PICTAR_fake.bed'), copy)
+        with open(copy, encoding='utf-8') as fh:
+            starts = [int(x.split('\t')[1]) for x in fh]
+        self.assertEqual([255, 1255, 1350, 2450, 2450, 2450], starts)
+        self.assertEqual((True, ['chr1']), sorting.check_sorted(copy))
+        self.assertEqual(['chr1'],
+                         sorting.sort_record(self.unsorted)['chroms'])
+
+        # The record on disk is reused by a new process
+        sorting._records.clear()
+        stamp = os.stat(copy).st_mtime
+        self.assertEqual(copy, sorting.sorted_path(self.unsorted))
+        self.assertEqual(stamp, os.stat(copy).st_mtime)
+
+    def test_sorted_path_stale(self):
+        """Test sorting.sorted_path() checks a modified file again"""
+        sorting.sorted_path(self.unsorted)
+        with open(self.unsorted, 'w', encoding='utf-8') as fh:
+            fh.write('chr1\t10\t20\tsorted\t5\t+\n')
+        self.assertEqual(self.unsorted, sorting.sorted_path(self.unsorted))
+
+    def test_sort_file_threads(self):
+        """Test threads sorting the same file do not share a temporary file"""
+        source = path.join(self.datadir, 'large.bed')
+        with open(source, 'w', encoding='utf-8') as fh:
+            for i in range(20000, 0, -1):
+                fh.write('chr1\t%d\t%d\tsite%d\t5\t+\n' % (i, i + 10, i))
+        target = path.join(self.datadir, 'large.sorted.bed')
+        errors = []
+
+        def sort():
+            try:
+                sorting.sort_file(source, target)
+                sorting.store_record(source, False, ['chr1'], sort=False)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=sort) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([], errors)
+        self.assertEqual((True, ['chr1']), sorting.check_sorted(target))
+        with open(target, encoding='utf-8') as fh:
+            self.assertEqual(20000, len(fh.readlines()))
+        self.assertEqual(['large.bed', 'large.sorted.bed'],
+                         sorted(x for x in os.listdir(self.datadir)
+                                if x.startswith('large')))
+        self.assertEqual(['large.bed.json'],
+                         sorted(os.listdir(path.join(self.datadir,
+                                                     sorting.SORT_DIR))))
+
+
+if __name__ == '__main__':
+    unittest.main()